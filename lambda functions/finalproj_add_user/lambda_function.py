@@ -7,46 +7,30 @@
 
 import json
 import bcrypt
-import os
 import datatier
+import applog
+import tracing
+import usercache
 
-from configparser import ConfigParser
-
+@tracing.traced("/user")
 def lambda_handler(event, context):
-    print("**Call to Lambda /user...")
-
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    applog.debug("**Call to Lambda /user...")
 
     try:
         # Parse incoming data from the event
         data = json.loads(event['body'])  # Assuming the client sends JSON in the body
-        print(data)
+        applog.debug("request", username=data.get("username"))
 
         # Hash the password securely using bcrypt, gensalt makes sure the same passwords don't have the same hashing
-        pwdhash = bcrypt.hashpw(data["pwdhash"].encode('utf-8'), bcrypt.gensalt())
+        with tracing.span("bcrypt.hash"):
+            pwdhash = bcrypt.hashpw(data["pwdhash"].encode('utf-8'), bcrypt.gensalt())
 
         #
-        # configure for RDS access
-        #
-        rds_endpoint = configur.get('rds', 'endpoint')
-        rds_portnum = int(configur.get('rds', 'port_number'))
-        rds_username = configur.get('rds', 'user_name')
-        rds_pwd = configur.get('rds', 'user_pwd')
-        rds_dbname = configur.get('rds', 'db_name')
-        
-        #
-        # open connection to the database:
+        # open (or reuse) the connection to the database:
         #
-        print("**Opening connection**")
+        applog.debug("**Opening connection**")
     
-        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+        dbConn = datatier.connection()
 
        
         # Check if the username already exists
@@ -69,13 +53,15 @@ def lambda_handler(event, context):
                 VALUES (%s, %s);
             """
             datatier.perform_action(dbConn, sql2, [data["username"], pwdhash.decode('utf-8')]) # decode turns the binary hash into a string
+            datatier.note_write(data["username"])
+            usercache.invalidate(data["username"])
 
             # Get the inserted user ID
             sql3 = "SELECT LAST_INSERT_ID();"
             row = datatier.retrieve_one_row(dbConn, sql3)
             userid = row[0]
             
-            print("Account created! Your userid is:", userid)
+            applog.info("Account created", userid=userid)
 
             return {
                 "statusCode": 200,
@@ -86,8 +72,7 @@ def lambda_handler(event, context):
             }
 	
     except Exception as err:
-        print("**ERROR**")
-        print(str(err))
+        applog.error("**ERROR**", error=str(err))
         
         return {
         'statusCode': 500,
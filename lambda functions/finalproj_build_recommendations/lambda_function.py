@@ -0,0 +1,188 @@
+#
+# build_recommendations()
+#
+# Runs on a schedule (an EventBridge rule, e.g. rate(1 day)) to rebuild the recommendation
+# tables (see recommend.py) from all the entries:
+#
+#   - the picks become a sparse users x tracks matrix X and a users x artists matrix Y
+#     (1 if the user ever picked the track / artist);
+#   - track similarity is the cosine similarity of X's columns, XᵀX scaled by the number
+#     of users of each track, plus ARTIST_WEIGHT times the similarity of the tracks'
+#     artists (the same computed on Y);
+#   - each track keeps its NEIGHBORS most similar tracks (track_neighbors), and each user
+#     the RECOMMENDATIONS best tracks they have not picked, scored against their
+#     RECENT_ENTRIES latest picks (recommendations).
+#
+# All of it is sparse matrix arithmetic (NumPy / SciPy), so a run takes one pass over the
+# entries however many users there are. Needs numpy and scipy (e.g. as a layer).
+#
+
+import json
+import numpy as np
+import scipy.sparse as sp
+import datatier
+import applog
+import metrics
+import recommend
+import tracing
+
+
+STREAM_BATCH = 5000   # picks per batch read from the database
+
+
+###################################################################
+#
+# matrices
+#
+def load_picks():
+  """
+  Returns the picks as an int array with a row (userid, trackid,
+  artistid) per entry, each user's newest first.
+  """
+  sql = """
+    SELECT e.userid, e.trackid, t.artistid
+    FROM entries e JOIN tracks t ON t.trackid = e.trackid
+    ORDER BY e.userid, e.entrydate DESC
+  """
+  batches = [np.array(rows, dtype=np.int64)
+             for rows in datatier.stream_rows(datatier.reader(), sql, batch_size=STREAM_BATCH)]
+  return np.concatenate(batches) if batches else np.empty((0, 3), dtype=np.int64)
+
+
+def incidence(rows, cols, shape):
+  """
+  Returns the rows x cols CSR matrix with a 1 where (row, col)
+  occurs at least once.
+  """
+  m = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+  m.sum_duplicates()
+  m.data[:] = 1.0
+  return m
+
+
+def cosine(X):
+  """
+  Returns the cosine similarity of the columns of the binary
+  matrix X, as a sparse matrix.
+  """
+  counts = np.asarray(X.sum(axis=0)).ravel()
+  scale = sp.diags(1.0 / np.sqrt(np.maximum(counts, 1)))
+  return (scale @ (X.T @ X) @ scale).tocsr()
+
+
+def top_n(S, n):
+  """
+  Returns S with only the n largest values of each row kept.
+  """
+  S = S.tocsr()
+  (rows, cols, vals) = ([], [], [])
+  for r in range(S.shape[0]):
+    (start, end) = (S.indptr[r], S.indptr[r + 1])
+    data = S.data[start:end]
+    idx = S.indices[start:end]
+    if len(data) > n:
+      keep = np.argpartition(-data, n)[:n]
+      (data, idx) = (data[keep], idx[keep])
+    rows.append(np.full(len(idx), r))
+    cols.append(idx)
+    vals.append(data)
+
+  if not rows:
+    return sp.csr_matrix(S.shape)
+  return sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=S.shape)
+
+
+def triples(M, row_ids, col_ids):
+  """
+  Returns [row id, col id, value] for the nonzero values of M, as
+  Python values (for the database driver).
+  """
+  M = M.tocoo()
+  return [list(t) for t in zip(row_ids[M.row].tolist(), col_ids[M.col].tolist(), M.data.tolist())]
+
+
+def build(picks):
+  """
+  Returns (track neighbor rows, recommendation rows) computed from
+  the picks (see load_picks).
+  """
+  (users, u) = np.unique(picks[:, 0], return_inverse=True)
+  (tracks, t) = np.unique(picks[:, 1], return_inverse=True)
+  (artists, a) = np.unique(picks[:, 2], return_inverse=True)
+
+  #
+  # track-track similarity, from the tracks and from their artists:
+  #
+  with tracing.span("recommend.similarity"):
+    X = incidence(u, t, (len(users), len(tracks)))
+    Y = incidence(u, a, (len(users), len(artists)))
+    P = incidence(t, a, (len(tracks), len(artists)))   # each track's artist
+
+    S = cosine(X) + recommend.ARTIST_WEIGHT * (P @ cosine(Y) @ P.T)
+    S = S.tolil()
+    S.setdiag(0)
+    S = S.tocsr()
+    S.eliminate_zeros()
+
+    neighbors = top_n(S, recommend.NEIGHBORS)
+
+  #
+  # each user's recent picks (picks are newest first per user, and
+  # sorted by user) scored against the neighbors, without the
+  # tracks they already picked:
+  #
+  with tracing.span("recommend.users"):
+    starts = np.searchsorted(u, np.arange(len(users)))
+    recent = (np.arange(len(u)) - starts[u]) < recommend.RECENT_ENTRIES
+
+    R = sp.csr_matrix((np.ones(recent.sum()), (u[recent], t[recent])), shape=X.shape) @ neighbors
+    R = R - R.multiply(X)
+    R.eliminate_zeros()
+
+    recommendations = top_n(R, recommend.RECOMMENDATIONS)
+
+  return (triples(neighbors, tracks, tracks), triples(recommendations, users, tracks))
+
+
+@tracing.traced("build_recommendations")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_build_recommendations**")
+
+    picks = load_picks()
+    (neighbors, recommendations) = build(picks) if len(picks) else ([], [])
+
+    metrics.count("TrackNeighbors", len(neighbors))
+    metrics.count("Recommendations", len(recommendations))
+
+    #
+    # replace the tables in one transaction, so /recommendations
+    # never sees them half written:
+    #
+    dbConn = datatier.connection()
+    with datatier.transaction(dbConn):
+      datatier.perform_action(dbConn, "DELETE FROM recommendations")
+      datatier.perform_action(dbConn, "DELETE FROM track_neighbors")
+      datatier.perform_bulk_action(dbConn, """
+        INSERT INTO track_neighbors(trackid, neighbor, score) VALUES(%s, %s, %s)
+      """, neighbors)
+      datatier.perform_bulk_action(dbConn, """
+        INSERT INTO recommendations(userid, trackid, score) VALUES(%s, %s, %s)
+      """, recommendations)
+
+    applog.info("**DONE**", picks=len(picks), neighbors=len(neighbors), recommendations=len(recommendations))
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"picks": len(picks), "neighbors": len(neighbors),
+                          "recommendations": len(recommendations)})
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -3,14 +3,16 @@
 # Spotify account through API Gateway. Creates JSON file of results and uploads to S3 bucket.
 #
 
-import urllib3
-import urllib
+import urllib.parse
 import json
-import boto3
-import os
 import base64
+import applog
+import httppool
+import metrics
+import runtime
+import tracing
 
-from configparser import ConfigParser
+metrics.install()
 
 ###################################################################
 #
@@ -20,7 +22,6 @@ class Concert:
   def __init__(self, artist, body):
     self.artist = artist
     self.date = body['dates']['start']['localDate']
-    print("***Got date***")
     location_result = body['_embedded']['venues'][0]
     if "city" in location_result:
       self.location = location_result['city']['name']
@@ -28,9 +29,7 @@ class Concert:
       self.location = self.location + ', ' + location_result['state']['name']
     if "country" in location_result:
       self.location = self.location + ', ' + location_result['country']['name']
-    print("***Got location***")
     self.link = body['url']
-    print("***Got link***")
   
   def to_dict(self):
     return {
@@ -42,28 +41,25 @@ class Concert:
 
 ###################################################################
 
+@tracing.traced("/callback")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: finalproj_concerts**")
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_concerts**")
     #
     # setup AWS based on config file:
     #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    with tracing.span("config"):
+      configur = runtime.config()
   
     #
     # configure for S3 access:
     #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
+    with tracing.span("s3.setup"):
+      s3_profile = 's3readwrite'
+      bucketname = configur.get('s3', 'bucket_name')
+      
+      s3 = runtime.aws_resource('s3', profile=s3_profile)
     
     #
     # get spotify and ticketmaster api baseurls
@@ -85,15 +81,14 @@ def lambda_handler(event, context):
     #
     # get authorization and access token from Spotify API
     #
-    http = urllib3.PoolManager()
+    http = httppool.pool()
     client_id = configur.get('spotify', 'client_id')
     client_secret = configur.get('spotify', 'client_secret')
     redirect_uri = 'https://t3jlpdy0mi.execute-api.us-east-2.amazonaws.com/prod/callback'
 
     code = event['queryStringParameters']['code']
-    print(code)
     
-    print("**Getting access token**")
+    applog.debug("**Getting access token**")
     auth_url = 'https://accounts.spotify.com/api/token'
 
     headers = {
@@ -108,47 +103,48 @@ def lambda_handler(event, context):
     }
     data = urllib.parse.urlencode(data)
 
-    res = http.request('POST', auth_url, headers=headers, body=data)
+    with tracing.span("spotify.token"):
+      res = http.request('POST', auth_url, headers=headers, body=data)
 
     if res.status == 200: #success
       pass
     else:
       # failed:
-      print("Failed with status code:", res.status)
-      print("url: " + auth_url)
+      applog.warning("Failed with status code", status=res.status, url=auth_url)
+      metrics.count("ExternalErrors")
       if res.status == 500:
         # we'll have an error message
         body = json.loads(res.data.decode('utf-8'))
-        print("Error message:", body)
+        applog.warning("Error message", body=body)
       #
       return
     body = json.loads(res.data.decode('utf-8'))
     access_token = body['access_token']
-    print(access_token)
 
-    print("***Access token retrieved**")
+    applog.debug("***Access token retrieved**")
     # 
     # get top 5 artists with Spotify API
     #
-    print("**Searching Spotify API for user's top artists**")
+    applog.debug("**Searching Spotify API for user's top artists**")
     api = '/me/top/artists'
     url = spotifybaseurl + api
     header = {
       "Authorization": "Bearer " + access_token
     }
 
-    res = http.request('GET', url, headers=header)
+    with tracing.span("spotify.top_artists"):
+      res = http.request('GET', url, headers=header)
 
     if res.status == 200: #success
       pass
     else:
       # failed:
-      print("Failed with status code:", res.status)
-      print("url: " + url)
+      applog.warning("Failed with status code", status=res.status, url=url)
+      metrics.count("ExternalErrors")
       if res.status == 500:
         # we'll have an error message
         body = json.loads(res.data.decode('utf-8'))
-        print("Error message:", body)
+        applog.warning("Error message", body=body)
       #
       return
     
@@ -160,14 +156,12 @@ def lambda_handler(event, context):
       artist = items[i]['name']
       artists.append(artist)
 
-    print(artists)
-
-    print("**COMPLETE**")
+    applog.debug("top artists", artists=artists)
 
     # 
     # search for next 3 attractions with Ticketmaster API for each top artist
     #
-    print("**Searching Ticketmaster API for upcoming concerts**")
+    applog.debug("**Searching Ticketmaster API for upcoming concerts**")
     consumer_key = configur.get('ticketmaster', 'consumer_key')
     
     # artists = ["Tate McRae", "Billie Eilish", "Sabrina Carpenter"]
@@ -184,34 +178,32 @@ def lambda_handler(event, context):
       }
       data = urllib.parse.urlencode(data)
 
-      res = http.request('GET', url + data)
+      with tracing.span("ticketmaster.search"):
+        res = http.request('GET', url + data)
 
       if res.status == 200: #success
         pass
       else:
         # failed:
-        print("Failed with status code:", res.status)
-        print("url: " + url)
+        applog.warning("Failed with status code", status=res.status, url=url)
+        metrics.count("ExternalErrors")
         if res.status == 500:
           # we'll have an error message
           body = json.loads(res.data.decode('utf-8'))
-          print("Error message:", body)
+          applog.warning("Error message", body=body)
         #
         return
       
       body = json.loads(res.data.decode('utf-8'))
-      print(body)
       if "_embedded" not in body: 
+        applog.debug("no upcoming concerts", artist=artist)
         continue
 
       else:
         # get details for each result
         results = body['_embedded']['events'][0]
-        print("next concerts for one artist: ")
-        print(results)
-        print("***Searching for details for each result***")
         id = results['id']
-        print(id)
+        applog.debug("***Searching for details for each result***", artist=artist, event_id=id)
         if (id is not ''):
           api = '/events/' + id + '?'
           url = ticketmasterbaseurl + api
@@ -220,41 +212,34 @@ def lambda_handler(event, context):
           }
           data = urllib.parse.urlencode(data)
           
-          res = http.request('GET', url + data)
+          with tracing.span("ticketmaster.event"):
+            res = http.request('GET', url + data)
 
         if res.status == 200: #success
           pass
         else:
           # failed:
-          print("Failed with status code:", res.status)
-          print("url: " + url)
+          applog.warning("Failed with status code", status=res.status, url=url)
+          metrics.count("ExternalErrors")
           if res.status == 500:
             # we'll have an error message
             body = json.loads(res.data.decode('utf-8'))
-            print("Error message:", body)
+            applog.warning("Error message", body=body)
           #
           return
         
         body = json.loads(res.data.decode('utf-8'))
-        print("details for each concert: ")
-        print(body)
         concerts.append(Concert(artist, body).to_dict())
 
 
-    print("**Upload JSON results to S3**")
-    s3.Object(bucketname, "concerts_results.json").put(
-        Body=json.dumps(concerts),
-        ContentType='application/json'
-    )
-
-    print("**COMPLETE**")
+    applog.debug("**Upload JSON results to S3**", concerts=len(concerts))
+    with tracing.span("s3.put"):
+      s3.Object(bucketname, "concerts_results.json").put(
+          Body=json.dumps(concerts),
+          ContentType='application/json'
+      )
 
-    #
-    # list upcoming concerts
-    #
-    print("Upcoming concerts:")
-    for concert in concerts:
-      print(concert)
+    applog.debug("**COMPLETE**")
 
     return {
       'statusCode': 200,
@@ -262,8 +247,7 @@ def lambda_handler(event, context):
     }
     
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    applog.error("**ERROR**", error=str(err))
     
     return {
       'statusCode': 500,
@@ -7,27 +7,28 @@
 
 import urllib.parse
 import json
-import os
+import applog
+import metrics
+import runtime
+import tracing
 
-from configparser import ConfigParser
+metrics.install()
 
+@tracing.traced("/concerts-init")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: finalproj_concerts_init**")
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_concerts_init**")
     #
     # setup AWS based on config file:
     #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    with tracing.span("config"):
+      configur = runtime.config()
 
     #
     # get authorization and access token from Spotify API
     #
-    print("**Getting authorization from user**")
+    applog.debug("**Getting authorization from user**")
     client_id = configur.get('spotify', 'client_id')
     client_secret = configur.get('spotify', 'client_secret')
     redirect_uri = 'https://t3jlpdy0mi.execute-api.us-east-2.amazonaws.com/prod/callback'
@@ -40,7 +41,6 @@ def lambda_handler(event, context):
     }
 
     params = urllib.parse.urlencode(params)
-    print('**Please copy and paste this link into your browser to grant Reverb authorization to your Spotify account: https://accounts.spotify.com/authorize?' + params + ' **')
 
     url = 'https://accounts.spotify.com/authorize?' + params
     return {
@@ -49,8 +49,7 @@ def lambda_handler(event, context):
     }
     
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    applog.error("**ERROR**", error=str(err))
     
     return {
       'statusCode': 500,
@@ -4,40 +4,40 @@
 #
 
 import json
-import boto3
-import os
+import applog
+import metrics
+import runtime
+import tracing
 
-from configparser import ConfigParser
+metrics.install()
 
 ###################################################################
 
+@tracing.traced("/concerts")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: finalproj_concerts**")
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_get_concerts**")
     
     #
     # setup AWS based on config file:
     #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    with tracing.span("config"):
+      configur = runtime.config()
   
     #
     # configure for S3 access:
     #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
+    with tracing.span("s3.setup"):
+      s3_profile = 's3readwrite'
+      bucketname = configur.get('s3', 'bucket_name')
+      
+      s3 = runtime.aws_resource('s3', profile=s3_profile)
     
-    response = s3.Object(bucketname, "concerts_results.json").get()
-    file_content = response['Body'].read().decode('utf-8') 
-    print(response)
+    with tracing.span("s3.get"):
+      response = s3.Object(bucketname, "concerts_results.json").get()
+      file_content = response['Body'].read().decode('utf-8') 
+    applog.debug("concerts results read", size=len(file_content))
 
     return {
       'statusCode': 200,
@@ -45,8 +45,7 @@ def lambda_handler(event, context):
     }
     
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    applog.error("**ERROR**", error=str(err))
     
     return {
       'statusCode': 500,
@@ -6,22 +6,14 @@
 
 import json
 import bcrypt
-import os
 import datatier
+import applog
+import tracing
+import usercache
 
-from configparser import ConfigParser
-
+@tracing.traced("/login")
 def lambda_handler(event, context):
-    print("**Call to Lambda /login...")
-
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    applog.debug("**Call to Lambda /login...")
 
     try:
         # Parse incoming data from the event
@@ -29,28 +21,13 @@ def lambda_handler(event, context):
         username = data["username"]
         pwdhash = data["pwdhash"]   
 
-        #
-        # configure for RDS access
-        #
-        rds_endpoint = configur.get('rds', 'endpoint')
-        rds_portnum = int(configur.get('rds', 'port_number'))
-        rds_username = configur.get('rds', 'user_name')
-        rds_pwd = configur.get('rds', 'user_pwd')
-        rds_dbname = configur.get('rds', 'db_name')
-        
-        #
-        # open connection to the database:
-        #
-        print("**Opening connection**")
-    
-        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-
-       
         # 
-        # Check if the username already exists
+        # Look up the user and its password hash (cached in the
+        # container; otherwise read from a read replica)
         # 
-        sql1 = "SELECT * FROM users WHERE username = %s;"
-        check_user = datatier.retrieve_one_row(dbConn, sql1, [username])
+        applog.debug("**Looking up user**")
+
+        check_user = usercache.lookup(username, datatier.consistent_requested(event))
 
         # If the username doesn't exist, return a message and do nothing
         if not check_user:
@@ -63,10 +40,12 @@ def lambda_handler(event, context):
 
         # If the user exists, check the password
         else: 
-            sql2 = "SELECT pwdhash FROM users WHERE username = %s;"
-            real_pw = datatier.retrieve_one_row(dbConn, sql2, [username]) 
+            real_pw = check_user[1]
+
+            with tracing.span("bcrypt.check"):
+                valid = bcrypt.checkpw(pwdhash.encode('utf-8'), real_pw.encode('utf-8')) #checkpw() checks if the string matches its hashed form
 
-            if bcrypt.checkpw(pwdhash.encode('utf-8'), real_pw[0].encode('utf-8')): #checkpw() checks if the string matches its hashed form
+            if valid:
                 return {
                     "statusCode": 200,
                     "body": json.dumps({"message": "Login successful!"})
@@ -79,8 +58,7 @@ def lambda_handler(event, context):
                 }
 	
     except Exception as err:
-        print("**ERROR**")
-        print(str(err))
+        applog.error("**ERROR**", error=str(err))
         
         return {
         'statusCode': 500,
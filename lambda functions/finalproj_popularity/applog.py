@@ -0,0 +1,243 @@
+#
+# applog.py
+#
+# Leveled, sampled, redacted logging for the Reverb lambda functions.
+#
+# Every log line is one compact JSON object on stdout (which lambda
+# sends to CloudWatch). In steady state an invocation writes a
+# single line: the invocation record from tracing.py. Progress
+# messages are logged with applog.debug() / applog.info(), and are
+# only written when
+#
+#   - the message's level is at or above REVERB_LOG_LEVEL
+#     (default WARNING), or
+#   - the invocation is sampled: REVERB_LOG_SAMPLE gives a sampling
+#     rate per route, e.g. "default=0.01,/concerts=0.1", or
+#   - debugging was switched on for the request by sending the
+#     header X-Reverb-Debug with the value of REVERB_DEBUG_TOKEN.
+#
+# Otherwise debug / info messages are kept in a small buffer, and
+# only written if the invocation fails. All values are redacted
+# (passwords, tokens, keys, blurbs, ...) and truncated to
+# REVERB_LOG_MAX_CHARS before they are written.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory.
+#
+
+import json
+import os
+import random
+import re
+import sys
+import time
+
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+#
+# field names whose values are never logged:
+#
+SECRET_KEYS = re.compile(
+  r"(pass(word)?|pwd|pwdhash|secret|token|authorization|api_?key|consumer_key|"
+  r"^code$|plaintext|blurb|encryptionkey|ciphertext)", re.IGNORECASE)
+
+#
+# secrets embedded in free text (headers, URLs, error messages):
+#
+SECRET_PATTERNS = [
+  (re.compile(r"(Bearer|Basic)\s+[A-Za-z0-9._~+/=-]+"), r"\1 ***"),
+  (re.compile(r"((?:apikey|api_key|client_secret|access_token|refresh_token|code)=)[^&\s\"']+",
+              re.IGNORECASE), r"\1***"),
+  (re.compile(r"\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}"), "***"),  # bcrypt hashes
+]
+
+REDACTED = "***"
+BUFFER_SIZE = 50
+
+
+###################################################################
+#
+# settings, read once per container from the environment
+#
+def _level(name):
+  return LEVELS.get(os.environ.get(name, "").upper(), LEVELS["WARNING"])
+
+
+def _sample_rates(s):
+  rates = {}
+  for part in filter(None, (s or "").split(",")):
+    try:
+      (route, rate) = part.rsplit("=", 1)
+      rates[route.strip()] = float(rate)
+    except ValueError:
+      pass
+  return rates
+
+
+_min_level = _level("REVERB_LOG_LEVEL")
+_sample = _sample_rates(os.environ.get("REVERB_LOG_SAMPLE"))
+_debug_token = os.environ.get("REVERB_DEBUG_TOKEN") or None
+_max_chars = int(os.environ.get("REVERB_LOG_MAX_CHARS", "512"))
+
+
+#
+# per-invocation state:
+#
+_detailed = False   # write everything for this invocation?
+_request_id = None
+_buffer = []
+
+
+###################################################################
+#
+# redaction and truncation
+#
+def truncate(s, limit=None):
+  limit = _max_chars if limit is None else limit
+  if len(s) <= limit:
+    return s
+  return s[:limit] + "...(" + str(len(s) - limit) + " more)"
+
+
+def scrub(value, key=None, depth=0):
+  """
+  Returns a copy of value that is safe and cheap to log: secret
+  fields are replaced with ***, secrets in text are masked, long
+  strings are truncated and deep or long structures are cut short.
+  """
+  if key is not None and SECRET_KEYS.search(str(key)):
+    return REDACTED
+
+  if isinstance(value, (bytes, bytearray)):
+    return "<" + str(len(value)) + " bytes>"
+
+  if isinstance(value, str):
+    for (pattern, replacement) in SECRET_PATTERNS:
+      value = pattern.sub(replacement, value)
+    return truncate(value)
+
+  if value is None or isinstance(value, (bool, int, float)):
+    return value
+
+  if depth >= 4:
+    return truncate(str(value), 64)
+
+  if isinstance(value, dict):
+    items = list(value.items())
+    out = {str(k): scrub(v, k, depth + 1) for (k, v) in items[:20]}
+    if len(items) > 20:
+      out["..."] = str(len(items) - 20) + " more keys"
+    return out
+
+  if isinstance(value, (list, tuple, set)):
+    items = list(value)
+    out = [scrub(v, None, depth + 1) for v in items[:10]]
+    if len(items) > 10:
+      out.append("..." + str(len(items) - 10) + " more")
+    return out
+
+  return scrub(str(value), None, depth + 1)
+
+
+###################################################################
+#
+# writing
+#
+def _write(line):
+  sys.stdout.write(json.dumps(line, separators=(",", ":"), default=str) + "\n")
+
+
+def _flush():
+  for line in _buffer:
+    _write(line)
+  _buffer.clear()
+
+
+def log(level, msg, **fields):
+  """
+  Logs msg at the given level ("DEBUG", "INFO", "WARNING" or
+  "ERROR"), with optional extra fields.
+  """
+  line = {"level": level, "msg": scrub(msg)}
+  if _request_id is not None:
+    line["request_id"] = _request_id
+  for (k, v) in fields.items():
+    line[k] = scrub(v, k)
+
+  if _detailed or LEVELS[level] >= _min_level:
+    if level == "ERROR":
+      # an error: write the context leading up to it first
+      _flush()
+    _write(line)
+  else:
+    # kept in case the invocation fails:
+    line["t"] = round(time.time(), 3)
+    _buffer.append(line)
+    if len(_buffer) > BUFFER_SIZE:
+      del _buffer[0]
+
+
+def debug(msg, **fields):
+  log("DEBUG", msg, **fields)
+
+
+def info(msg, **fields):
+  log("INFO", msg, **fields)
+
+
+def warning(msg, **fields):
+  log("WARNING", msg, **fields)
+
+
+def error(msg, **fields):
+  log("ERROR", msg, **fields)
+
+
+###################################################################
+#
+# invocations (called by tracing.traced)
+#
+def _debug_requested(event):
+  if _debug_token is None or not isinstance(event, dict):
+    return False
+  headers = event.get("headers") or {}
+  for (k, v) in headers.items():
+    if k.lower() == "x-reverb-debug":
+      return v == _debug_token
+  return False
+
+
+def begin(route, event, request_id):
+  """
+  Starts an invocation: decides whether it is logged in detail.
+  """
+  global _detailed, _request_id
+
+  _request_id = request_id
+  _buffer.clear()
+
+  rate = _sample.get(route, _sample.get("default", 0.0))
+  _detailed = _debug_requested(event) or (rate > 0 and random.random() < rate)
+  return _detailed
+
+
+def detailed():
+  return _detailed
+
+
+def end(record, failed=False):
+  """
+  Ends an invocation by writing its record; if it failed, the
+  buffered debug messages are written first.
+  """
+  global _detailed, _request_id
+
+  if failed:
+    _flush()
+  _buffer.clear()
+
+  _write(record)
+
+  _detailed = False
+  _request_id = None
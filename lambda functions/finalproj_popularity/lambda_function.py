@@ -1,47 +1,239 @@
 #
-# Python program to retrieve most recent song of the day of user from database. It then searches
-# Spotify using the Spotify API and gets the popularity score of the song.
+# Python program to retrieve the popularity score on Spotify of a user's songs of the day.
+#
+# By default it reports the most recent entry. With ?from=YYYY-MM-DD&to=YYYY-MM-DD (either
+# may be left out) or ?entries=ID,ID,... it reports every entry in the range / list, with
+# aggregate stats (mean, min, max, and the trend in points per day), in one response.
+#
+# The track and its popularity are stored on each entry, so Spotify is only called when the
+# stored popularity is older than popularity_max_age seconds: stale tracks are fetched 50 at a
+# time by track id, and only entries whose song was never resolved are searched for -- at
+# most MAX_SEARCHES per request; the rest are handed to finalproj_resolve_track in the
+# background and reported without a popularity until it has found them.
 #
 
+import datetime
 import json
-import os
-import base64
 import datatier
-import urllib3
-import urllib
+import applog
+import metrics
+import runtime
+import spotify
+import tracing
+import usercache
+
+
+POPULARITY_MAX_AGE = 6 * 60 * 60   # seconds, unless set in [spotify]
+MAX_ENTRIES = 366                  # entries per request
+MAX_SEARCHES = 20                  # Spotify searches per request
+
+SELECT_ENTRIES = """
+  SELECT e.entryid, e.entrydate, t.name, a.name, e.spotify_trackid, e.spotify_song,
+         e.spotify_artist, e.popularity, e.popularity_at
+  FROM entries e
+    JOIN tracks t ON t.trackid = e.trackid
+    JOIN artists a ON a.artistid = t.artistid
+"""
+
+
+###################################################################
+#
+# selecting the entries
+#
+def parse_date(s):
+  """
+  Returns the YYYY-MM-DD string as a date, or raises ValueError.
+  """
+  if len(s) != 10 or s[4] != '-' or s[7] != '-':
+    raise ValueError("Invalid date. Use YYYY-MM-DD.")
+  return datetime.date.fromisoformat(s)
+
+
+def select_entries(dbConn, userid, query):
+  """
+  Returns (the user's entries asked for by the query string, True
+  if a range or list was asked for), oldest first.
+  """
+  if query.get("entries"):
+    try:
+      entryids = [int(x) for x in query["entries"].split(",") if x.strip()]
+    except ValueError:
+      raise ValueError("Invalid entries. Use a comma-separated list of entry ids.")
+    if not entryids:
+      raise ValueError("Invalid entries. Use a comma-separated list of entry ids.")
+    if len(entryids) > MAX_ENTRIES:
+      raise ValueError("At most " + str(MAX_ENTRIES) + " entries per request.")
+    sql = SELECT_ENTRIES + " WHERE e.userid = %s AND e.entryid IN (" \
+          + ", ".join(["%s"] * len(entryids)) + ") ORDER BY e.entrydate"
+    return (list(datatier.retrieve_all_rows(dbConn, sql, [userid] + entryids)), True)
+
+  if query.get("from") or query.get("to"):
+    where = "e.userid = %s"
+    parameters = [userid]
+    if query.get("from"):
+      where += " AND e.entrydate >= %s"
+      parameters.append(parse_date(query["from"]))
+    if query.get("to"):
+      where += " AND e.entrydate <= %s"
+      parameters.append(parse_date(query["to"]))
+    sql = SELECT_ENTRIES + " WHERE " + where + " ORDER BY e.entrydate LIMIT %s"
+    return (list(datatier.retrieve_all_rows(dbConn, sql, parameters + [MAX_ENTRIES])), True)
+
+  sql = SELECT_ENTRIES + """
+    WHERE e.userid = %s
+    ORDER BY e.entrydate DESC
+    LIMIT 1
+  """
+  row = datatier.retrieve_one_row(dbConn, sql, [userid])
+  return ([row] if row else [], False)
+
+
+###################################################################
+#
+# popularity of the entries
+#
+def resolve_later(entryids):
+  """
+  Starts finalproj_resolve_track for each entry, asynchronously
+  (if a resolver function is configured).
+  """
+  resolver = runtime.config().get('spotify', 'resolver_function', fallback=None)
+  if not resolver:
+    return
+
+  for entryid in entryids:
+    try:
+      with tracing.span("lambda.invoke"):
+        runtime.aws_client('lambda').invoke(FunctionName=resolver,
+                                            InvocationType='Event',
+                                            Payload=json.dumps({"entryid": entryid}))
+    except Exception as err:
+      applog.warning("could not start the track lookup", entryid=entryid, error=str(err))
+
 
-from configparser import ConfigParser
+def entry_popularity(rows, max_age, now):
+  """
+  Returns a dict per entry with its song on Spotify and popularity
+  (None if the song is not on Spotify, or not looked up yet), using
+  the stored values that are fresh and asking Spotify for the rest;
+  new values are stored on the entries.
+  """
+  results = []
+  stale = {}      # trackid => [result, ...]
+  unresolved = [] # results whose song was never found
 
+  for (entryid, entrydate, song, artist, trackid, song_name, artist_name, popularity, popularity_at) in rows:
+    result = {
+      'entryid': entryid,
+      'date': str(entrydate),
+      'song': song_name or song,
+      'artist': artist_name or artist,
+      'popularity': popularity,
+      'trackid': trackid,
+      '_search': (song, artist),
+    }
+    results.append(result)
+
+    if popularity is not None and popularity_at is not None and (now - popularity_at).total_seconds() < max_age:
+      metrics.cache("Popularity", True)
+      continue
+
+    metrics.cache("Popularity", False)
+    if trackid:
+      stale.setdefault(trackid, []).append(result)
+    else:
+      unresolved.append(result)
+
+  #
+  # stale tracks, by id, in batches:
+  #
+  trackids = list(stale)
+  tracks = {}
+  for i in range(0, len(trackids), spotify.MAX_IDS):
+    tracks.update(spotify.get_tracks(trackids[i:i + spotify.MAX_IDS]))
+
+  updated = []
+  for (trackid, waiting) in stale.items():
+    if trackid in tracks:
+      for result in waiting:
+        updated.append((result, tracks[trackid]))
+    else:  # no longer on Spotify under that id, search again
+      unresolved += waiting
+
+  #
+  # songs without a track id, one search each, up to MAX_SEARCHES;
+  # beyond that, entries never resolved are left to the resolver
+  # and the others to the next request:
+  #
+  for result in unresolved[:MAX_SEARCHES]:
+    track = spotify.search_track(*result['_search'])
+    if track is not None:
+      updated.append((result, track))
+    else:
+      result['popularity'] = None
+
+  deferred = unresolved[MAX_SEARCHES:]
+  for result in deferred:
+    result['popularity'] = None
+  if deferred:
+    metrics.count("SearchesDeferred", len(deferred))
+    resolve_later([r['entryid'] for r in deferred if not r['trackid']])
+
+  #
+  # store the new values:
+  #
+  if updated:
+    for (result, track) in updated:
+      result.update(song=track["name"], artist=track["artist"], popularity=track["popularity"], trackid=track["id"])
+
+    datatier.perform_bulk_action(datatier.connection(), """
+      UPDATE entries
+      SET spotify_trackid = %s, spotify_song = %s, spotify_artist = %s,
+          popularity = %s, popularity_at = %s
+      WHERE entryid = %s
+    """, [[t["id"], t["name"], t["artist"], t["popularity"], now, r["entryid"]] for (r, t) in updated])
+
+  for result in results:
+    del result['_search']
+  return results
+
+
+def summarize(results):
+  """
+  Returns aggregate stats of the entries' popularity: count, how
+  many were found on Spotify, mean, min, max, and the trend -- the
+  least-squares slope of popularity over time, in points per day.
+  """
+  points = [(datetime.date.fromisoformat(r['date']).toordinal(), r['popularity'])
+            for r in results if r['popularity'] is not None]
+  stats = {'count': len(results), 'found': len(points), 'mean': None, 'min': None, 'max': None, 'trend': None}
+  if not points:
+    return stats
+
+  values = [p for (d, p) in points]
+  stats.update(mean=round(sum(values) / len(values), 2), min=min(values), max=max(values))
+
+  if len(points) > 1:
+    mean_d = sum(d for (d, p) in points) / len(points)
+    mean_p = sum(values) / len(values)
+    var = sum((d - mean_d) ** 2 for (d, p) in points)
+    if var > 0:
+      stats['trend'] = round(sum((d - mean_d) * (p - mean_p) for (d, p) in points) / var, 3)
+  return stats
+
+
+@tracing.traced("/popularity/{username}")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: finalproj_popularity**")
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_popularity**")
 
     #
     # setup AWS based on config file:
     #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-    
-    #
-    # open connection to the database:
-    #
-    print("**Opening DB connection**")
+    with tracing.span("config"):
+      configur = runtime.config()
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-
     # 
     # Check if the username already exists
     # 
@@ -55,147 +247,85 @@ def lambda_handler(event, context):
     else:
         raise Exception("requires username parameter in event")
 
-    sql = "SELECT userid FROM users WHERE username = %s;"
-    userid = datatier.retrieve_one_row(dbConn, sql, [username])
+    consistent = datatier.consistent_requested(event)
+
+    with tracing.span("userid_lookup"):
+      userid = usercache.userid(username, consistent)
 
     # If the username doesn't exist, return a message and do nothing
-    if not userid:
+    if userid is None:
       return {
         "statusCode": 401,
         "body": json.dumps({
             "message": "Username does not exist.",
         })
       }
-    
-    #
-    # get most recent song from DB
-    #
-    print("**Get most recent DB entry**")
-    sql = """
-      SELECT songname, artist FROM entries 
-      WHERE userid = %s
-      ORDER BY entrydate DESC
-    """
-    
-    result = datatier.retrieve_one_row(dbConn, sql, [userid])
-    print(result)
-    song = result[0]
-    artist = result[1]
-    print(song)
-    print(artist)
-    print("**Most recent song received**")
 
     #
-    # get spotify api baseurl
+    # open (or reuse) a connection to the database; reads can
+    # use a read replica:
     #
-    spotifybaseurl = configur.get('spotify', 'webservice')
-
+    applog.debug("**Opening DB connection**")
+    
+    dbConn = datatier.reader(username, consistent)
+    
     #
-    # make sure baseurl does not end with /, if so remove:
+    # get the entries asked for (by default the most recent one) with
+    # what we know about their songs on Spotify (filled in by
+    # finalproj_resolve_track after each write, and by
+    # finalproj_refresh_popularity and earlier calls):
     #
-    lastchar = spotifybaseurl[len(spotifybaseurl) - 1]
-    if lastchar == "/":
-      spotifybaseurl = spotifybaseurl[:-1]
+    applog.debug("**Get DB entries**")
+    query = event.get("queryStringParameters") or {}
 
-    #
-    # Get Spotify authorization
-    #
-    print("**Getting Spotify authorization**")
-    http = urllib3.PoolManager()
-    client_id = configur.get('spotify', 'client_id')
-    client_secret = configur.get('spotify', 'client_secret')
-    auth_header = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-    url = 'https://accounts.spotify.com/api/token'
-    headers = {
-        'Authorization': f'Basic {auth_header}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    data = {
-        'grant_type': 'client_credentials'
-    }
-    data = urllib.parse.urlencode(data)
+    try:
+      (rows, several) = select_entries(dbConn, userid, query)
+    except ValueError as err:
+      return {
+        'statusCode': 400,
+        'body': json.dumps({"message": str(err)})
+      }
 
-    res = http.request('POST', url, headers=headers, body=data)
+    if not rows and not several:
+      return {
+        'statusCode': 404,
+        'body': json.dumps("You have not written any entries yet!")
+      }
 
-    if res.status == 200: #success
-      pass
-    else:
-      # failed:
-      print("Failed with status code:", res.status)
-      print("url: " + url)
-      if res.status == 500:
-        # we'll have an error message
-        body = json.loads(res.data.decode('utf-8'))
-        print("Error message:", body)
-      #
-      return
-
-    body = json.loads(res.data.decode('utf-8'))
-    access_token = body["access_token"]
-     
-    print("**Authorization successful**")
+    max_age = configur.getint('spotify', 'popularity_max_age', fallback=POPULARITY_MAX_AGE)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
 
-    #
-    # Search for track on Spotify and get id if it exists
-    #
-    print("**Searching for track**")
-    api = '/search?'
-    url = spotifybaseurl + api
-    header = {
-      "Authorization": "Bearer " + access_token
-    }
-    data = {
-      "q": "track%" + song + "artist%" + artist,
-      "type": "track"
-    }
-    data = urllib.parse.urlencode(data)
+    results = entry_popularity(rows, max_age, now)
 
-    res = http.request('GET', url + data, headers=header)
+    applog.debug("**COMPLETED**", entries=len(results))
 
-    if res.status == 200: #success
-      pass
-    else:
-      # failed:
-      print("Failed with status code:", res.status)
-      print("url: " + url)
-      if res.status == 500:
-        # we'll have an error message
-        body = json.loads(res.data.decode('utf-8'))
-        print("Error message:", body)
-      #
-      return
-    
-    body = json.loads(res.data.decode('utf-8'))
-    print("**Getting Popularity**") 
-    #
-    # check if results were found
-    #
+    if several:
+      return {
+        'statusCode': 200,
+        'body': json.dumps({
+          'entries': results,
+          'stats': summarize(results)
+        })
+      }
 
-    if "tracks" not in body or "items" not in body["tracks"] or len(body["tracks"]["items"]) <= 0:
+    result = results[0]
+    if result['popularity'] is None:
       return {
         'statusCode': 404,
         'body': json.dumps("Your most recent song of the day was not found on Spotify :(")
       }
-    else:  
-      popularity = body["tracks"]["items"][0]["popularity"]
-      song_name = body["tracks"]["items"][0]["name"]
-      artist_name = body["tracks"]["items"][0]["artists"][0]["name"]
 
-
-    print("**COMPLETED**")
-    
     return {
       'statusCode': 200,
       'body': json.dumps({
-        'song': song_name,
-        'artist': artist_name,
-        'popularity': popularity
+        'song': result['song'],
+        'artist': result['artist'],
+        'popularity': result['popularity']
       })
     }
 
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    applog.error("**ERROR**", error=str(err))
     
     return {
       'statusCode': 500,
@@ -0,0 +1,235 @@
+#
+# spotify.py
+#
+# Calls to the Spotify Web API with the app's own (client
+# credentials) token, for the functions that look up tracks.
+#
+# The access token is kept for the life of the container and only
+# requested again shortly before it expires (or if Spotify rejects
+# it), so a warm invocation makes a single API call.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import base64
+import datetime
+import email.utils
+import json
+import math
+import time
+import urllib.parse
+
+import applog
+import httppool
+import metrics
+import runtime
+import tracing
+
+
+TOKEN_URL = 'https://accounts.spotify.com/api/token'
+TOKEN_MARGIN = 60   # seconds before expiry to get a new token
+MAX_IDS = 50        # track ids per several-tracks call
+MAX_RETRY_AFTER = 5 # seconds we wait when rate limited
+DEFAULT_RETRY_AFTER = 1.0 # seconds, when Retry-After is missing or unreadable
+RETRY_MARGIN_MS = 1000    # time left for the retried call itself
+
+_token = None   # (access token, expires at on the monotonic clock)
+
+
+class SpotifyError(Exception):
+  """
+  A Spotify API call failed.
+  """
+
+  def __init__(self, status, url):
+    super().__init__("Spotify call failed with status code " + str(status))
+    self.status = status
+    self.url = url
+
+
+def _failed(res, url):
+  applog.warning("Failed with status code", status=res.status, url=url)
+  metrics.count("ExternalErrors")
+  if res.status == 500:
+    # we'll have an error message
+    applog.warning("Error message", body=res.data.decode('utf-8', 'replace'))
+  return SpotifyError(res.status, url)
+
+
+def baseurl():
+  """
+  Returns the Spotify API base URL from the config file, without
+  a trailing /.
+  """
+  return runtime.config().get('spotify', 'webservice').rstrip('/')
+
+
+def access_token():
+  """
+  Returns a client credentials access token, from the container's
+  cache when it is still valid.
+  """
+  global _token
+
+  if _token is not None and time.monotonic() < _token[1]:
+    metrics.cache("SpotifyToken", True)
+    return _token[0]
+
+  metrics.cache("SpotifyToken", False)
+
+  configur = runtime.config()
+  client_id = configur.get('spotify', 'client_id')
+  client_secret = configur.get('spotify', 'client_secret')
+  auth_header = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+  headers = {
+    'Authorization': f'Basic {auth_header}',
+    'Content-Type': 'application/x-www-form-urlencoded'
+  }
+  data = urllib.parse.urlencode({'grant_type': 'client_credentials'})
+  url = configur.get('spotify', 'token_url', fallback=TOKEN_URL)
+
+  with tracing.span("spotify.token"):
+    res = httppool.pool().request('POST', url, headers=headers, body=data)
+
+  if res.status != 200:
+    raise _failed(res, url)
+
+  body = json.loads(res.data.decode('utf-8'))
+  expires_in = body.get("expires_in", 3600)
+  _token = (body["access_token"], time.monotonic() + max(expires_in - TOKEN_MARGIN, 0))
+  return _token[0]
+
+
+def retry_after(res):
+  """
+  Returns the seconds a rate limited response asks us to wait: its
+  Retry-After as seconds or as an HTTP date, or DEFAULT_RETRY_AFTER
+  when it is missing or unreadable.
+  """
+  value = res.headers.get("Retry-After")
+  try:
+    seconds = float(value)
+  except (TypeError, ValueError):
+    try:
+      when = email.utils.parsedate_to_datetime(value)
+      if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+      seconds = (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    except (TypeError, ValueError, IndexError):
+      seconds = DEFAULT_RETRY_AFTER
+  if not math.isfinite(seconds):
+    seconds = DEFAULT_RETRY_AFTER
+  return max(seconds, 0.0)
+
+
+def get(api, span, missing_ok=False):
+  """
+  GETs an API path (e.g. /tracks/ID) and returns the parsed body,
+  or None if missing_ok and Spotify answers 404. A token Spotify
+  rejects is dropped and the call made once more, and so is a call
+  that is rate limited (after its Retry-After, if short enough and
+  the invocation has the time left).
+  """
+  global _token
+
+  url = baseurl() + api
+
+  for attempt in (1, 2):
+    header = {
+      "Authorization": "Bearer " + access_token()
+    }
+    with tracing.span(span):
+      res = httppool.pool().request('GET', url, headers=header)
+
+    if res.status == 401 and attempt == 1:
+      _token = None
+      continue
+    if res.status == 429 and attempt == 1:
+      metrics.count("SpotifyThrottles")
+      wait = retry_after(res)
+      remaining = tracing.remaining_ms()
+      if wait <= MAX_RETRY_AFTER and (remaining is None or wait * 1000 + RETRY_MARGIN_MS < remaining):
+        time.sleep(wait)
+        continue
+    break
+
+  if res.status == 404 and missing_ok:
+    return None
+  if res.status != 200:
+    raise _failed(res, url)
+
+  return json.loads(res.data.decode('utf-8'))
+
+
+def _track(item):
+  return {
+    "id": item["id"],
+    "name": item["name"],
+    "artist": item["artists"][0]["name"],
+    "artistid": item["artists"][0].get("id"),
+    "popularity": item["popularity"],
+  }
+
+
+def search_track(song, artist):
+  """
+  Searches Spotify for a song by an artist; returns the best match
+  as a dict with id, name, artist, artistid and popularity, or
+  None.
+  """
+  data = {
+    "q": "track%" + song + "artist%" + artist,
+    "type": "track"
+  }
+  body = get('/search?' + urllib.parse.urlencode(data), "spotify.search")
+
+  if "tracks" not in body or "items" not in body["tracks"] or len(body["tracks"]["items"]) <= 0:
+    return None
+  return _track(body["tracks"]["items"][0])
+
+
+def get_track(trackid):
+  """
+  Returns the track with the given Spotify id as a dict with id,
+  name, artist, artistid and popularity, or None if there is no
+  such track.
+  """
+  body = get('/tracks/' + urllib.parse.quote(trackid), "spotify.track", missing_ok=True)
+  return _track(body) if body else None
+
+
+def get_tracks(trackids):
+  """
+  Returns {trackid: track dict} for up to MAX_IDS track ids, with
+  one call to the several-tracks endpoint; ids Spotify does not
+  know are left out.
+  """
+  body = get(_tracks_api(trackids), "spotify.tracks")
+  return tracks_in(body)
+
+
+def _tracks_api(trackids):
+  if len(trackids) > MAX_IDS:
+    raise ValueError("at most " + str(MAX_IDS) + " track ids per call")
+  return '/tracks?' + urllib.parse.urlencode({"ids": ",".join(trackids)})
+
+
+def tracks_in(body):
+  """
+  Returns {trackid: track dict} for a several-tracks response body.
+  """
+  return {t["id"]: _track(t) for t in body.get("tracks", []) if t}
+
+
+def fetch_tracks(trackids, token):
+  """
+  Makes the several-tracks call for up to MAX_IDS ids with the given
+  token and returns (status, body or None). Unlike get_tracks it
+  only does the HTTP request -- no token refresh, retries, metrics
+  or spans -- so it can run on worker threads; the caller records
+  the results, and retries failed calls with get_tracks.
+  """
+  res = httppool.pool().request('GET', baseurl() + _tracks_api(trackids),
+                                headers={"Authorization": "Bearer " + token})
+  return (res.status, json.loads(res.data.decode('utf-8')) if res.status == 200 else None)
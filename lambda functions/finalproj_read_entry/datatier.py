@@ -8,7 +8,17 @@
 #   Northwestern University
 #
 
+import contextlib
+import json
+import os
+import re
+import time
+
 import pymysql
+import applog
+import metrics
+import runtime
+import tracing
 
 
 ###################################################################
@@ -36,20 +46,305 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
   a connection object
   """
   try:
-    dbConn = pymysql.connect(host=endpoint,
-                             port=portnum,
-                             user=username,
-                             passwd=pwd,
-                             database=dbname)
+    with tracing.span("db.connect"):
+      dbConn = pymysql.connect(host=endpoint,
+                               port=portnum,
+                               user=username,
+                               passwd=pwd,
+                               database=dbname)
 
     return dbConn
 
   except Exception as err:
-    print("datatier.get_dbConn() failed:")
-    print(str(err))
+    applog.error("datatier.get_dbConn() failed", error=str(err))
+    metrics.count("DBErrors")
     raise
 
 
+##################################################################
+#
+# connection:
+#
+# Returns this container's connection to the database, opening it
+# on first use and reusing it in later invocations.
+#
+_connections = {}
+
+def connection(section='rds'):
+  """
+  Returns an open connection to the database configured in the
+  given section of the config file. The connection is kept for the
+  life of the container: later calls check it is still alive and
+  reuse it, reconnecting if the server has dropped it.
+
+  The connection is in autocommit mode, so a query never runs in a
+  snapshot left open by an earlier invocation.
+
+  Parameters
+  ----------
+  section : config file section with endpoint, port_number,
+            user_name, user_pwd and db_name (string)
+
+  Returns
+  -------
+  a connection object
+  """
+  dbConn = _connections.get(section)
+
+  if dbConn is not None:
+    try:
+      with tracing.span("db.ping"):
+        dbConn.ping(reconnect=True)
+      metrics.cache("DBConnection", True)
+      return dbConn
+    except Exception as err:
+      applog.warning("datatier.connection() lost connection", error=str(err))
+      del _connections[section]
+
+  metrics.cache("DBConnection", False)
+
+  configur = runtime.config()
+  dbConn = get_dbConn(configur.get(section, 'endpoint'),
+                      int(configur.get(section, 'port_number')),
+                      configur.get(section, 'user_name'),
+                      configur.get(section, 'user_pwd'),
+                      configur.get(section, 'db_name'))
+  dbConn.autocommit(True)
+
+  _connections[section] = dbConn
+  return dbConn
+
+
+##################################################################
+#
+# reader / note_write:
+#
+# Read-only queries can go to a reader endpoint -- an RDS read
+# replica, or an Aurora cluster's reader endpoint -- configured in
+# the [rds-reader] section with the read-only account, so reads
+# scale out and off the primary ([rds], the writer).
+#
+# Replicas lag the primary, so a read that must see a write that
+# was just made (read-your-writes) goes to the writer instead:
+# when the caller asks for it (consistent_requested), or when the
+# key was written from this container within the last
+# read_your_writes_window seconds (note_write).
+#
+READER_SECTION = 'rds-reader'
+CONSISTENT_HEADER = 'x-reverb-consistent'
+
+_recent_writes = {}
+
+def note_write(key):
+  """
+  Records that the data of key (e.g. a username) was just
+  written, so reader(key) uses the writer for a while.
+
+  Parameters
+  ----------
+  key : what was written (string)
+
+  Returns
+  -------
+  nothing
+  """
+  now = time.monotonic()
+  _recent_writes[key] = now
+
+  if len(_recent_writes) > 1000:
+    window = runtime.config().getfloat(READER_SECTION, 'read_your_writes_window', fallback=5.0)
+    for (k, t) in list(_recent_writes.items()):
+      if now - t >= window:
+        del _recent_writes[k]
+
+
+def consistent_requested(event):
+  """
+  Returns True if the request asks to read its own writes, with
+  the header X-Reverb-Consistent: 1 (sent by the client shortly
+  after it writes).
+
+  Parameters
+  ----------
+  event : the lambda event (dict)
+
+  Returns
+  -------
+  True or False
+  """
+  headers = event.get("headers") or {}
+  for (k, v) in headers.items():
+    if k.lower() == CONSISTENT_HEADER:
+      return v not in ("", "0", "false")
+  return False
+
+
+def reader(key=None, consistent=False):
+  """
+  Returns a connection for read-only queries: the reader
+  connection ([rds-reader]), or the writer connection ([rds]) if
+  there is no reader configured, the reader cannot be reached, or
+  the read must see recent writes.
+
+  Parameters
+  ----------
+  key : what is being read, checked against note_write (string),
+  consistent : True to always read from the writer
+
+  Returns
+  -------
+  a connection object
+  """
+  configur = runtime.config()
+
+  if not configur.has_section(READER_SECTION):
+    return connection()
+
+  written = _recent_writes.get(key)
+  window = configur.getfloat(READER_SECTION, 'read_your_writes_window', fallback=5.0)
+
+  if consistent or (written is not None and time.monotonic() - written < window):
+    metrics.count("DBConsistentReads")
+    return connection()
+
+  try:
+    return connection(READER_SECTION)
+  except Exception as err:
+    applog.warning("datatier.reader() falling back to the writer", error=str(err))
+    return connection()
+
+
+##################################################################
+#
+# query instrumentation:
+#
+# Every query run through datatier is timed and counted, per
+# invocation, under its fingerprint: the statement with literals
+# and parameters replaced by ? and whitespace collapsed, so the
+# same query with different values is counted together.
+#
+#   - each query counts in the DBQueries metric;
+#   - a fingerprint run REVERB_N_PLUS_ONE times (default 5) in one
+#     invocation is logged as a likely N+1 pattern (a query in a
+#     loop that should be one query), and counted in DBNPlusOne;
+#   - a query slower than REVERB_SLOW_QUERY_MS (default 100) is
+#     logged with its EXPLAIN plan, and counted in DBSlowQueries.
+#
+# The invocation's log record gets "db": {"queries", "ms"}, plus
+# the per-fingerprint breakdown when it is logged in detail. If
+# REVERB_QUERY_LOG names a file, the breakdown of every invocation
+# is appended to it as a JSON line, for tools/benchmark.py queries.
+#
+SLOW_QUERY_MS = float(os.environ.get("REVERB_SLOW_QUERY_MS", "100"))
+N_PLUS_ONE = int(os.environ.get("REVERB_N_PLUS_ONE", "5"))
+EXPLAIN_MAX_ROWS = 10
+
+FINGERPRINT_RULES = [
+  (re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL), " "),   # comments
+  (re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""), "?"),   # strings
+  (re.compile(r"\b\d+(?:\.\d+)?\b|%s"), "?"),   # numbers, parameters
+  (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?+)"),   # IN / VALUES lists
+  (re.compile(r"\s+"), " "),
+]
+EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+_queries = {}  # fingerprint => [count, total ms, max ms, rows]
+
+
+def fingerprint(sql):
+  """
+  Returns the normalized form of an SQL statement.
+  """
+  for (pattern, replacement) in FINGERPRINT_RULES:
+    sql = pattern.sub(replacement, sql)
+  return sql.strip().rstrip(";").strip()
+
+
+def explain(dbConn, sql, parameters=[]):
+  """
+  Returns the EXPLAIN plan of a query as a list of rows (lists of
+  strings, the first being the column names), or an error string.
+  """
+  if not EXPLAINABLE.match(sql):
+    return None
+
+  dbCursor = dbConn.cursor()
+  try:
+    dbCursor.execute("EXPLAIN " + sql.strip(), parameters)
+    plan = [[d[0] for d in dbCursor.description or ()]]
+    plan += [[str(v) for v in row] for row in dbCursor.fetchmany(EXPLAIN_MAX_ROWS)]
+    return plan
+  except Exception as err:
+    return "EXPLAIN failed: " + str(err)
+  finally:
+    dbCursor.close()
+
+
+def _since(start):
+  return (time.perf_counter() - start) * 1000
+
+
+def instrument(dbConn, sql, parameters, ms, rows):
+  """
+  Records one execution of a query that took ms milliseconds and
+  retrieved / modified rows rows.
+  """
+  fp = fingerprint(sql)
+  q = _queries.setdefault(fp, [0, 0.0, 0.0, 0])
+  q[0] += 1
+  q[1] += ms
+  q[2] = max(q[2], ms)
+  q[3] += max(rows, 0)
+
+  metrics.count("DBQueries")
+
+  if q[0] == N_PLUS_ONE:
+    metrics.count("DBNPlusOne")
+    applog.warning("datatier: possible N+1 query", fingerprint=fp, count=q[0])
+
+  if ms >= SLOW_QUERY_MS:
+    metrics.count("DBSlowQueries")
+    applog.warning("datatier: slow query", fingerprint=fp, ms=round(ms, 2), rows=rows,
+                   explain=explain(dbConn, sql, parameters))
+
+
+def query_report():
+  """
+  Returns this invocation's queries, slowest (in total) first.
+  """
+  report = [
+    {"fingerprint": fp, "count": count, "ms": round(total, 2), "max_ms": round(slowest, 2), "rows": rows}
+    for (fp, (count, total, slowest, rows)) in _queries.items()
+  ]
+  report.sort(key=lambda q: -q["ms"])
+  return report
+
+
+def _on_finish(record):
+  if not _queries:
+    return
+
+  report = query_report()
+  _queries.clear()
+
+  record["db"] = {
+    "queries": sum(q["count"] for q in report),
+    "ms": round(sum(q["ms"] for q in report), 2),
+  }
+  if "spans" in record:  # logged in detail
+    record["db"]["by_query"] = report
+
+  path = os.environ.get("REVERB_QUERY_LOG")
+  if path:
+    line = {"route": record.get("route"), "request_id": record.get("request_id"), "queries": report}
+    with open(path, "a") as f:
+      f.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+
+metrics.install()
+tracing.on_finish(_on_finish)
+
+
 ##################################################################
 #
 # retrieve_one_row:
@@ -80,16 +375,19 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
   dbCursor = dbConn.cursor()
 
   try:
-    dbCursor.execute(sql, parameters)
-    row = dbCursor.fetchone()
+    start = time.perf_counter()
+    with tracing.span("db.query"):
+      dbCursor.execute(sql, parameters)
+      row = dbCursor.fetchone()
+    instrument(dbConn, sql, parameters, _since(start), 0 if row is None else 1)
     if row is None:  # executed successfully, but no data was retrieved
       return ()
     else:
       return row
 
   except Exception as err:
-    print("datatier.retrieve_one_row() failed:")
-    print(str(err))
+    applog.error("datatier.retrieve_one_row() failed", error=str(err))
+    metrics.count("DBErrors")
     raise
 
   finally:
@@ -127,20 +425,102 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
   dbCursor = dbConn.cursor()
 
   try:
-    dbCursor.execute(sql, parameters)
-    rows = dbCursor.fetchall()
+    start = time.perf_counter()
+    with tracing.span("db.query"):
+      dbCursor.execute(sql, parameters)
+      rows = dbCursor.fetchall()
+    instrument(dbConn, sql, parameters, _since(start), len(rows or ()))
     if rows is None:  # executed successfully, but no data was retrieved
       return []
     else:
       return rows
 
   except Exception as err:
-    print("datatier.retrieve_all_rows() failed:")
-    print(str(err))
+    applog.error("datatier.retrieve_all_rows() failed", error=str(err))
+    metrics.count("DBErrors")
+    raise
+
+  finally:
+    dbCursor.close()
+
+
+##################################################################
+#
+# stream_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and yields the
+# rows (tuples) as they arrive from the server -- one at a
+# time, or in lists of batch_size rows. Unlike
+# retrieve_all_rows, the result is never held in memory as a
+# whole, so memory stays flat however many rows the query
+# retrieves (exports, reports, a user's whole history).
+#
+STREAM_FETCH_SIZE = 500
+
+def stream_rows(dbConn, sql, parameters=[], batch_size=None):
+  """
+  Executes an sql SELECT query against the database connection
+  with an unbuffered (server-side) cursor and yields the rows
+  lazily
+
+  Until the generator is exhausted or closed, the connection is
+  busy with the result and cannot run other queries; use another
+  connection (e.g. datatier.reader() for the stream and
+  datatier.connection() for the rest) if you need to query while
+  streaming. Stopping early (break, or closing the generator)
+  closes the cursor, which discards the rest of the result.
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  batch_size: optional, yield lists of up to this many rows
+    instead of single rows
+
+  Returns
+  _______
+  a generator of rows (tuples), or of lists of rows
+  """
+
+  dbCursor = dbConn.cursor(pymysql.cursors.SSCursor)
+  rows = 0
+  ms = None  # time in the database, not in the caller's loop
+
+  try:
+    start = time.perf_counter()
+    with tracing.span("db.query"):
+      dbCursor.execute(sql, parameters)
+    ms = _since(start)
+
+    while True:
+      start = time.perf_counter()
+      with tracing.span("db.fetch"):
+        batch = dbCursor.fetchmany(batch_size or STREAM_FETCH_SIZE)
+      ms += _since(start)
+      if not batch:  # no more rows
+        break
+
+      rows += len(batch)
+      if batch_size:
+        yield list(batch)
+      else:
+        yield from batch
+
+  except GeneratorExit:
+    raise
+
+  except Exception as err:
+    applog.error("datatier.stream_rows() failed", error=str(err))
+    metrics.count("DBErrors")
     raise
 
   finally:
+    metrics.count("DBRowsStreamed", rows)
     dbCursor.close()
+    if ms is not None:
+      instrument(dbConn, sql, parameters, ms, rows)
 
 
 ###############################################################
@@ -173,19 +553,147 @@ def perform_action(dbConn, sql, parameters=[]):
   """
 
   dbCursor = dbConn.cursor()
+  joined = in_transaction(dbConn)
 
   try:
     # try to execute, and if successful commit the changes
-    # and return the # of rows modified by the query:
-    dbCursor.execute(sql, parameters)
-    dbConn.commit()
+    # (unless a transaction commits them later) and return
+    # the # of rows modified by the query:
+    start = time.perf_counter()
+    with tracing.span("db.action"):
+      dbCursor.execute(sql, parameters)
+      if not joined:
+        dbConn.commit()
+    instrument(dbConn, sql, parameters, _since(start), dbCursor.rowcount)
     return dbCursor.rowcount
 
   except Exception as err:
-    # failed, rollback any possible changes and log error:
+    # failed, rollback any possible changes (or leave that to
+    # the transaction) and log error:
+    if not joined:
+      dbConn.rollback()
+    applog.error("datatier.perform_action() failed", error=str(err))
+    metrics.count("DBErrors")
+    raise
+
+  finally:
+    dbCursor.close()
+
+
+###############################################################
+#
+# transaction:
+#
+# Groups several action queries into one transaction: they are
+# committed together when the with block ends, or rolled back
+# together if it raises. perform_action and perform_bulk_action
+# called inside the block join the transaction instead of
+# committing on their own, and so does a nested transaction()
+# on the same connection.
+#
+#   with datatier.transaction(dbConn):
+#     datatier.perform_action(dbConn, sql1, [...])
+#     datatier.perform_bulk_action(dbConn, sql2, rows)
+#
+_transactions = set()
+
+def in_transaction(dbConn):
+  """
+  Returns True if dbConn is inside a transaction() block.
+  """
+  return id(dbConn) in _transactions
+
+
+@contextlib.contextmanager
+def transaction(dbConn):
+  """
+  Context manager that runs the block in one transaction on the
+  database connection, committing at the end or rolling back on
+  error
+
+  Parameters
+  __________
+  dbConn : the database connection
+
+  Returns
+  _______
+  the connection, for use in the with block
+  """
+
+  if in_transaction(dbConn):  # nested: part of the outer transaction
+    yield dbConn
+    return
+
+  with tracing.span("db.begin"):
+    dbConn.begin()
+  _transactions.add(id(dbConn))
+
+  try:
+    yield dbConn
+    with tracing.span("db.commit"):
+      dbConn.commit()
+
+  except BaseException as err:
     dbConn.rollback()
-    print("datatier.perform_action() failed:")
-    print(str(err))
+    applog.warning("datatier.transaction() rolled back", error=str(err))
+    raise
+
+  finally:
+    _transactions.discard(id(dbConn))
+
+
+###############################################################
+#
+# perform_bulk_action:
+#
+# Given a database connection, an SQL action query and a list
+# of parameter lists, executes the query once per parameter
+# list with executemany -- which sends an INSERT ... VALUES as
+# multi-row INSERTs -- in chunks of chunk_size rows, all in one
+# transaction. Returns the total number of rows modified.
+#
+BULK_CHUNK_SIZE = 500
+
+def perform_bulk_action(dbConn, sql, rows, chunk_size=BULK_CHUNK_SIZE):
+  """
+  Executes an sql ACTION query against the database connection
+  for each parameter list in rows, in chunks, in one transaction,
+  and returns the number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL action query (parameterized with %s),
+  rows: list of parameter lists, one per execution,
+  chunk_size: optional, # of parameter lists per round trip
+
+  Returns
+  _______
+  total number of rows modified; if anything fails, nothing
+  is modified
+  """
+
+  rows = list(rows)
+  modified = 0
+
+  if not rows:
+    return 0
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    start = time.perf_counter()
+    with transaction(dbConn):
+      for i in range(0, len(rows), chunk_size):
+        with tracing.span("db.bulk_action"):
+          dbCursor.executemany(sql, rows[i:i + chunk_size])
+        modified += dbCursor.rowcount
+    instrument(dbConn, sql, rows[0], _since(start), modified)
+    return modified
+
+  except Exception as err:
+    applog.error("datatier.perform_bulk_action() failed", error=str(err), rows=len(rows))
+    metrics.count("DBErrors")
     raise
 
   finally:
@@ -6,47 +6,23 @@
 #
 
 import json
-import boto3
-from base64 import b64encode
-import os
 import datatier
+import applog
+import metrics
+import runtime
+import tracing
+import usercache
 
-from configparser import ConfigParser
-
+@tracing.traced("/read/{username}/{date}")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: finalproj_read_entry**")
-    
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-
-    #
-    # open connection to the database:
-    #
-    print("**Opening connection**")
-    
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_read_entry**")
     
     #
     # check path parameters
     #
-    print("**Accessing Parameters**")
+    applog.debug("**Accessing Parameters**")
     
     if "username" in event:
       username = event["username"]
@@ -78,21 +54,32 @@ def lambda_handler(event, context):
         "body": json.dumps("Invalid date. Use YYYY-MM-DD.")
       }
 
+    consistent = datatier.consistent_requested(event)
+
     #
-    # now retrieve all the users:
+    # now retrieve the user (usually cached in the container):
     #
-    print("**Retrieving entry**")
+    applog.debug("**Retrieving entry**", username=username, date=date)
 
+    with tracing.span("userid_lookup"):
+      userid = usercache.userid(username, consistent)
+    if userid is None:
+      raise Exception("no such user")
 
-    sql1 = '''
-      SELECT userid FROM users 
-      WHERE username = %s;
-    '''
-    userid = datatier.retrieve_one_row(dbConn, sql1, [username])[0]
+    #
+    # open (or reuse) a connection to the database; reads can
+    # use a read replica:
+    #
+    applog.debug("**Opening connection**")
+    
+    dbConn = datatier.reader(username, consistent)
 
     sql2 = '''
-      SELECT * FROM entries 
-      WHERE userid = %s AND entrydate = %s;
+      SELECT e.entryid, e.entrydate, t.name, a.name, e.blurb
+      FROM entries e
+        JOIN tracks t ON t.trackid = e.trackid
+        JOIN artists a ON a.artistid = t.artistid
+      WHERE e.userid = %s AND e.entrydate = %s;
     '''
     
     row = datatier.retrieve_one_row(dbConn, sql2, [userid, date])
@@ -106,36 +93,28 @@ def lambda_handler(event, context):
     
 
     else: 
-      print("**Entry Found**")
+      applog.debug("**Entry Found**", entryid=row[0])
       #
       # Decryption
       # 
-      blurb_encrypted = row[5]
-      key_encrypted = row[6]
-      # print("blurb", blurb_encrypted)
-      # print("key", key_encrypted)
-      # print(len(key_encrypted))
-      # print(len(blurb_encrypted))
-
-      # decrypt key that is unique to each entry
-      kms_client = boto3.client('kms')
-      key_response = kms_client.decrypt(
-        CiphertextBlob=key_encrypted,
-      )
-      key_decrypted = key_response['Plaintext']
-      print(key_decrypted)
+      blurb_encrypted = row[4]
 
-      # decrypt blurb with decrypted key
-      blurb_decrypted = kms_client.decrypt(
-        CiphertextBlob=blurb_encrypted    
-      )['Plaintext'].decode('utf-8')
+      # the blurb was encrypted with the KMS key itself, so one
+      # decrypt call gets it back (the entry's data key is not needed)
+      with tracing.span("kms.client"):
+        kms_client = runtime.aws_client('kms')
+      metrics.count("KMSCalls")
+      with tracing.span("kms.decrypt"):
+        blurb_decrypted = kms_client.decrypt(
+          CiphertextBlob=blurb_encrypted    
+        )['Plaintext'].decode('utf-8')
       
       entry = {
         'entryid': row[0],
         'username': username, 
-        'entrydate': str(row[2]),
-        'songname': row[3],
-        'artist': row[4],
+        'entrydate': str(row[1]),
+        'songname': row[2],
+        'artist': row[3],
         'blurb': blurb_decrypted
       }
     
@@ -145,8 +124,7 @@ def lambda_handler(event, context):
       }
     
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    applog.error("**ERROR**", error=str(err))
     
     return {
       'statusCode': 500,
@@ -0,0 +1,53 @@
+#
+# rebuild_stats()
+#
+# Recomputes the users' journal statistics (see userstats.py) from their entries: run it once
+# after migrations/007-user-stats.sql, and whenever the entries were changed other than through
+# /write. With {"username": ...} in the event only that user is rebuilt, otherwise every user,
+# each in its own short transaction so /write is only held up for one user at a time.
+#
+
+import json
+import datatier
+import applog
+import metrics
+import tracing
+import userstats
+
+
+@tracing.traced("rebuild_stats")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_rebuild_stats**")
+
+    dbConn = datatier.connection()
+
+    if event and event.get("username"):
+      row = datatier.retrieve_one_row(dbConn, "SELECT userid FROM users WHERE username = %s", [event["username"]])
+      if not row:
+        raise Exception("no such user")
+      userids = [row[0]]
+    else:
+      userids = [userid for (userid,) in datatier.retrieve_all_rows(dbConn, "SELECT userid FROM users ORDER BY userid")]
+
+    entries = 0
+    for userid in userids:
+      entries += userstats.rebuild_user(dbConn, userid)
+
+    metrics.count("StatsRebuilt", len(userids))
+
+    applog.info("**DONE**", users=len(userids), entries=entries)
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"users": len(userids), "entries": entries})
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -0,0 +1,86 @@
+#
+# recommendations()
+#
+# Recommends songs based on the user's recent entries: GET /recommendations/{username}
+# returns the tracks most similar to what they picked lately (see recommend.py), best first.
+# The recommendations are precomputed -- by finalproj_build_recommendations, and for the
+# writer on each /write -- so this is a single indexed read of at most RECOMMENDATIONS rows.
+#
+
+import json
+import datatier
+import applog
+import recommend
+import tracing
+import usercache
+
+
+@tracing.traced("/recommendations/{username}")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_recommendations**")
+
+    if "username" in event:
+      username = event["username"]
+    elif "pathParameters" in event:
+      if "username" in event["pathParameters"]:
+        username = event["pathParameters"]["username"]
+      else:
+        raise Exception("requires username parameter in pathParameters")
+    else:
+        raise Exception("requires username parameter in event")
+
+    query = event.get("queryStringParameters") or {}
+    try:
+      limit = min(max(int(query.get("limit") or recommend.RECOMMENDATIONS), 1), recommend.RECOMMENDATIONS)
+    except ValueError:
+      return {
+        "statusCode": 400,
+        "body": json.dumps({"message": "Invalid limit."})
+      }
+
+    consistent = datatier.consistent_requested(event)
+
+    with tracing.span("userid_lookup"):
+      userid = usercache.userid(username, consistent)
+    if userid is None:
+      return {
+        "statusCode": 401,
+        "body": json.dumps({"message": "Username does not exist."})
+      }
+
+    #
+    # reads can use a read replica (a request right after /write
+    # asks for a consistent read, and sees the updated ones):
+    #
+    dbConn = datatier.reader(username, consistent)
+
+    sql = """
+      SELECT t.name, a.name, t.spotify_trackid, r.score
+      FROM recommendations r
+        JOIN tracks t ON t.trackid = r.trackid
+        JOIN artists a ON a.artistid = t.artistid
+      WHERE r.userid = %s
+      ORDER BY r.score DESC, r.trackid
+      LIMIT %s
+    """
+    rows = datatier.retrieve_all_rows(dbConn, sql, [userid, limit])
+
+    recommendations = [{'song': song, 'artist': artist, 'spotify_trackid': spotify_trackid, 'score': round(score, 4)}
+                       for (song, artist, spotify_trackid, score) in rows]
+
+    applog.debug("**DONE**", recommendations=len(recommendations))
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({'recommendations': recommendations})
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
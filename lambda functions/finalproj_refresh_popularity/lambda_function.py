@@ -0,0 +1,123 @@
+#
+# refresh_popularity()
+#
+# Runs on a schedule (an EventBridge rule, e.g. rate(1 hour)) to keep the popularity stored on
+# entries fresh: collects the Spotify tracks whose popularity is older than popularity_max_age,
+# fetches them 50 at a time from Spotify's several-tracks endpoint with a few calls in flight,
+# and stores the new values on the entries and in the track_popularity time series -- a few
+# dozen API calls for thousands of entries, instead of one /popularity search per entry.
+#
+
+import datetime
+import json
+from concurrent.futures import ThreadPoolExecutor
+import datatier
+import applog
+import httppool
+import metrics
+import runtime
+import spotify
+import tracing
+
+
+POPULARITY_MAX_AGE = 6 * 60 * 60   # seconds, unless set in [spotify]
+MAX_TRACKS = 5000                  # tracks per run, unless set in [spotify]
+CONCURRENCY = 4                    # Spotify calls in flight, unless set in [spotify]
+WRITE_CHUNK = 100                  # tracks written back per transaction
+
+@tracing.traced("refresh_popularity")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_refresh_popularity**")
+
+    configur = runtime.config()
+    max_age = configur.getint('spotify', 'popularity_max_age', fallback=POPULARITY_MAX_AGE)
+    max_tracks = configur.getint('spotify', 'refresh_max_tracks', fallback=MAX_TRACKS)
+    concurrency = configur.getint('spotify', 'refresh_concurrency', fallback=CONCURRENCY)
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    stale_before = now - datetime.timedelta(seconds=max_age)
+
+    #
+    # collect the stale tracks, least recently refreshed first:
+    #
+    sql = """
+      SELECT spotify_trackid, MIN(popularity_at)
+      FROM entries
+      WHERE spotify_trackid IS NOT NULL
+      GROUP BY spotify_trackid
+      HAVING MIN(popularity_at) IS NULL OR MIN(popularity_at) < %s
+      ORDER BY MIN(popularity_at)
+      LIMIT %s
+    """
+    trackids = [row[0] for row in datatier.stream_rows(datatier.reader(), sql, [stale_before, max_tracks])]
+    applog.info("stale tracks", count=len(trackids))
+
+    if not trackids:
+      return {
+        'statusCode': 200,
+        'body': json.dumps({"stale": 0, "refreshed": 0})
+      }
+
+    #
+    # fetch them in batches, a few batches at a time. The worker
+    # threads only make the HTTP calls, with the token fetched here
+    # and a connection each; the results, metrics and any retries
+    # (a rejected token, rate limiting) are handled on this thread:
+    #
+    batches = [trackids[i:i + spotify.MAX_IDS] for i in range(0, len(trackids), spotify.MAX_IDS)]
+    token = spotify.access_token()
+    httppool.pool(maxsize=concurrency)
+
+    with tracing.span("spotify.tracks.concurrent"), ThreadPoolExecutor(max_workers=concurrency) as pool:
+      responses = list(pool.map(lambda batch: spotify.fetch_tracks(batch, token), batches))
+
+    tracks = {}
+    for (batch, (status, body)) in zip(batches, responses):
+      if status == 200:
+        tracks.update(spotify.tracks_in(body))
+      else:
+        tracks.update(spotify.get_tracks(batch))
+
+    metrics.count("TracksRefreshed", len(tracks))
+    metrics.count("TracksMissing", len(trackids) - len(tracks))
+
+    #
+    # store the new values, on the entries and in the time series,
+    # WRITE_CHUNK tracks per transaction so /write is never held up
+    # for long (the updates use the (spotify_trackid, popularity_at)
+    # index). Tracks Spotify no longer returns (removed, or not
+    # available in the market) are stamped too, with no popularity,
+    # so they wait their turn instead of being first in every run
+    # (/popularity searches for those entries' songs again):
+    #
+    dbConn = datatier.connection()
+    for i in range(0, len(trackids), WRITE_CHUNK):
+      chunk = [tracks.get(trackid) or {"id": trackid, "popularity": None}
+               for trackid in trackids[i:i + WRITE_CHUNK]]
+      with datatier.transaction(dbConn):
+        datatier.perform_bulk_action(dbConn, """
+          UPDATE entries SET popularity = %s, popularity_at = %s
+          WHERE spotify_trackid = %s
+        """, [[t["popularity"], now, t["id"]] for t in chunk])
+
+        datatier.perform_bulk_action(dbConn, """
+          INSERT INTO track_popularity(trackid, fetched_at, popularity)
+                      VALUES(%s, %s, %s)
+        """, [[t["id"], now, t["popularity"]] for t in chunk if t["popularity"] is not None])
+
+    applog.info("**DONE**", stale=len(trackids), refreshed=len(tracks), calls=len(batches))
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"stale": len(trackids), "refreshed": len(tracks), "calls": len(batches)})
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+    
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
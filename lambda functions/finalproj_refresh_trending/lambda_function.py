@@ -0,0 +1,69 @@
+#
+# refresh_trending()
+#
+# Runs on a schedule (an EventBridge rule, e.g. rate(1 day)) to delete the trending counts
+# (see trending.py) of the days that left the window. With {"rebuild": true} in the event it
+# recounts the window from the entries instead, e.g. after they were changed other than through
+# /write. A rebuild reads the window's entries, so run it at a quiet time.
+#
+
+import datetime
+import json
+import datatier
+import applog
+import metrics
+import tracing
+import trending
+
+
+@tracing.traced("refresh_trending")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_refresh_trending**")
+
+    rebuild = bool(event and event.get("rebuild"))
+    today = trending.today()
+    first_day = today - datetime.timedelta(days=trending.WINDOW_DAYS - 1)
+
+    dbConn = datatier.connection()
+
+    with datatier.transaction(dbConn):
+      deleted = 0
+      for (table, column) in trending.TABLES:
+        if rebuild:
+          deleted += datatier.perform_action(dbConn, "DELETE FROM " + table)
+        else:
+          deleted += datatier.perform_action(dbConn, "DELETE FROM " + table + " WHERE entrydate < %s", [first_day])
+
+      counted = 0
+      if rebuild:
+        counted += datatier.perform_action(dbConn, """
+          INSERT INTO trending_tracks(entrydate, trackid, entries)
+            SELECT entrydate, trackid, COUNT(*) FROM entries
+            WHERE entrydate >= %s AND entrydate <= %s
+            GROUP BY entrydate, trackid
+        """, [first_day, today])
+        counted += datatier.perform_action(dbConn, """
+          INSERT INTO trending_artists(entrydate, artistid, entries)
+            SELECT e.entrydate, t.artistid, COUNT(*) FROM entries e JOIN tracks t ON t.trackid = e.trackid
+            WHERE e.entrydate >= %s AND e.entrydate <= %s
+            GROUP BY e.entrydate, t.artistid
+        """, [first_day, today])
+
+    metrics.count("TrendingRowsDeleted", deleted)
+
+    applog.info("**DONE**", rebuild=rebuild, deleted=deleted, counted=counted)
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"rebuild": rebuild, "deleted": deleted, "counted": counted})
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
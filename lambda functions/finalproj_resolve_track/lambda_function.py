@@ -0,0 +1,100 @@
+#
+# resolve_track()
+#
+# Invoked asynchronously (InvocationType=Event) by finalproj_write_entry after a journal entry
+# is written: searches Spotify for the entry's song and stores the track id, its canonical
+# name and artist, and its popularity on the entry, so /popularity can answer from the
+# database. Not called through API Gateway; the event is {"entryid": ...}.
+#
+# The Spotify ids are also stored on the song's catalog rows (tracks and artists), so the
+# next entry of a song already in the catalog is looked up by id instead of searched for.
+#
+
+import datetime
+import json
+import datatier
+import applog
+import spotify
+import tracing
+
+@tracing.traced("resolve_track")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_resolve_track**")
+
+    entryid = event["entryid"]
+
+    #
+    # the entry was just written, so read it from the writer:
+    #
+    dbConn = datatier.connection()
+
+    sql = """
+      SELECT t.name, a.name, e.spotify_trackid, t.trackid, t.spotify_trackid, a.artistid
+      FROM entries e
+        JOIN tracks t ON t.trackid = e.trackid
+        JOIN artists a ON a.artistid = t.artistid
+      WHERE e.entryid = %s;
+    """
+    row = datatier.retrieve_one_row(dbConn, sql, [entryid])
+
+    if not row:
+      applog.warning("no such entry", entryid=entryid)
+      return {
+        'statusCode': 404,
+        'body': json.dumps("no such entry")
+      }
+
+    (song, artist, trackid, catalog_trackid, catalog_spotify_id, artistid) = row
+    if trackid:  # already resolved (e.g. by /popularity, or a retried event)
+      return {
+        'statusCode': 200,
+        'body': json.dumps({"entryid": entryid, "trackid": trackid})
+      }
+
+    #
+    # look the song up on Spotify (by id when the catalog knows it)
+    # and store what we found:
+    #
+    track = spotify.get_track(catalog_spotify_id) if catalog_spotify_id else None
+    if track is None:
+      track = spotify.search_track(song, artist)
+    if track is None:
+      applog.info("track not found on Spotify", entryid=entryid)
+      return {
+        'statusCode': 404,
+        'body': json.dumps("track not found")
+      }
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    sql = """
+      UPDATE entries
+      SET spotify_trackid = %s, spotify_song = %s, spotify_artist = %s,
+          popularity = %s, popularity_at = %s
+      WHERE entryid = %s AND spotify_trackid IS NULL
+    """
+    datatier.perform_action(dbConn, sql,
+                            [track["id"], track["name"], track["artist"], track["popularity"], now, entryid])
+
+    if not catalog_spotify_id:
+      datatier.perform_action(dbConn, "UPDATE tracks SET spotify_trackid = %s WHERE trackid = %s AND spotify_trackid IS NULL",
+                              [track["id"], catalog_trackid])
+    if track["artistid"]:
+      datatier.perform_action(dbConn, "UPDATE artists SET spotify_artistid = %s WHERE artistid = %s AND spotify_artistid IS NULL",
+                              [track["artistid"], artistid])
+
+    applog.info("**DONE**", entryid=entryid, trackid=track["id"])
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"entryid": entryid, "trackid": track["id"]})
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+    
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -0,0 +1,82 @@
+#
+# catalog.py
+#
+# The song catalog: one row per artist and per track (an artist's
+# song), which entries reference by id instead of repeating the
+# names on every row.
+#
+# Artists and tracks are matched on a normalized key (see namekey),
+# so "The Beatles" and "the  beatles" are the same artist; the name
+# stored is the one first written. The Spotify ids are filled in
+# by finalproj_resolve_track once the song is found.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import datatier
+import tracing
+
+
+def namekey(name):
+  """
+  Returns the key a name is matched on: lower case, with runs of
+  whitespace collapsed to one space and none at either end (the
+  same as migrations/003-catalog.sql computes).
+  """
+  return " ".join(name.lower().split())
+
+
+def _row_id(dbConn, sql, parameters):
+  row = datatier.retrieve_one_row(dbConn, sql, parameters)
+  return row[0] if row else None
+
+
+def artist_id(dbConn, artist):
+  """
+  Returns the artistid of the artist, adding the artist to the
+  catalog if needed.
+  """
+  key = namekey(artist)
+  sql = "SELECT artistid FROM artists WHERE namekey = %s;"
+
+  artistid = _row_id(dbConn, sql, [key])
+  if artistid is None:
+    # INSERT IGNORE: another writer may add the same artist first
+    datatier.perform_action(dbConn, "INSERT IGNORE INTO artists(name, namekey) VALUES(%s, %s);",
+                            [artist.strip(), key])
+    artistid = _row_id(dbConn, sql, [key])
+  return artistid
+
+
+def track_id(dbConn, song, artist):
+  """
+  Returns the trackid of the song by the artist, adding the song
+  (and artist) to the catalog if needed. A song already in the
+  catalog costs one indexed lookup.
+
+  Parameters
+  ----------
+  dbConn : open connection to the writer,
+  song : the song's name as the user wrote it,
+  artist : the artist's name as the user wrote it
+
+  Returns
+  -------
+  the trackid (int)
+  """
+  with tracing.span("catalog.lookup"):
+    key = namekey(song)
+    trackid = _row_id(dbConn, """
+      SELECT t.trackid
+      FROM tracks t JOIN artists a ON a.artistid = t.artistid
+      WHERE a.namekey = %s AND t.namekey = %s;
+    """, [namekey(artist), key])
+    if trackid is not None:
+      return trackid
+
+    artistid = artist_id(dbConn, artist)
+    sql = "SELECT trackid FROM tracks WHERE artistid = %s AND namekey = %s;"
+    datatier.perform_action(dbConn, "INSERT IGNORE INTO tracks(artistid, name, namekey) VALUES(%s, %s, %s);",
+                            [artistid, song.strip(), key])
+    return _row_id(dbConn, sql, [artistid, key])
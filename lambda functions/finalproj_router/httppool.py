@@ -0,0 +1,36 @@
+#
+# httppool.py
+#
+# One urllib3 connection pool per container for the calls to the
+# Spotify and Ticketmaster APIs, so warm invocations reuse open
+# (TLS) connections instead of setting up new ones.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that calls out over HTTP.
+#
+
+import urllib3
+
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10.0
+MAXSIZE = 4          # connections kept per host, unless a caller needs more
+
+_pool = None
+_maxsize = 0
+
+
+def pool(maxsize=MAXSIZE):
+  """
+  Returns this container's urllib3.PoolManager, keeping at least
+  maxsize connections per host (pass the number of threads that
+  will share it).
+  """
+  global _pool, _maxsize
+
+  if _pool is None or maxsize > _maxsize:
+    _maxsize = max(maxsize, MAXSIZE)
+    _pool = urllib3.PoolManager(num_pools=4,
+                                maxsize=_maxsize,
+                                timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT))
+  return _pool
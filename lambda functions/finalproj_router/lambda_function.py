@@ -0,0 +1,123 @@
+#
+# Router: one lambda function that serves every Reverb route.
+#
+# API Gateway can send all routes (or a {proxy+} resource) to this
+# function instead of the eight separate ones. It dispatches each
+# request by method and resource to the unchanged lambda_handler of
+# the function that owns the route, so all routes share one pool of
+# warm containers -- and, within a container, one config, one
+# database connection, one set of boto3 clients and one HTTP pool
+# (see runtime.py, datatier.py and httppool.py).
+#
+# The handlers are loaded when the container starts: from handlers/
+# when packaged by tools/package_lambdas.py, otherwise from the
+# sibling function directories.
+#
+
+import importlib.util
+import json
+import pathlib
+import re
+import urllib.parse
+
+import applog
+
+
+#
+# (method, API Gateway resource, lambda function) -- keep in sync
+# with the API Gateway resources and tools/local_gateway.py.
+#
+ROUTES = [
+  ("POST", "/user", "finalproj_add_user"),
+  ("POST", "/login", "finalproj_login"),
+  ("POST", "/write", "finalproj_write_entry"),
+  ("GET", "/read/{username}/{date}", "finalproj_read_entry"),
+  ("GET", "/popularity/{username}", "finalproj_popularity"),
+  ("GET", "/search/{username}", "finalproj_search"),
+  ("GET", "/recommendations/{username}", "finalproj_recommendations"),
+  ("GET", "/stats/{username}", "finalproj_stats"),
+  ("GET", "/trending", "finalproj_trending"),
+  ("GET", "/concerts-init", "finalproj_concerts_init"),
+  ("GET", "/concerts", "finalproj_get_concerts"),
+  ("GET", "/callback", "finalproj_concerts"),
+]
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+
+###################################################################
+#
+# loading the handlers
+#
+def handler_path(function):
+  packaged = HERE / "handlers" / (function + ".py")
+  if packaged.is_file():
+    return packaged
+  return HERE.parent / function / "lambda_function.py"
+
+
+def load_handler(function):
+  """
+  Imports a function's lambda_function module under its own name
+  and returns its lambda_handler. Its imports of the shared modules
+  (datatier, runtime, ...) resolve to the router's copies, so every
+  route shares their state.
+  """
+  spec = importlib.util.spec_from_file_location("handlers." + function, handler_path(function))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module.lambda_handler
+
+
+def compile_route(resource):
+  pattern = re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(resource))
+  return re.compile("^" + pattern + "$")
+
+
+_handlers = {}
+for (method, resource, function) in ROUTES:
+  if function not in _handlers:
+    _handlers[function] = load_handler(function)
+
+_routes = {(method, resource): _handlers[function] for (method, resource, function) in ROUTES}
+_patterns = [(method, resource, compile_route(resource)) for (method, resource, function) in ROUTES]
+
+
+###################################################################
+#
+# dispatch
+#
+def route(event):
+  """
+  Returns (handler, event) for the request, or (None, event). The
+  event's resource is used when it is one of ours; otherwise (e.g.
+  a {proxy+} resource) the path is matched against the routes and
+  the event is rewritten with their resource and path parameters.
+  """
+  method = event.get("httpMethod")
+  handler = _routes.get((method, event.get("resource")))
+  if handler is not None:
+    return (handler, event)
+
+  path = event.get("path") or ""
+  for (m, resource, pattern) in _patterns:
+    match = pattern.match(path)
+    if m == method and match:
+      params = {k: urllib.parse.unquote(v) for (k, v) in match.groupdict().items()}
+      event = dict(event, resource=resource, pathParameters=params or None)
+      return (_routes[(m, resource)], event)
+
+  return (None, event)
+
+
+def lambda_handler(event, context):
+  (handler, event) = route(event)
+
+  if handler is None:
+    applog.warning("no route", method=event.get("httpMethod"), path=event.get("path"))
+    return {
+      'statusCode': 404,
+      'body': json.dumps({"message": "Not found"})
+    }
+
+  return handler(event, context)
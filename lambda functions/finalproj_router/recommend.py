@@ -0,0 +1,67 @@
+#
+# recommend.py
+#
+# Song recommendations from the journal history.
+#
+# finalproj_build_recommendations (on a schedule) computes how
+# similar every pair of tracks is from who picked them -- tracks
+# picked by the same users, and tracks by artists picked by the
+# same users -- and keeps each track's NEIGHBORS most similar
+# tracks in track_neighbors. A user's recommendations are the
+# tracks most similar to their RECENT_ENTRIES latest picks that
+# they have not picked yet:
+#
+#   score(user, track) = sum over the user's recent picks p of
+#                        similarity(p, track), if a neighbor of p
+#
+# stored, RECOMMENDATIONS per user, in recommendations. The builder
+# computes them for every user; /write recomputes them for the
+# writer from track_neighbors (update_user), so a new entry shows
+# up in the user's recommendations right away.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import datatier
+import tracing
+
+
+NEIGHBORS = 20          # similar tracks kept per track
+RECOMMENDATIONS = 20    # tracks kept per user
+RECENT_ENTRIES = 30     # a user's latest picks the recommendations are based on
+ARTIST_WEIGHT = 0.5     # weight of artist similarity next to track similarity
+
+
+def update_user(dbConn, userid):
+  """
+  Recomputes the user's recommendations from their recent entries
+  and the stored track neighbors, and replaces the stored ones.
+  Reads at most RECENT_ENTRIES x NEIGHBORS neighbor rows.
+
+  Returns
+  -------
+  the number of recommendations stored
+  """
+  sql = """
+    SELECT n.neighbor, SUM(n.score) AS total
+    FROM (SELECT trackid FROM entries
+          WHERE userid = %s
+          ORDER BY entrydate DESC
+          LIMIT %s) recent
+      JOIN track_neighbors n ON n.trackid = recent.trackid
+    WHERE n.neighbor NOT IN (SELECT trackid FROM entries WHERE userid = %s)
+    GROUP BY n.neighbor
+    ORDER BY total DESC, n.neighbor
+    LIMIT %s
+  """
+  with tracing.span("recommend.update"):
+    rows = datatier.retrieve_all_rows(dbConn, sql, [userid, RECENT_ENTRIES, userid, RECOMMENDATIONS])
+
+    with datatier.transaction(dbConn):
+      datatier.perform_action(dbConn, "DELETE FROM recommendations WHERE userid = %s", [userid])
+      datatier.perform_bulk_action(dbConn, """
+        INSERT INTO recommendations(userid, trackid, score) VALUES(%s, %s, %s)
+      """, [[userid, trackid, float(total)] for (trackid, total) in rows])
+
+  return len(rows)
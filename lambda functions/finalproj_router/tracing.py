@@ -0,0 +1,231 @@
+#
+# tracing.py
+#
+# Per-invocation timing spans for the Reverb lambda functions.
+#
+# A handler is wrapped with @tracing.traced("/route"), and the
+# phases inside it with "with tracing.span(name):". Each invocation
+# then logs one JSON record (via applog) with the route, status,
+# total duration, cold / warm start and the time spent in each
+# phase, so a slow call can be attributed to config, the database,
+# KMS, Spotify, Ticketmaster or S3. The full list of spans, with
+# start offsets on a monotonic clock, is only logged when the
+# invocation is sampled, debugged or fails (see applog.py). If the
+# REVERB_SERVER_TIMING environment variable is set to 1 the spans
+# are also returned to the caller in a Server-Timing header.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory.
+#
+
+import functools
+import os
+import time
+
+import applog
+
+
+#
+# module state: lambda runs one invocation at a time per container,
+# so the current trace can simply be a module-level variable.
+#
+_cold = True
+_trace = None
+_span_hooks = []
+_finish_hooks = []
+
+
+###################################################################
+#
+# Trace
+#
+class Trace:
+  """
+  The spans recorded during one invocation.
+  """
+
+  def __init__(self, route, event, context):
+    self.route = route
+    self.start = time.perf_counter()
+    self.request_id = getattr(context, "aws_request_id", None)
+    self.function = getattr(context, "function_name", None)
+    self.context = context
+    self.method = event.get("httpMethod") if isinstance(event, dict) else None
+    self.spans = []
+
+  def add(self, name, start, end):
+    self.spans.append((name, start - self.start, end - start))
+
+  def elapsed_ms(self):
+    return (time.perf_counter() - self.start) * 1000
+
+
+###################################################################
+#
+# span
+#
+class span:
+  """
+  Context manager that times the enclosed block and records it
+  as a named span of the current invocation. Outside of a traced
+  invocation it does nothing.
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if _trace is not None:
+      end = time.perf_counter()
+      _trace.add(self.name, self.start, end)
+      for hook in _span_hooks:
+        try:
+          hook(self.name, (end - self.start) * 1000)
+        except Exception as err:
+          applog.warning("tracing span hook failed", error=str(err))
+    return False
+
+
+def on_span(hook):
+  """
+  Registers hook(name, ms) to be called as each span of a traced
+  invocation ends.
+  """
+  if hook not in _span_hooks:
+    _span_hooks.append(hook)
+
+
+def on_finish(hook):
+  """
+  Registers hook(record) to be called with each invocation's log
+  record before it is written, so other modules (e.g. datatier)
+  can add their own fields.
+  """
+  if hook not in _finish_hooks:
+    _finish_hooks.append(hook)
+
+
+def remaining_ms():
+  """
+  Returns the milliseconds left before the current invocation times
+  out, or None when not known (e.g. outside a traced invocation).
+  """
+  trace = _trace
+  if trace is None or not hasattr(trace.context, "get_remaining_time_in_millis"):
+    return None
+  return trace.context.get_remaining_time_in_millis()
+
+
+###################################################################
+#
+# Server-Timing
+#
+def server_timing_enabled():
+  return os.environ.get("REVERB_SERVER_TIMING", "0").lower() in ("1", "true", "on")
+
+
+def phase_totals(trace):
+  """
+  Returns {name: (total ms, count)} for the spans in the trace.
+  """
+  totals = {}
+  for (name, offset, duration) in trace.spans:
+    (ms, n) = totals.get(name, (0.0, 0))
+    totals[name] = (ms + duration * 1000, n + 1)
+  return totals
+
+
+def server_timing(trace, total_ms):
+  """
+  Formats the trace as a Server-Timing header value; spans with
+  the same name are summed, with the count as the description.
+  """
+  metrics = []
+  for (name, (ms, n)) in phase_totals(trace).items():
+    metric = name.replace(" ", "_") + ";dur=%.1f" % ms
+    if n > 1:
+      metric += ';desc="x%d"' % n
+    metrics.append(metric)
+
+  metrics.append("total;dur=%.1f" % total_ms)
+  return ", ".join(metrics)
+
+
+###################################################################
+#
+# traced
+#
+def traced(route):
+  """
+  Decorator for a lambda_handler(event, context): records the
+  invocation as a trace for the given route and logs it as one
+  JSON line when the handler returns. An invocation that raises
+  or returns no status / a 5xx status counts as failed.
+  """
+
+  def decorator(handler):
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+      global _trace, _cold
+
+      cold = _cold
+      _cold = False
+
+      trace = Trace(route, event, context)
+      _trace = trace
+      result = None
+      applog.begin(route, event, trace.request_id)
+
+      try:
+        result = handler(event, context)
+        return result
+
+      finally:
+        _trace = None
+        total_ms = trace.elapsed_ms()
+        status = result.get("statusCode") if isinstance(result, dict) else None
+
+        record = {
+          "type": "invocation",
+          "route": route,
+          "method": trace.method,
+          "function": trace.function,
+          "request_id": trace.request_id,
+          "cold": cold,
+          "status": status,
+          "duration_ms": round(total_ms, 2),
+        }
+
+        failed = not isinstance(status, int) or status >= 500
+        if failed or applog.detailed():
+          record["spans"] = [
+            {"name": name, "start_ms": round(offset * 1000, 2), "dur_ms": round(duration * 1000, 2)}
+            for (name, offset, duration) in trace.spans
+          ]
+        else:
+          record["phases"] = {
+            name: round(ms, 2) for (name, (ms, n)) in phase_totals(trace).items()
+          }
+
+        # a failing hook must not replace the handler's response:
+        for hook in _finish_hooks:
+          try:
+            hook(record)
+          except Exception as err:
+            applog.warning("tracing finish hook failed", error=str(err))
+
+        applog.end(record, failed)
+
+        if server_timing_enabled() and isinstance(result, dict):
+          headers = result.setdefault("headers", {})
+          headers["Server-Timing"] = server_timing(trace, total_ms)
+          headers["X-Reverb-Cold-Start"] = "true" if cold else "false"
+
+    return wrapper
+
+  return decorator
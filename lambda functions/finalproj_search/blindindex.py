@@ -0,0 +1,84 @@
+#
+# blindindex.py
+#
+# Keyword search over the encrypted blurbs without decrypting them:
+# on /write each word of the blurb is stored in blurb_tokens as a
+# keyed digest, HMAC-SHA256(key, userid + word), and /search?text=
+# computes the same digests for the words searched for, so the
+# matching entries are found with one index lookup and only those
+# are decrypted.
+#
+# The HMAC key never reaches the database: it is kept in the
+# [blind-index] section of the config, encrypted with the app's KMS
+# key (e.g. the CiphertextBlob of `aws kms generate-data-key
+# --key-id alias/reverbapp-key --key-spec AES_256`, base64), and
+# decrypted once per container. Including the userid makes the same
+# word's digest differ between users; what the digests still reveal
+# is which of one user's entries share a word.
+#
+# Without a key in the config, blurbs are not indexed and text
+# search is unavailable.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import base64
+import hashlib
+import hmac
+import re
+
+import metrics
+import runtime
+import tracing
+
+
+SECTION = 'blind-index'
+DIGEST_BYTES = 16    # stored digest length (truncated HMAC-SHA256)
+MIN_WORD = 2         # shorter words are not indexed
+MAX_WORDS = 500      # distinct words indexed per blurb
+
+WORD = re.compile(r"\w+")
+
+_key = None
+
+
+def enabled():
+  """
+  Returns True if the config has a blind index key.
+  """
+  return runtime.config().has_option(SECTION, 'key')
+
+
+def key():
+  """
+  Returns the HMAC key, decrypting it with KMS the first time.
+  """
+  global _key
+
+  if _key is None:
+    blob = base64.b64decode(runtime.config().get(SECTION, 'key'))
+    metrics.count("KMSCalls")
+    with tracing.span("kms.decrypt"):
+      _key = runtime.aws_client('kms').decrypt(CiphertextBlob=blob)['Plaintext']
+  return _key
+
+
+def words(text):
+  """
+  Returns the distinct words of the text that are indexed: lower
+  case, at least MIN_WORD characters, at most MAX_WORDS of them.
+  """
+  seen = dict.fromkeys(w for w in WORD.findall(text.lower()) if len(w) >= MIN_WORD)
+  return list(seen)[:MAX_WORDS]
+
+
+def digests(userid, text):
+  """
+  Returns the user's keyed digests (bytes) of the words of the
+  text, one per distinct word.
+  """
+  k = key()
+  prefix = str(userid).encode() + b"\0"
+  return [hmac.new(k, prefix + w.encode('utf-8'), hashlib.sha256).digest()[:DIGEST_BYTES]
+          for w in words(text)]
@@ -0,0 +1,329 @@
+#
+# search()
+#
+# Searches the user's journal by song or artist: GET /search/{username}?q=phoebe returns the
+# entries (newest first, without their blurbs) where every word of the query is in the song
+# or the artist name -- "phoeb", "bridgers", "kyoto" or "phoebe kyoto" all find Phoebe
+# Bridgers' Kyoto.
+#
+# The names live in the catalog (tracks and artists), which have FULLTEXT indexes built with
+# MySQL's ngram parser, so a search is one indexed query however many entries the user has.
+# When nothing matches, the songs of the user's latest FUZZY_ENTRIES entries are compared
+# with the query by trigram similarity instead, so small typos ("pheobe") still find them.
+#
+# ?text=words searches the blurbs instead (or as well): the entries whose blurb contains every
+# word are found through the blind index (see blindindex.py), without decrypting anything,
+# and only the blurbs of the entries returned are decrypted.
+#
+# Results are paginated: pass the "next" value of a response as ?cursor= to get the next
+# page, and ?limit= (default 20, at most 100) to change the page size.
+#
+
+import json
+import blindindex
+import catalog
+import datatier
+import applog
+import metrics
+import runtime
+import tracing
+import usercache
+
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MIN_TERM = 2             # ngram_token_size: shorter words cannot be matched
+FUZZY_THRESHOLD = 0.4    # trigram similarity (Dice) a fuzzy match needs
+FUZZY_ENTRIES = 500      # latest entries whose songs a fuzzy search compares
+
+# characters with a meaning in a BOOLEAN MODE query:
+OPERATORS = str.maketrans({c: " " for c in '+-<>()~*"@'})
+
+SELECT_ENTRIES = """
+  SELECT e.entryid, e.entrydate, t.name, a.name
+  FROM entries e
+    JOIN tracks t ON t.trackid = e.trackid
+    JOIN artists a ON a.artistid = t.artistid
+  WHERE e.userid = %s
+"""
+
+# one per word, so each MATCH can use its FULLTEXT index:
+MATCHING_TRACKS = """
+  e.trackid IN (
+    SELECT trackid FROM tracks
+    WHERE MATCH(name) AGAINST (%s IN BOOLEAN MODE)
+    UNION
+    SELECT mt.trackid FROM tracks mt JOIN artists ma ON ma.artistid = mt.artistid
+    WHERE MATCH(ma.name) AGAINST (%s IN BOOLEAN MODE)
+  )
+"""
+
+MATCHING_BLURBS = """
+  e.entryid IN (
+    SELECT entryid FROM blurb_tokens
+    WHERE userid = %s AND digest IN ({digests})
+    GROUP BY entryid
+    HAVING COUNT(*) = %s
+  )
+"""
+
+
+###################################################################
+#
+# matching
+#
+def search_terms(q):
+  """
+  Returns the words of the query that can be searched for.
+  """
+  return [w for w in catalog.namekey(q.translate(OPERATORS)).split() if len(w) >= MIN_TERM]
+
+
+def boolean_query(terms):
+  """
+  Returns a BOOLEAN MODE query requiring every term; with the ngram
+  parser a quoted term matches anywhere in the name.
+  """
+  return " ".join('+"' + t + '"' for t in terms)
+
+
+def matching_tracks(terms):
+  """
+  Returns (condition, parameters) matching the entries whose song
+  or artist contains each term -- not necessarily the same one, so
+  "phoebe kyoto" finds Kyoto by Phoebe Bridgers.
+  """
+  conditions = []
+  parameters = []
+  for term in terms:
+    against = boolean_query([term])
+    conditions.append(MATCHING_TRACKS)
+    parameters += [against, against]
+  return (" AND ".join(conditions), parameters)
+
+
+def trigrams(s):
+  s = "  " + s + " "
+  return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def similarity(query, name):
+  """
+  Returns how well the query matches the best run of words in the
+  name, by trigram similarity (Dice coefficient, 0 to 1).
+  """
+  q = trigrams(query)
+  words = catalog.namekey(name).split()
+  n = max(len(query.split()), 1)
+  best = 0.0
+  for i in range(max(len(words) - n + 1, 1)):
+    t = trigrams(" ".join(words[i:i + n]))
+    best = max(best, 2 * len(q & t) / (len(q) + len(t)))
+  return best
+
+
+def fuzzy_tracks(dbConn, userid, terms):
+  """
+  Returns the ids of the user's tracks whose song or artist is
+  similar enough to the query, among the songs of their latest
+  FUZZY_ENTRIES entries (a read of the (userid, entrydate) index
+  however long the journal is). Only used when the indexed search
+  finds nothing.
+  """
+  sql = """
+    SELECT DISTINCT t.trackid, t.name, a.name
+    FROM (SELECT trackid FROM entries
+          WHERE userid = %s
+          ORDER BY entrydate DESC, entryid DESC
+          LIMIT %s) recent
+      JOIN tracks t ON t.trackid = recent.trackid
+      JOIN artists a ON a.artistid = t.artistid
+  """
+  query = " ".join(terms)
+  rows = datatier.retrieve_all_rows(dbConn, sql, [userid, FUZZY_ENTRIES])
+  return [trackid for (trackid, song, artist) in rows
+          if max(similarity(query, song), similarity(query, artist)) >= FUZZY_THRESHOLD]
+
+
+def matching_blurbs(userid, text):
+  """
+  Returns (condition, parameters) matching the entries whose blurb
+  contains every word of the text.
+  """
+  digests = blindindex.digests(userid, text)
+  condition = MATCHING_BLURBS.format(digests=", ".join(["%s"] * len(digests)))
+  return (condition, [userid] + digests + [len(digests)])
+
+
+def add_blurbs(dbConn, entries):
+  """
+  Decrypts the blurbs of the entries (one KMS call each) and adds
+  them to the entry dicts.
+  """
+  if not entries:
+    return
+  sql = "SELECT entryid, blurb FROM entries WHERE entryid IN (" + ", ".join(["%s"] * len(entries)) + ")"
+  blurbs = dict(datatier.retrieve_all_rows(dbConn, sql, [entry['entryid'] for entry in entries]))
+
+  with tracing.span("kms.client"):
+    kms_client = runtime.aws_client('kms')
+  for entry in entries:
+    metrics.count("KMSCalls")
+    with tracing.span("kms.decrypt"):
+      entry['blurb'] = kms_client.decrypt(CiphertextBlob=blurbs[entry['entryid']])['Plaintext'].decode('utf-8')
+
+
+###################################################################
+#
+# paging
+#
+def parse_cursor(cursor):
+  """
+  Returns (entrydate, entryid) of the last entry of the previous
+  page from a "next" value, or raises ValueError.
+  """
+  (date, entryid) = cursor.split("_")
+  if len(date) != 10 or date[4] != '-' or date[7] != '-':
+    raise ValueError(cursor)
+  return (date, int(entryid))
+
+
+def page(dbConn, userid, matches, cursor, limit):
+  """
+  Returns (entries, next cursor or None): the next page of the
+  user's entries that satisfy every (condition, parameters) in
+  matches, newest first.
+  """
+  sql = SELECT_ENTRIES
+  parameters = [userid]
+  for (condition, condition_parameters) in matches:
+    sql += " AND " + condition
+    parameters += condition_parameters
+  if cursor:
+    sql += " AND (e.entrydate < %s OR (e.entrydate = %s AND e.entryid < %s))"
+    parameters += [cursor[0], cursor[0], cursor[1]]
+  sql += " ORDER BY e.entrydate DESC, e.entryid DESC LIMIT %s"
+
+  # one extra row tells us whether there is a next page:
+  rows = datatier.retrieve_all_rows(dbConn, sql, parameters + [limit + 1])
+
+  entries = [{'entryid': entryid, 'date': str(entrydate), 'song': song, 'artist': artist}
+             for (entryid, entrydate, song, artist) in rows[:limit]]
+  next_cursor = None
+  if len(rows) > limit:
+    last = entries[-1]
+    next_cursor = last['date'] + "_" + str(last['entryid'])
+  return (entries, next_cursor)
+
+
+@tracing.traced("/search/{username}")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_search**")
+
+    #
+    # check parameters
+    #
+    if "username" in event:
+      username = event["username"]
+    elif "pathParameters" in event:
+      if "username" in event["pathParameters"]:
+        username = event["pathParameters"]["username"]
+      else:
+        raise Exception("requires username parameter in pathParameters")
+    else:
+        raise Exception("requires username parameter in event")
+
+    query = event.get("queryStringParameters") or {}
+    terms = search_terms(query.get("q", ""))
+    text = query.get("text", "").strip()
+    if (not terms and not text) or (query.get("q") and not terms) or (text and not blindindex.words(text)):
+      return {
+        "statusCode": 400,
+        "body": json.dumps({"message": "Search for a song or artist (q) or for words of your blurbs (text), "
+                                       + "at least " + str(MIN_TERM) + " characters."})
+      }
+    if text and not blindindex.enabled():
+      return {
+        "statusCode": 400,
+        "body": json.dumps({"message": "Searching blurbs is not set up."})
+      }
+
+    try:
+      limit = min(max(int(query.get("limit") or DEFAULT_LIMIT), 1), MAX_LIMIT)
+      cursor = parse_cursor(query["cursor"]) if query.get("cursor") else None
+    except ValueError:
+      return {
+        "statusCode": 400,
+        "body": json.dumps({"message": "Invalid limit or cursor."})
+      }
+
+    consistent = datatier.consistent_requested(event)
+
+    with tracing.span("userid_lookup"):
+      userid = usercache.userid(username, consistent)
+    if userid is None:
+      return {
+        "statusCode": 401,
+        "body": json.dumps({"message": "Username does not exist."})
+      }
+
+    #
+    # reads can use a read replica:
+    #
+    dbConn = datatier.reader(username, consistent)
+
+    applog.debug("**Searching**", terms=terms)
+
+    matches = []
+    if text:
+      with tracing.span("blind_index"):
+        matches.append(matching_blurbs(userid, text))
+    if terms:
+      matches.append(matching_tracks(terms))
+
+    (entries, next_cursor) = page(dbConn, userid, matches, cursor, limit)
+    fuzzy = False
+
+    #
+    # no song or artist contains the words; look for similar ones
+    # (a page after the first can only be empty here if it is fuzzy
+    # too):
+    #
+    if not entries and terms:
+      trackids = fuzzy_tracks(dbConn, userid, terms)
+      if trackids:
+        fuzzy = True
+        matches[-1] = ("e.trackid IN (" + ", ".join(["%s"] * len(trackids)) + ")", trackids)
+        (entries, next_cursor) = page(dbConn, userid, matches, cursor, limit)
+
+    #
+    # a text search shows the blurbs it matched; only these are
+    # decrypted:
+    #
+    if text:
+      add_blurbs(dbConn, entries)
+
+    metrics.count("SearchResults", len(entries))
+    if fuzzy:
+      metrics.count("FuzzySearches")
+
+    applog.debug("**DONE**", results=len(entries), fuzzy=fuzzy)
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({
+        'entries': entries,
+        'next': next_cursor,
+        'fuzzy': fuzzy
+      })
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -0,0 +1,88 @@
+#
+# stats()
+#
+# Returns the user's journal statistics: GET /stats/{username} gives the number of entries,
+# distinct songs and artists, first and last entry, current and longest streak of days in a
+# row, entries per month and the most picked artists.
+#
+# They are kept up to date by /write (see userstats.py), so this is a single row read however
+# many entries the user has.
+#
+
+import json
+import datatier
+import applog
+import tracing
+import usercache
+import userstats
+
+
+@tracing.traced("/stats/{username}")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_stats**")
+
+    if "username" in event:
+      username = event["username"]
+    elif "pathParameters" in event:
+      if "username" in event["pathParameters"]:
+        username = event["pathParameters"]["username"]
+      else:
+        raise Exception("requires username parameter in pathParameters")
+    else:
+        raise Exception("requires username parameter in event")
+
+    consistent = datatier.consistent_requested(event)
+
+    with tracing.span("userid_lookup"):
+      userid = usercache.userid(username, consistent)
+    if userid is None:
+      return {
+        "statusCode": 401,
+        "body": json.dumps({"message": "Username does not exist."})
+      }
+
+    #
+    # reads can use a read replica (a request right after /write
+    # asks for a consistent read, and sees the updated stats):
+    #
+    dbConn = datatier.reader(username, consistent)
+
+    sql = "SELECT last_entry, current_run_start, " + userstats.STATS_COLUMNS + " FROM user_stats WHERE userid = %s"
+    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+
+    if not row:   # no entries yet
+      stats = {'entries': 0, 'distinct_songs': 0, 'distinct_artists': 0, 'first_entry': None,
+               'last_entry': None, 'current_streak': 0, 'longest_streak': 0, 'months': {},
+               'top_artists': []}
+    else:
+      (entries, distinct_songs, distinct_artists, first_entry, last_entry,
+       current_run_start, longest_streak, months, top_artists) = row[2:]
+      months = json.loads(months)
+      stats = {
+        'entries': entries,
+        'distinct_songs': distinct_songs,
+        'distinct_artists': distinct_artists,
+        'first_entry': str(first_entry) if first_entry else None,
+        'last_entry': str(last_entry) if last_entry else None,
+        'current_streak': userstats.current_streak(row[:2]),
+        'longest_streak': longest_streak,
+        'months': {month: months[month] for month in sorted(months)},
+        'top_artists': [{'artist': name, 'entries': count} for (artistid, name, count) in json.loads(top_artists)],
+      }
+
+    applog.debug("**DONE**", entries=stats['entries'])
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps(stats)
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
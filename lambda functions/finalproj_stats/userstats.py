@@ -0,0 +1,263 @@
+#
+# userstats.py
+#
+# Per-user journal statistics, kept up to date as entries are
+# written so /stats reads them from one row instead of going over
+# the user's entries.
+#
+# user_stats has a row per user with the counters (entries,
+# distinct songs and artists, first and last entry), the entries
+# per month and the TOP_ARTISTS most picked artists (JSON), and
+# the streaks: the longest run of consecutive days with an entry,
+# and where the run ending at the last entry started (the current
+# streak, if the last entry is recent). Two side tables make the
+# updates cheap: user_artist_counts has the tally of every artist
+# the user picked, and user_streaks every run of consecutive days
+# as (start_date, end_date), so a new entry only merges with the
+# runs ending the day before and starting the day after.
+#
+# /write calls record_entry in the entry's transaction; it locks
+# the user's row, so a user's updates apply one at a time.
+# finalproj_rebuild_stats recomputes the rows from the entries
+# (rebuild_user), e.g. after a migration or a manual fix.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import datetime
+import json
+
+import datatier
+import tracing
+
+
+TOP_ARTISTS = 5    # artists kept in user_stats.top_artists
+
+ONE_DAY = datetime.timedelta(days=1)
+
+STATS_COLUMNS = """entries, distinct_songs, distinct_artists, first_entry, last_entry,
+                   current_run_start, longest_streak, months, top_artists"""
+
+
+def _date(value):
+  if isinstance(value, str):
+    return datetime.date.fromisoformat(value)
+  return value
+
+
+def _lock(dbConn, userid):
+  """
+  Returns the user's stats row as a dict, creating it if needed,
+  locked until the end of the transaction.
+  """
+  datatier.perform_action(dbConn, """
+    INSERT IGNORE INTO user_stats(userid, months, top_artists) VALUES(%s, '{}', '[]')
+  """, [userid])
+  row = datatier.retrieve_one_row(dbConn, "SELECT " + STATS_COLUMNS + """
+    FROM user_stats WHERE userid = %s FOR UPDATE
+  """, [userid])
+  (entries, distinct_songs, distinct_artists, first_entry, last_entry,
+   current_run_start, longest_streak, months, top_artists) = row
+  return {
+    'entries': entries,
+    'distinct_songs': distinct_songs,
+    'distinct_artists': distinct_artists,
+    'first_entry': _date(first_entry),
+    'last_entry': _date(last_entry),
+    'current_run_start': _date(current_run_start),
+    'longest_streak': longest_streak,
+    'months': json.loads(months),
+    'top_artists': json.loads(top_artists),
+  }
+
+
+def _store(dbConn, userid, stats):
+  datatier.perform_action(dbConn, """
+    UPDATE user_stats
+    SET entries = %s, distinct_songs = %s, distinct_artists = %s, first_entry = %s, last_entry = %s,
+        current_run_start = %s, longest_streak = %s, months = %s, top_artists = %s
+    WHERE userid = %s
+  """, [stats['entries'], stats['distinct_songs'], stats['distinct_artists'],
+        stats['first_entry'], stats['last_entry'], stats['current_run_start'],
+        stats['longest_streak'], json.dumps(stats['months'], sort_keys=True),
+        json.dumps(stats['top_artists']), userid])
+
+
+def _rank(top_artists, artistid, name, count):
+  """
+  Returns the top artists list [[artistid, name, count], ...] with
+  the artist's count updated, most picked first.
+  """
+  top = [a for a in top_artists if a[0] != artistid] + [[artistid, name, count]]
+  top.sort(key=lambda a: (-a[2], a[1].lower()))
+  return top[:TOP_ARTISTS]
+
+
+def record_entry(dbConn, userid, entrydate, trackid):
+  """
+  Updates the user's stats for an entry just added to the entries
+  table. Runs in the caller's transaction (or its own), so the
+  entry and its stats are written together.
+
+  Parameters
+  ----------
+  dbConn : open connection to the writer,
+  userid : the user,
+  entrydate : the entry's date (YYYY-MM-DD or a date),
+  trackid : the entry's track
+  """
+  entrydate = _date(entrydate)
+
+  with tracing.span("userstats.record"), datatier.transaction(dbConn):
+    stats = _lock(dbConn, userid)
+
+    stats['entries'] += 1
+    month = entrydate.isoformat()[:7]
+    stats['months'][month] = stats['months'].get(month, 0) + 1
+
+    songs = datatier.retrieve_one_row(dbConn, """
+      SELECT COUNT(*) FROM entries WHERE userid = %s AND trackid = %s
+    """, [userid, trackid])[0]
+    if songs == 1:
+      stats['distinct_songs'] += 1
+
+    #
+    # the artist's tally, and the top artists if it moves up:
+    #
+    (artistid, name) = datatier.retrieve_one_row(dbConn, """
+      SELECT a.artistid, a.name FROM tracks t JOIN artists a ON a.artistid = t.artistid
+      WHERE t.trackid = %s
+    """, [trackid])
+    datatier.perform_action(dbConn, """
+      INSERT INTO user_artist_counts(userid, artistid, entries) VALUES(%s, %s, 1)
+      ON DUPLICATE KEY UPDATE entries = entries + 1
+    """, [userid, artistid])
+    count = datatier.retrieve_one_row(dbConn, """
+      SELECT entries FROM user_artist_counts WHERE userid = %s AND artistid = %s
+    """, [userid, artistid])[0]
+    if count == 1:
+      stats['distinct_artists'] += 1
+
+    top = stats['top_artists']
+    if len(top) < TOP_ARTISTS or count >= top[-1][2] or any(a[0] == artistid for a in top):
+      stats['top_artists'] = _rank(top, artistid, name, count)
+
+    #
+    # the streaks: a day already written counts once; a new one joins
+    # the runs ending the day before and starting the day after:
+    #
+    days = datatier.retrieve_one_row(dbConn, """
+      SELECT COUNT(*) FROM entries WHERE userid = %s AND entrydate = %s
+    """, [userid, entrydate])[0]
+    if days == 1:
+      (start, end) = (entrydate, entrydate)
+      neighbors = datatier.retrieve_all_rows(dbConn, """
+        SELECT start_date, end_date FROM user_streaks
+        WHERE userid = %s AND (end_date = %s OR start_date = %s)
+      """, [userid, entrydate - ONE_DAY, entrydate + ONE_DAY])
+      for (run_start, run_end) in neighbors:
+        (start, end) = (min(start, _date(run_start)), max(end, _date(run_end)))
+      if neighbors:
+        datatier.perform_action(dbConn, "DELETE FROM user_streaks WHERE userid = %s AND start_date IN (%s, %s)",
+                                [userid, start, entrydate + ONE_DAY])
+      datatier.perform_action(dbConn, """
+        INSERT INTO user_streaks(userid, start_date, end_date) VALUES(%s, %s, %s)
+      """, [userid, start, end])
+
+      stats['longest_streak'] = max(stats['longest_streak'], (end - start).days + 1)
+      if stats['last_entry'] is None or end >= stats['last_entry']:
+        stats['current_run_start'] = start
+
+    stats['first_entry'] = min(filter(None, [stats['first_entry'], entrydate]))
+    stats['last_entry'] = max(filter(None, [stats['last_entry'], entrydate]))
+
+    _store(dbConn, userid, stats)
+
+
+def runs(dates):
+  """
+  Returns the runs of consecutive days, [(start, end), ...], of the
+  sorted dates.
+  """
+  result = []
+  for d in dates:
+    if result and d - result[-1][1] <= ONE_DAY:
+      result[-1] = (result[-1][0], d)
+    else:
+      result.append((d, d))
+  return result
+
+
+def rebuild_user(dbConn, userid):
+  """
+  Recomputes the user's stats, artist tallies and streaks from
+  their entries and replaces the stored ones.
+
+  Returns
+  -------
+  the number of entries counted
+  """
+  with tracing.span("userstats.rebuild"), datatier.transaction(dbConn):
+    _lock(dbConn, userid)
+
+    rows = datatier.retrieve_all_rows(dbConn, """
+      SELECT e.entrydate, e.trackid, a.artistid, a.name
+      FROM entries e
+        JOIN tracks t ON t.trackid = e.trackid
+        JOIN artists a ON a.artistid = t.artistid
+      WHERE e.userid = %s
+      ORDER BY e.entrydate
+    """, [userid])
+
+    dates = []
+    months = {}
+    artists = {}
+    for (entrydate, trackid, artistid, name) in rows:
+      dates.append(_date(entrydate))
+      month = dates[-1].isoformat()[:7]
+      months[month] = months.get(month, 0) + 1
+      (count, _) = artists.get(artistid, (0, name))
+      artists[artistid] = (count + 1, name)
+
+    streaks = runs(sorted(set(dates)))
+    top = []
+    for (artistid, (count, name)) in artists.items():
+      top = _rank(top, artistid, name, count)
+
+    stats = {
+      'entries': len(rows),
+      'distinct_songs': len({trackid for (_, trackid, _, _) in rows}),
+      'distinct_artists': len(artists),
+      'first_entry': dates[0] if dates else None,
+      'last_entry': dates[-1] if dates else None,
+      'current_run_start': streaks[-1][0] if streaks else None,
+      'longest_streak': max([(end - start).days + 1 for (start, end) in streaks], default=0),
+      'months': months,
+      'top_artists': top,
+    }
+
+    datatier.perform_action(dbConn, "DELETE FROM user_artist_counts WHERE userid = %s", [userid])
+    datatier.perform_action(dbConn, "DELETE FROM user_streaks WHERE userid = %s", [userid])
+    datatier.perform_bulk_action(dbConn, """
+      INSERT INTO user_artist_counts(userid, artistid, entries) VALUES(%s, %s, %s)
+    """, [[userid, artistid, count] for (artistid, (count, _)) in artists.items()])
+    datatier.perform_bulk_action(dbConn, """
+      INSERT INTO user_streaks(userid, start_date, end_date) VALUES(%s, %s, %s)
+    """, [[userid, start, end] for (start, end) in streaks])
+    _store(dbConn, userid, stats)
+
+  return len(rows)
+
+
+def current_streak(stats_row, today=None):
+  """
+  Returns the current streak from the stored last_entry and
+  current_run_start: the run ending at the last entry, if that was
+  today or yesterday (UTC), else 0.
+  """
+  (last_entry, current_run_start) = (_date(stats_row[0]), _date(stats_row[1]))
+  today = today or datetime.datetime.now(datetime.timezone.utc).date()
+  if last_entry is None or last_entry < today - ONE_DAY:
+    return 0
+  return (last_entry - current_run_start).days + 1
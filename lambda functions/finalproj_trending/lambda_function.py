@@ -0,0 +1,81 @@
+#
+# trending()
+#
+# What Reverb users are picking lately: GET /trending?period=week returns the top songs and
+# artists across all users, each day's picks counting less the older they are (see
+# trending.py); ?period=day gives today's picks, ?limit= (default 10, at most 50) the number
+# of each.
+#
+# The counts are kept up to date by /write, so this never reads the entries. Each container
+# keeps a result for CACHE_SECONDS, and the response says so in Cache-Control so clients and
+# the API Gateway cache can reuse it too.
+#
+
+import json
+import os
+import time
+import datatier
+import applog
+import metrics
+import tracing
+import trending
+
+
+DEFAULT_PERIOD = "week"
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+CACHE_SECONDS = float(os.environ.get("REVERB_TRENDING_CACHE_SECONDS", "60"))
+
+_cache = {}   # (period, limit) => (expires, body)
+
+
+@tracing.traced("/trending")
+def lambda_handler(event, context):
+  try:
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: finalproj_trending**")
+
+    query = event.get("queryStringParameters") or {}
+    period = query.get("period") or DEFAULT_PERIOD
+    if period not in trending.PERIODS:
+      return {
+        "statusCode": 400,
+        "body": json.dumps({"message": "Invalid period, use one of: " + ", ".join(trending.PERIODS) + "."})
+      }
+    try:
+      limit = min(max(int(query.get("limit") or DEFAULT_LIMIT), 1), MAX_LIMIT)
+    except ValueError:
+      return {
+        "statusCode": 400,
+        "body": json.dumps({"message": "Invalid limit."})
+      }
+
+    now = time.monotonic()
+    cached = _cache.get((period, limit))
+    metrics.cache("TrendingCache", cached is not None and cached[0] > now)
+
+    if cached is None or cached[0] <= now:
+      #
+      # reads can use a read replica; a few seconds behind is fine
+      # for a ranking that is cached anyway:
+      #
+      (songs, artists) = trending.top(datatier.reader(), period, limit)
+      body = json.dumps({'period': period, 'songs': songs, 'artists': artists})
+      cached = (now + CACHE_SECONDS, body)
+      _cache[(period, limit)] = cached
+
+    applog.debug("**DONE**", period=period)
+
+    return {
+      'statusCode': 200,
+      'headers': {'Cache-Control': 'public, max-age=' + str(max(int(cached[0] - now), 0))},
+      'body': cached[1]
+    }
+
+  except Exception as err:
+    applog.error("**ERROR**", error=str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
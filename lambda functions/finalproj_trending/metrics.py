@@ -0,0 +1,152 @@
+#
+# metrics.py
+#
+# Counters and latency histograms for the Reverb lambda functions,
+# in CloudWatch Embedded Metric Format (EMF).
+#
+# Metrics are aggregated in memory during an invocation and flushed
+# once, when it ends, as part of the invocation's log record (see
+# tracing.py), so CloudWatch extracts them from the log line we
+# already write -- no PutMetricData calls. All metrics are in the
+# "Reverb" namespace with a Route dimension:
+#
+#   Requests, Errors (5xx), ClientErrors (4xx), ColdStarts
+#   Latency                  total duration of the invocation
+#   Latency.<span>           every tracing span, e.g. Latency.db.query,
+#                            Latency.spotify.search, Latency.kms.decrypt
+#
+# plus whatever the code counts with metrics.count() (e.g. KMSCalls,
+# DBQueries) and metrics.cache() (<name>.Hits / <name>.Misses).
+#
+# install() registers the tracing hooks that do this; datatier calls
+# it, and handlers that don't use datatier call it themselves.
+#
+# If REVERB_METRICS_FILE is set, each invocation's metrics are
+# appended to that file as a JSON line instead (for local runs and
+# tests).
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory.
+#
+
+import json
+import os
+import time
+
+import tracing
+
+
+NAMESPACE = "Reverb"
+MAX_VALUES = 100    # EMF limit on values per metric
+
+#
+# per-invocation state: name -> (unit, total) and name -> (unit, [values])
+#
+_counters = {}
+_histograms = {}
+
+
+###################################################################
+#
+# recording
+#
+def count(name, value=1, unit="Count"):
+  """
+  Adds value to the counter name for this invocation.
+  """
+  (u, total) = _counters.get(name, (unit, 0))
+  _counters[name] = (u, total + value)
+
+
+def observe(name, value, unit="Milliseconds"):
+  """
+  Adds one sample to the histogram name for this invocation.
+  """
+  _histograms.setdefault(name, (unit, []))[1].append(value)
+
+
+def cache(name, hit):
+  """
+  Counts a hit or a miss of the named cache.
+  """
+  count(name + ".Hits", 1 if hit else 0)
+  count(name + ".Misses", 0 if hit else 1)
+
+
+###################################################################
+#
+# flushing
+#
+def _values(samples):
+  """
+  Rounds samples to 3 significant digits and, if there are more
+  than EMF allows, keeps an evenly spaced subset of the sorted
+  values (which preserves the percentiles).
+  """
+  samples = sorted(float("%.3g" % v) for v in samples)
+  if len(samples) > MAX_VALUES:
+    step = (len(samples) - 1) / (MAX_VALUES - 1)
+    samples = [samples[round(i * step)] for i in range(MAX_VALUES)]
+  return samples
+
+
+def document(route):
+  """
+  Returns this invocation's metrics as an EMF document.
+  """
+  definitions = []
+  doc = {"Route": route}
+
+  for (name, (unit, total)) in _counters.items():
+    definitions.append({"Name": name, "Unit": unit})
+    doc[name] = total
+
+  for (name, (unit, samples)) in _histograms.items():
+    definitions.append({"Name": name, "Unit": unit})
+    values = _values(samples)
+    doc[name] = values[0] if len(values) == 1 else values
+
+  doc["_aws"] = {
+    "Timestamp": int(time.time() * 1000),
+    "CloudWatchMetrics": [{
+      "Namespace": NAMESPACE,
+      "Dimensions": [["Route"]],
+      "Metrics": definitions,
+    }],
+  }
+  return doc
+
+
+def _on_span(name, ms):
+  observe("Latency." + name, ms)
+
+
+def _on_finish(record):
+  status = record.get("status")
+
+  count("Requests")
+  count("Errors", 1 if not isinstance(status, int) or status >= 500 else 0)
+  count("ClientErrors", 1 if isinstance(status, int) and 400 <= status < 500 else 0)
+  count("ColdStarts", 1 if record.get("cold") else 0)
+  observe("Latency", record["duration_ms"])
+
+  doc = document(record["route"])
+  _counters.clear()
+  _histograms.clear()
+
+  path = os.environ.get("REVERB_METRICS_FILE")
+  if path:
+    with open(path, "a") as f:
+      f.write(json.dumps(doc, separators=(",", ":")) + "\n")
+  else:
+    record.update(doc)
+
+
+def install():
+  """
+  Registers the hooks that record each span's latency and flush
+  the metrics when an invocation ends; calling it again does
+  nothing.
+  """
+  tracing.on_span(_on_span)
+  tracing.on_finish(_on_finish)
@@ -6,42 +6,30 @@
 #
 
 import json
-import boto3
-import os
-from base64 import b64encode
+import blindindex
+import catalog
 import datatier
+import recommend
+import applog
+import metrics
+import runtime
+import tracing
+import trending
+import usercache
+import userstats
 
-from configparser import ConfigParser
-
+@tracing.traced("/write")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: write_entry**")
-    
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'reverbapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    applog.debug("**STARTING**")
+    applog.debug("**lambda: write_entry**")
     
     #
-    # configure for RDS access
+    # open (or reuse) the connection to the database:
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    applog.debug("**Opening connection**")
     
-    #
-    # open connection to the database:
-    #
-    print("**Opening connection**")
-    
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.connection()
 
     #
     # Parse user inputs
@@ -51,10 +39,11 @@ def lambda_handler(event, context):
     username = data["username"]
     date = data["date"]
 
-    # get corresponding userid to username
-    sql1 = "SELECT userid FROM users WHERE username = %s;"
-    row = datatier.retrieve_one_row(dbConn, sql1, [username])
-    userid = row[0]
+    # get corresponding userid to username (usually cached in the container)
+    with tracing.span("userid_lookup"):
+      userid = usercache.userid(username, datatier.consistent_requested(event))
+    if userid is None:
+      raise Exception("no such user")
 
     #
     # Scenario 1: only a date is passed. That means we just want to check if it's valid
@@ -105,48 +94,101 @@ def lambda_handler(event, context):
       artist = data["artist"]
       blurb = data["blurb"]
 
-      print("**Logging entry**")
+      applog.debug("**Logging entry**", username=username, date=date)
 
       # 
       # AWS KMS Encryption: generate a encryption key to encrypt the blurb 
       #                     so that it's unreadable in the database
       #
-      kms_client = boto3.client('kms')
+      with tracing.span("kms.client"):
+        kms_client = runtime.aws_client('kms')
       key_id = 'alias/reverbapp-key'
       
       # Encrypt the blurb using the plaintext data key
-      blurb_encrypted = kms_client.encrypt(
-        KeyId=key_id,
-        Plaintext=blurb.encode('utf-8') # turn blurb into bytes array before encryption
-      )['CiphertextBlob'] # encrypted blurb
+      metrics.count("KMSCalls")
+      with tracing.span("kms.encrypt"):
+        blurb_encrypted = kms_client.encrypt(
+          KeyId=key_id,
+          Plaintext=blurb.encode('utf-8') # turn blurb into bytes array before encryption
+        )['CiphertextBlob'] # encrypted blurb
 
       # Retrieve encrypted key (CiphertextBlob) for storage (though not needed for decryption here)
-      encryptionkey = kms_client.generate_data_key(
-        KeyId=key_id,
-        KeySpec='AES_256'
-      )['CiphertextBlob']
+      metrics.count("KMSCalls")
+      with tracing.span("kms.generate_data_key"):
+        encryptionkey = kms_client.generate_data_key(
+          KeyId=key_id,
+          KeySpec='AES_256'
+        )['CiphertextBlob']
+      #
+      # keyed digests of the blurb's words, so it can be searched
+      # without decrypting it (see blindindex.py):
+      #
+      tokens = []
+      if blindindex.enabled():
+        with tracing.span("blind_index"):
+          tokens = blindindex.digests(userid, blurb)
+
       #
-      # Update entries database
+      # Update entries database; the song is stored once in the
+      # catalog and referenced by id:
       #
-      print("**Adding entry row to database**")
+      applog.debug("**Adding entry row to database**")
+
+      trackid = catalog.track_id(dbConn, song, artist)
       
       sql2 = """
-        INSERT INTO entries(userid, entrydate, songname, artist, blurb, encryptionkey)
-                    VALUES(%s, %s, %s, %s, %s, %s);
+        INSERT INTO entries(userid, entrydate, trackid, blurb, encryptionkey)
+                    VALUES(%s, %s, %s, %s, %s);
       """
-      
-      datatier.perform_action(dbConn, sql2, [userid, date, song, artist, blurb_encrypted, encryptionkey])
+
+      # the entry, its blurb tokens, the user's stats and the
+      # trending counts are written together:
+      with datatier.transaction(dbConn):
+        datatier.perform_action(dbConn, sql2, [userid, date, trackid, blurb_encrypted, encryptionkey])
+
+        #
+        # Entry upload done, return new entryid:
+        #
+        sql3 = "SELECT LAST_INSERT_ID();"
+        
+        row = datatier.retrieve_one_row(dbConn, sql3)
+        entryid = row[0]
+
+        if tokens:
+          datatier.perform_bulk_action(dbConn, """
+            INSERT INTO blurb_tokens(userid, digest, entryid) VALUES(%s, %s, %s)
+          """, [[userid, digest, entryid] for digest in tokens])
+
+        userstats.record_entry(dbConn, userid, date, trackid)
+        trending.record_entry(dbConn, date, trackid)
+
+      datatier.note_write(username)
 
       #
-      # Entry upload done, return new entryid:
+      # the new pick changes the user's recommendations; a failure
+      # here only leaves them as they were:
       #
-      sql3 = "SELECT LAST_INSERT_ID();"
-      
-      row = datatier.retrieve_one_row(dbConn, sql3)
-      entryid = row[0]
+      try:
+        recommend.update_user(dbConn, userid)
+      except Exception as err:
+        applog.warning("could not update the recommendations", error=str(err))
+
+      #
+      # look the song up on Spotify in the background, so the write
+      # doesn't wait for it (/popularity falls back to a search if
+      # this never happens):
+      #
+      resolver = runtime.config().get('spotify', 'resolver_function', fallback=None)
+      if resolver:
+        try:
+          with tracing.span("lambda.invoke"):
+            runtime.aws_client('lambda').invoke(FunctionName=resolver,
+                                                InvocationType='Event',
+                                                Payload=json.dumps({"entryid": entryid}))
+        except Exception as err:
+          applog.warning("could not start the track lookup", error=str(err))
       
-      print("entryid:", entryid)
-      print("**DONE**")
+      applog.info("**DONE**", entryid=entryid)
       
       return {
         'statusCode': 200,
@@ -155,8 +197,7 @@ def lambda_handler(event, context):
       
     
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    applog.error("**ERROR**", error=str(err))
     
     return {
       'statusCode': 500,
@@ -0,0 +1,75 @@
+#
+# runtime.py
+#
+# Per-container state shared by the Reverb lambda functions.
+#
+# Lambda reuses a container for many invocations, so anything that
+# is expensive to set up -- parsing reverbapp-config.ini, creating
+# boto3 clients -- is done once per container here and reused by
+# every later (warm) invocation, and by every route when the
+# functions are served by the router (finalproj_router).
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory.
+#
+
+import os
+
+from configparser import ConfigParser
+
+
+CONFIG_FILE = 'reverbapp-config.ini'
+
+_config = None
+_sessions = {}
+_clients = {}
+
+
+def config():
+  """
+  Returns the parsed config file (read on first use).
+  """
+  global _config
+
+  if _config is None:
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = CONFIG_FILE
+
+    configur = ConfigParser()
+    configur.read(CONFIG_FILE)
+    _config = configur
+
+  return _config
+
+
+def _session(profile):
+  import boto3
+
+  if profile is None:
+    return boto3
+  if profile not in _sessions:
+    _sessions[profile] = boto3.session.Session(profile_name=profile)
+  return _sessions[profile]
+
+
+def aws_client(service, profile=None):
+  """
+  Returns a boto3 client for the service, created on first use;
+  profile names a profile in the config file (default: the
+  function's own credentials).
+  """
+  key = ("client", service, profile)
+  if key not in _clients:
+    config()
+    _clients[key] = _session(profile).client(service)
+  return _clients[key]
+
+
+def aws_resource(service, profile=None):
+  """
+  Returns a boto3 resource for the service, created on first use.
+  """
+  key = ("resource", service, profile)
+  if key not in _clients:
+    config()
+    _clients[key] = _session(profile).resource(service)
+  return _clients[key]
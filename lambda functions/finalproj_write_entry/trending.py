@@ -0,0 +1,121 @@
+#
+# trending.py
+#
+# What Reverb users are picking lately, across all users.
+#
+# Each entry dated within the last WINDOW_DAYS days (UTC) adds one
+# to its track's and its artist's count for that day, in
+# trending_tracks and trending_artists -- one row per day and track
+# (or artist), updated by /write in the entry's transaction. A
+# period's ranking sums the days' counts with older days weighted
+# down, halving every HALF_LIFE_DAYS:
+#
+#   score(track) = sum over days d in the period of
+#                  entries(d, track) * 0.5 ** (age(d) / HALF_LIFE_DAYS)
+#
+# so /trending reads only these small tables, never the entries.
+# finalproj_refresh_trending deletes the days that left the window
+# (and can recount the window from the entries).
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import datetime
+
+import datatier
+import tracing
+
+
+PERIODS = {"day": 1, "week": 7}              # days in each period
+WINDOW_DAYS = max(PERIODS.values())          # days kept
+HALF_LIFE_DAYS = 2.0
+
+TABLES = [("trending_tracks", "trackid"), ("trending_artists", "artistid")]
+
+
+def today():
+  return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+def days(period, until=None):
+  """
+  Returns the days of the period, most recent first.
+  """
+  until = until or today()
+  return [until - datetime.timedelta(days=age) for age in range(PERIODS[period])]
+
+
+def record_entry(dbConn, entrydate, trackid):
+  """
+  Counts a new entry in its day's trending rows, if the day is in
+  the window. Runs in the caller's transaction (or its own).
+
+  Parameters
+  ----------
+  dbConn : open connection to the writer,
+  entrydate : the entry's date (YYYY-MM-DD or a date),
+  trackid : the entry's track
+  """
+  if isinstance(entrydate, str):
+    entrydate = datetime.date.fromisoformat(entrydate)
+  if not 0 <= (today() - entrydate).days < WINDOW_DAYS:
+    return
+
+  # one upsert per table (the day's row may not exist yet, or be
+  # added by another writer at the same time):
+  with tracing.span("trending.record"), datatier.transaction(dbConn):
+    datatier.perform_action(dbConn, """
+      INSERT INTO trending_tracks(entrydate, trackid, entries) VALUES(%s, %s, 1)
+      ON DUPLICATE KEY UPDATE entries = entries + 1
+    """, [entrydate, trackid])
+    datatier.perform_action(dbConn, """
+      INSERT INTO trending_artists(entrydate, artistid, entries)
+      SELECT %s, artistid, 1 FROM tracks WHERE trackid = %s
+      ON DUPLICATE KEY UPDATE entries = entries + 1
+    """, [entrydate, trackid])
+
+
+def _scored(table, column, period, limit, until):
+  """
+  Returns (sql, parameters) selecting the top (id, score, entries)
+  of the period from the table.
+  """
+  period_days = days(period, until)
+  weights = " ".join(["WHEN %s THEN %s"] * len(period_days))
+  parameters = []
+  for (age, day) in enumerate(period_days):
+    parameters += [day, 0.5 ** (age / HALF_LIFE_DAYS)]
+
+  sql = ("SELECT " + column + ", SUM(entries * CASE entrydate " + weights + " ELSE 0 END) AS score, SUM(entries) AS total"
+         + " FROM " + table + " WHERE entrydate >= %s AND entrydate <= %s"
+         + " GROUP BY " + column + " ORDER BY score DESC, " + column + " LIMIT %s")
+  return (sql, parameters + [period_days[-1], period_days[0], limit])
+
+
+def top(dbConn, period, limit, until=None):
+  """
+  Returns (songs, artists): the period's top tracks and artists,
+  highest score first, as dicts.
+  """
+  (sql, parameters) = _scored("trending_tracks", "trackid", period, limit, until)
+  songs = datatier.retrieve_all_rows(dbConn, """
+    SELECT t.name, a.name, ranked.score, ranked.total
+    FROM (""" + sql + """) ranked
+      JOIN tracks t ON t.trackid = ranked.trackid
+      JOIN artists a ON a.artistid = t.artistid
+    ORDER BY ranked.score DESC, ranked.trackid
+  """, parameters)
+
+  (sql, parameters) = _scored("trending_artists", "artistid", period, limit, until)
+  artists = datatier.retrieve_all_rows(dbConn, """
+    SELECT a.name, ranked.score, ranked.total
+    FROM (""" + sql + """) ranked
+      JOIN artists a ON a.artistid = ranked.artistid
+    ORDER BY ranked.score DESC, ranked.artistid
+  """, parameters)
+
+  return ([{'song': song, 'artist': artist, 'entries': int(total), 'score': round(float(score), 3)}
+           for (song, artist, score, total) in songs],
+          [{'artist': artist, 'entries': int(total), 'score': round(float(score), 3)}
+           for (artist, score, total) in artists])
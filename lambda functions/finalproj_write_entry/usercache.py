@@ -0,0 +1,99 @@
+#
+# usercache.py
+#
+# Per-container cache of username => (userid, pwdhash).
+#
+# Every request that touches the database starts by looking the
+# user up by name (and /write is called twice per journal entry),
+# so the lookups are cached in the container: a warm invocation for
+# a user it has seen skips the query -- and the connection check.
+#
+# The cache is bounded (least recently used entries are dropped)
+# and entries expire, since users can be created or change their
+# password from other containers:
+#
+#   REVERB_USER_CACHE_SIZE          max # of usernames (1024)
+#   REVERB_USER_CACHE_TTL           seconds a user is kept (60)
+#   REVERB_USER_CACHE_NEGATIVE_TTL  seconds an unknown username is
+#                                   remembered as unknown (5)
+#
+# A change made in this container invalidates the entry right
+# away (invalidate()), and a request that asks to read its own
+# writes (datatier.consistent_requested) bypasses the cache.
+#
+# Like datatier.py, a copy of this file lives in each function's
+# directory that uses it.
+#
+
+import collections
+import os
+import time
+
+import datatier
+import metrics
+
+
+MAX_SIZE = int(os.environ.get("REVERB_USER_CACHE_SIZE", "1024"))
+TTL = float(os.environ.get("REVERB_USER_CACHE_TTL", "60"))
+NEGATIVE_TTL = float(os.environ.get("REVERB_USER_CACHE_NEGATIVE_TTL", "5"))
+
+_MISSING = ()
+
+_entries = collections.OrderedDict()   # username => (expires, (userid, pwdhash) or _MISSING)
+
+
+def _fetch(username, consistent):
+  dbConn = datatier.reader(username, consistent)
+  sql = "SELECT userid, pwdhash FROM users WHERE username = %s;"
+  row = datatier.retrieve_one_row(dbConn, sql, [username])
+  return tuple(row) if row else _MISSING
+
+
+def lookup(username, consistent=False):
+  """
+  Returns (userid, pwdhash) for the username, or None if there is
+  no such user -- from the cache when possible, otherwise from the
+  database (datatier.reader).
+
+  Parameters
+  ----------
+  username : the username (string),
+  consistent : True to skip the cache and read from the writer
+
+  Returns
+  -------
+  (userid, pwdhash) tuple, or None
+  """
+  now = time.monotonic()
+  entry = None if consistent else _entries.get(username)
+
+  if entry is not None and entry[0] > now:
+    _entries.move_to_end(username)
+    metrics.cache("UserCache", True)
+    user = entry[1]
+  else:
+    metrics.cache("UserCache", False)
+    user = _fetch(username, consistent)
+    _entries[username] = (now + (TTL if user else NEGATIVE_TTL), user)
+    _entries.move_to_end(username)
+    while len(_entries) > MAX_SIZE:
+      _entries.popitem(last=False)
+
+  return user if user else None
+
+
+def userid(username, consistent=False):
+  """
+  Returns the userid of the username, or None if there is no such
+  user (see lookup).
+  """
+  user = lookup(username, consistent)
+  return user[0] if user else None
+
+
+def invalidate(username):
+  """
+  Drops the username from the cache; call after creating the user
+  or changing its password.
+  """
+  _entries.pop(username, None)
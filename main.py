@@ -21,9 +21,18 @@ import json
 import pathlib
 import logging
 import sys
+import os
 import time
+import random
+import argparse
+import threading
+import urllib.parse
+import urllib3
 
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 
 
 ############################################################
@@ -50,188 +59,430 @@ class Entry:
     self.encryptionkey = row[6]
 
 
+class RetryPolicy:
+  """
+  How the client retries web service calls: capped exponential
+  backoff with full jitter, honoring Retry-After, bounded by both
+  a max # of attempts and a total deadline for the whole call.
+  """
+
+  def __init__(self,
+               max_attempts=4,
+               base_delay=0.25,
+               max_delay=4.0,
+               deadline=30.0,
+               connect_timeout=3.05,
+               read_timeout=29.0,
+               retry_statuses=(429, 502, 503, 504),
+               unsafe_retry_statuses=(429,),
+               idempotent_methods=("GET", "PUT", "DELETE")):
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.deadline = deadline
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.retry_statuses = retry_statuses
+    # a 429 means API Gateway never ran the call, so it's safe
+    # to retry even if the call is not idempotent:
+    self.unsafe_retry_statuses = unsafe_retry_statuses
+    self.idempotent_methods = idempotent_methods
+
+  def should_retry(self, response, idempotent):
+    if idempotent:
+      return response.status_code in self.retry_statuses
+    return response.status_code in self.unsafe_retry_statuses
+
+  def timeout(self, remaining):
+    # never wait on a read past the overall deadline:
+    read_timeout = max(min(self.read_timeout, remaining), self.connect_timeout)
+    return (self.connect_timeout, read_timeout)
+
+  def backoff(self, attempt):
+    cap = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+    return random.uniform(0, cap)
+
+  def retry_after(self, response):
+    """
+    Returns the # of seconds the server asked us to wait via the
+    Retry-After header (either seconds or an HTTP date), or None.
+    """
+    if response is None:
+      return None
+
+    value = response.headers.get("Retry-After")
+    if not value:
+      return None
+
+    try:
+      return max(0.0, float(value))
+    except ValueError:
+      pass
+
+    try:
+      when = parsedate_to_datetime(value)
+      return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+      return None
+
+  def delay(self, attempt, response=None):
+    retry_after = self.retry_after(response)
+    if retry_after is not None:
+      return retry_after
+    return self.backoff(attempt)
+
+
+retry_policy = RetryPolicy()
+
+
 ###################################################################
 #
-# web_service_get
+# get_session
 #
-# When calling servers on a network, calls can randomly fail. 
-# The better approach is to repeat at least N times (typically 
-# N=3), and then give up after N tries.
+# Every web service call goes through one requests.Session that
+# lives as long as the client, so the TCP + TLS connection to
+# API Gateway is kept alive and reused from one call to the next
+# (e.g. the login, date check and write calls of write_entry).
 #
-def web_service_get(url):
+_session = None
+
+def get_session(pool_maxsize=4):
   """
-  Submits a GET request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
+  Returns the client's shared requests.Session, creating it on
+  first use. The session's connection pool keeps connections
+  to API Gateway open between calls.
   
   Parameters
   ----------
-  url: url for calling the web service
+  pool_maxsize: max # of keep-alive connections kept per host
   
   Returns
   -------
-  response received from web service
+  requests.Session object
   """
+  global _session
 
-  try:
-    retries = 0
+  if _session is None:
+    #
+    # we only talk to one host (API Gateway), so one pool is
+    # enough; retries are handled by web_service_*, not urllib3:
+    #
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=0)
     
-    while True:
-      response = requests.get(url)
-        
-      if response.status_code in [200, 400, 480, 481, 482, 500]:
-        #
-        # we consider this a successful call and response
-        #
-        break;
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    
+    _session = session
 
-      #
-      # failed, try again?
-      #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
-      #
-      # if get here, we tried 3 times, we give up:
-      #
-      break
+  return _session
+
+
+def close_session():
+  """
+  Closes the shared session (and its pooled connections), if
+  one was created.
+  
+  Parameters
+  ----------
+  None
+  
+  Returns
+  -------
+  nothing
+  """
+  global _session
+
+  if _session is not None:
+    _session.close()
+    _session = None
 
-    return response
 
-  except Exception as e:
-    print("**ERROR**")
-    logging.error("web_service_get() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return None
-    
 ###################################################################
 #
-# web_service_put
+# read-your-writes
 #
-# When calling servers on a network, calls can randomly fail. 
-# The better approach is to repeat at least N times (typically 
-# N=3), and then give up after N tries.
+# Reads may be served from a database read replica, which can lag
+# a few seconds behind. For a short while after the client writes
+# a user's data (a successful non-idempotent call, e.g. /user or
+# /write), its calls about that user carry the header
+# X-Reverb-Consistent so they are served from the primary and see
+# the write. Like the server's datatier.note_write, this is kept
+# per user, so a batch writing for many users at once does not
+# send every read to the primary.
 #
-def web_service_put(url, data):
+CONSISTENT_READ_WINDOW = 5.0   # seconds
+
+# routes with the username in the path, /ROUTE/{username}...:
+USER_ROUTES = ("read", "popularity", "search", "recommendations", "stats")
+
+_last_writes = {}   # username => time.monotonic() of its last write
+_last_writes_lock = threading.Lock()
+
+def request_user(url, data):
   """
-  Submits a GET request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
+  Returns the user a call is about: the "username" of its JSON
+  body (/user, /login, /write), else the path segment after one of
+  the USER_ROUTES (/read/{username}/..., /stats/{username}, ...).
   
   Parameters
   ----------
-  url: url for calling the web service
+  url: url of the call
+  data: the JSON body, or None
   
   Returns
   -------
-  response received from web service
+  username, or None if the call is not about a user (/trending)
   """
+  if isinstance(data, dict) and data.get("username"):
+    return data["username"]
+  parts = urllib.parse.urlparse(url).path.split("/")
+  for (i, part) in enumerate(parts[:-1]):
+    if part in USER_ROUTES:
+      return urllib.parse.unquote(parts[i + 1])
+  return None
 
-  try:
-    retries = 0
-    
-    while True:
-      response = requests.put(url, json=data)
-        
-      if response.status_code in [200, 400, 500]:
-        #
-        # we consider this a successful call and response
-        #
-        break;
 
-      #
-      # failed, try again?
-      #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
-      #
-      # if get here, we tried 3 times, we give up:
-      #
-      break
+def note_write(username):
+  """
+  Records that the client just wrote the user's data.
+  
+  Parameters
+  ----------
+  username: the user written, or None
+  
+  Returns
+  -------
+  nothing
+  """
+  if username is None:
+    return
+  with _last_writes_lock:
+    _last_writes[username] = time.monotonic()
 
-    return response
 
-  except Exception as e:
-    print("**ERROR**")
-    logging.error("web_service_put() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return None
+def consistency_headers(username):
+  """
+  Returns the extra headers for a call about the user:
+  X-Reverb-Consistent if the client wrote the user's data within
+  CONSISTENT_READ_WINDOW seconds.
+  
+  Parameters
+  ----------
+  username: the user the call is about, or None
+  
+  Returns
+  -------
+  dict of headers
+  """
+  with _last_writes_lock:
+    last_write = _last_writes.get(username)
+  if last_write is not None and time.monotonic() - last_write < CONSISTENT_READ_WINDOW:
+    return {"X-Reverb-Consistent": "1"}
+  return {}
+
+
+def never_sent(e):
+  """
+  Returns True if a requests exception means the request never
+  reached the server: the connection timed out, was refused, or
+  the host name did not resolve (urllib3's NewConnectionError).
+  A connection dropped after the request went out is not.
+  
+  Parameters
+  ----------
+  e: exception raised by requests
+  
+  Returns
+  -------
+  True or False
+  """
+  if isinstance(e, requests.exceptions.ConnectTimeout):
+    return True
+  if not isinstance(e, requests.exceptions.ConnectionError) or not e.args:
+    return False
+  reason = getattr(e.args[0], "reason", e.args[0])   # MaxRetryError wraps the cause
+  return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
 
 ###################################################################
 #
-# web_service_post
+# web_service_call
 #
-# When calling servers on a network, calls can randomly fail. 
-# The better approach is to repeat at least N times (typically 
-# N=3), and then give up after N tries.
+# When calling servers on a network, calls can randomly fail,
+# and API Gateway throttles us (429) when we call too quickly.
+# So we retry, following the client's RetryPolicy: exponential
+# backoff with jitter, honoring any Retry-After, and giving up
+# once the policy's total deadline is spent.
 #
-def web_service_post(url, data):
+def web_service_call(method, url, data=None, idempotent=None, policy=None):
   """
-  Submits a GET request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
+  Submits a request to a web service, retrying according to the
+  given RetryPolicy. Any status code the policy does not consider
+  transient (200, 400, 401, 404, 500, ...) is a valid response
+  and is returned right away. Transient failures (throttling,
+  gateway errors, connections that could not be made, and for
+  idempotent calls other connection and read errors) are retried until the policy runs out of attempts or time, and
+  then the last response is returned.
   
   Parameters
   ----------
+  method: "GET", "PUT" or "POST"
   url: url for calling the web service
+  data: optional data to send as the JSON body
+  idempotent: True if the call is safe to repeat; defaults to
+    True for GET and PUT, False for POST
+  policy: RetryPolicy to follow, defaults to retry_policy
   
   Returns
   -------
-  response received from web service
+  response received from web service, or None if no response
+  could be obtained
   """
 
-  try:
-    retries = 0
-    
-    while True:
-      response = requests.post(url, json=data)
-        
-      if response.status_code in [200, 400, 500]:
+  if policy is None:
+    policy = retry_policy
+
+  if idempotent is None:
+    idempotent = method in policy.idempotent_methods
+
+  username = request_user(url, data)
+
+  start = time.monotonic()
+  attempt = 0
+  headers = consistency_headers(username)
+
+  while True:
+    attempt = attempt + 1
+    remaining = policy.deadline - (time.monotonic() - start)
+
+    try:
+      response = get_session().request(method, url, json=data, headers=headers,
+                                        timeout=policy.timeout(remaining))
+
+      if not policy.should_retry(response, idempotent):
         #
         # we consider this a successful call and response
         #
-        break;
+        if not idempotent and response.status_code < 400:
+          note_write(username)
+        return response
 
+      error = None
+
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as e:
       #
-      # failed, try again?
+      # could not reach the server, or the server did not answer;
+      # a connect failure means the request was never sent, so
+      # it's always safe to retry, otherwise only if idempotent:
       #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
+      if not idempotent and not never_sent(e):
+        return web_service_failed(method, url, e)
+
+      response = None
+      error = e
+
+    except Exception as e:
+      return web_service_failed(method, url, e)
+
+    #
+    # failed, try again?
+    #
+    delay = policy.delay(attempt, response)
+    elapsed = time.monotonic() - start
+
+    if attempt >= policy.max_attempts or elapsed + delay >= policy.deadline:
       #
-      # if get here, we tried 3 times, we give up:
+      # if get here, we're out of attempts or time, we give up:
       #
-      break
+      if response is None:
+        return web_service_failed(method, url, error)
+      return response
 
-    return response
+    time.sleep(delay)
+
+
+def web_service_failed(method, url, e):
+  """
+  Logs a web service call that could not be completed.
+  
+  Parameters
+  ----------
+  method: HTTP method of the call
+  url: url of the call
+  e: the exception that ended the call
+  
+  Returns
+  -------
+  None
+  """
+  print("**ERROR**", file=sys.stderr)
+  logging.error("web_service_call() failed:")
+  logging.error(method + " url: " + url)
+  logging.error(e)
+  return None
+
+
+###################################################################
+#
+# web_service_get / put / post
+#
+def web_service_get(url, policy=None):
+  """
+  Submits a GET request to a web service, see web_service_call.
+  
+  Parameters
+  ----------
+  url: url for calling the web service
+  policy: optional RetryPolicy
+  
+  Returns
+  -------
+  response received from web service, or None
+  """
+  return web_service_call("GET", url, policy=policy)
+
+
+def web_service_put(url, data, policy=None):
+  """
+  Submits a PUT request to a web service, see web_service_call.
+  
+  Parameters
+  ----------
+  url: url for calling the web service
+  data: data to send as the JSON body
+  policy: optional RetryPolicy
+  
+  Returns
+  -------
+  response received from web service, or None
+  """
+  return web_service_call("PUT", url, data, policy=policy)
+
+
+def web_service_post(url, data, idempotent=False, policy=None):
+  """
+  Submits a POST request to a web service, see web_service_call.
+  POSTs are not retried after connection errors unless the
+  caller says the call is idempotent (e.g. /login).
+  
+  Parameters
+  ----------
+  url: url for calling the web service
+  data: data to send as the JSON body
+  idempotent: True if the call is safe to repeat
+  policy: optional RetryPolicy
+  
+  Returns
+  -------
+  response received from web service, or None
+  """
+  return web_service_call("POST", url, data, idempotent=idempotent, policy=policy)
 
-  except Exception as e:
-    print("**ERROR**")
-    logging.error("web_service_post() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return None
   
 ############################################################
 #
@@ -258,6 +509,10 @@ def prompt():
     print("   3 => read an old journal entry")
     print("   4 => get song popularity score")
     print("   5 => see upcoming concerts")
+    print("   6 => search your journal")
+    print("   7 => get song recommendations")
+    print("   8 => see your journal stats")
+    print("   9 => see what's trending")
 
     cmd = input()
 
@@ -321,6 +576,8 @@ def add_user(baseurl):
     url = baseurl + api
     
     res = web_service_post(url, data)
+    if res is None:  # no response, error already logged
+      return
 
     #
     # let's look at what we got back:
@@ -389,7 +646,9 @@ def write_entry(baseurl):
     # debug
     # print("Login URL:", login_url)
     
-    login_res = web_service_post(login_url, login_data)
+    login_res = web_service_post(login_url, login_data, idempotent=True)
+    if login_res is None:  # no response, error already logged
+      return
 
     if login_res.status_code == 200:  # Login successful
         print("Login successful! Let's get to your journal...")
@@ -413,7 +672,9 @@ def write_entry(baseurl):
       "username": username,
       "date": date
     }
-    date_check = web_service_post(url, date_data)
+    date_check = web_service_post(url, date_data, idempotent=True)
+    if date_check is None:  # no response, error already logged
+      return
     if date_check.status_code == 200:  # date is valid. proceed
         pass
     else:
@@ -438,6 +699,8 @@ def write_entry(baseurl):
     }
 
     res = web_service_post(url, data)
+    if res is None:  # no response, error already logged
+      return
     body = res.json()
     #
     # let's look at what we got back:
@@ -498,7 +761,9 @@ def read_entry(baseurl):
     }
     
     
-    login_res = web_service_post(login_url, login_data)
+    login_res = web_service_post(login_url, login_data, idempotent=True)
+    if login_res is None:  # no response, error already logged
+      return
 
     if login_res.status_code == 200:  # Login successful
         print("Login successful! Let's get to your journal...")
@@ -519,6 +784,8 @@ def read_entry(baseurl):
 
     # res = requests.get(url)
     res = web_service_get(url)
+    if res is None:  # no response, error already logged
+      return
 
     #
     # let's look at what we got back:
@@ -557,13 +824,240 @@ def read_entry(baseurl):
     logging.error(e)
     return
 
+############################################################
+#
+# search
+#
+def search(baseurl):
+  """
+  Lists the user's journal entries whose song or artist matches
+  the search, a page at a time.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+
+  try:
+    username = input("Enter username> ")
+    password = input("Enter password> ")
+
+    login_res = web_service_post(baseurl + "/login", {"username": username, "pwdhash": password}, idempotent=True)
+    if login_res is None:  # no response, error already logged
+      return
+    if login_res.status_code != 200:
+      print(login_res.json().get("message", "Login failed."))
+      return
+
+    q = input("Search for a song or artist (or press enter to skip)> ").strip()
+    text = input("Search for words in your blurbs (or press enter to skip)> ").strip()
+    cursor = None
+
+    while True:
+      query = {k: v for (k, v) in (("q", q), ("text", text)) if v}
+      if cursor:
+        query["cursor"] = cursor
+      url = baseurl + "/search/" + username + "?" + urllib.parse.urlencode(query)
+
+      res = web_service_get(url)
+      if res is None:  # no response, error already logged
+        return
+
+      body = res.json()
+      if res.status_code != 200:
+        print("Failed with status code:", res.status_code)
+        print("url: " + url)
+        if res.status_code in [400, 401]:
+          print(body["message"])
+        elif res.status_code == 500:
+          print("Error message:", body)
+        return
+
+      if not body["entries"]:
+        print("No entries found.")
+        return
+      if body["fuzzy"] and cursor is None:
+        print("No exact matches; similar songs:")
+      for entry in body["entries"]:
+        print(entry["date"] + ": \"" + entry["song"] + "\" by " + entry["artist"] + " (entry " + str(entry["entryid"]) + ")")
+        if "blurb" in entry:
+          print("  Blurb:", entry["blurb"])
+
+      cursor = body["next"]
+      if cursor is None or input("More? (y/n)> ").strip().lower() != "y":
+        return
+
+  except Exception as e:
+    logging.error("**ERROR: search() failed:")
+    logging.error(e)
+    return
+
+############################################################
+#
+# recommendations
+#
+def recommendations(baseurl):
+  """
+  Lists songs recommended to the user from their recent entries.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+
+  try:
+    username = input("Enter username> ")
+
+    url = baseurl + "/recommendations/" + username
+    res = web_service_get(url)
+    if res is None:  # no response, error already logged
+      return
+
+    body = res.json()
+    if res.status_code != 200:
+      print("Failed with status code:", res.status_code)
+      print("url: " + url)
+      if res.status_code in [400, 401]:
+        print(body["message"])
+      elif res.status_code == 500:
+        print("Error message:", body)
+      return
+
+    if not body["recommendations"]:
+      print("No recommendations yet -- keep writing entries!")
+      return
+
+    print("Songs you might like:")
+    for (i, rec) in enumerate(body["recommendations"], start=1):
+      print("  " + str(i) + ". \"" + rec["song"] + "\" by " + rec["artist"])
+
+  except Exception as e:
+    logging.error("**ERROR: recommendations() failed:")
+    logging.error(e)
+    return
+
+############################################################
+#
+# stats
+#
+def stats(baseurl):
+  """
+  Prints the user's journal statistics: entries, streaks, entries
+  per month and most picked artists.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+
+  try:
+    username = input("Enter username> ")
+
+    url = baseurl + "/stats/" + username
+    res = web_service_get(url)
+    if res is None:  # no response, error already logged
+      return
+
+    body = res.json()
+    if res.status_code != 200:
+      print("Failed with status code:", res.status_code)
+      print("url: " + url)
+      if res.status_code in [400, 401]:
+        print(body["message"])
+      elif res.status_code == 500:
+        print("Error message:", body)
+      return
+
+    if body["entries"] == 0:
+      print("No entries yet -- write your first one!")
+      return
+
+    print("Entries:", body["entries"], "(" + body["first_entry"] + " to " + body["last_entry"] + ")")
+    print("Different songs:", body["distinct_songs"], " different artists:", body["distinct_artists"])
+    print("Current streak:", body["current_streak"], "days  longest streak:", body["longest_streak"], "days")
+    print("Entries per month:")
+    for (month, count) in body["months"].items():
+      print("  " + month + ": " + str(count))
+    print("Most picked artists:")
+    for (i, artist) in enumerate(body["top_artists"], start=1):
+      print("  " + str(i) + ". " + artist["artist"] + " (" + str(artist["entries"]) + ")")
+
+  except Exception as e:
+    logging.error("**ERROR: stats() failed:")
+    logging.error(e)
+    return
+
+############################################################
+#
+# trending
+#
+def trending(baseurl):
+  """
+  Prints the songs and artists Reverb users picked the most lately.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+
+  try:
+    period = input("Today or this week? (day/week, default week)> ").strip() or "week"
+
+    url = baseurl + "/trending?" + urllib.parse.urlencode({"period": period})
+    res = web_service_get(url)
+    if res is None:  # no response, error already logged
+      return
+
+    body = res.json()
+    if res.status_code != 200:
+      print("Failed with status code:", res.status_code)
+      print("url: " + url)
+      if res.status_code == 400:
+        print(body["message"])
+      elif res.status_code == 500:
+        print("Error message:", body)
+      return
+
+    if not body["songs"]:
+      print("Nothing trending yet.")
+      return
+
+    print("Trending songs:")
+    for (i, song) in enumerate(body["songs"], start=1):
+      print("  " + str(i) + ". \"" + song["song"] + "\" by " + song["artist"] + " (" + str(song["entries"]) + ")")
+    print("Trending artists:")
+    for (i, artist) in enumerate(body["artists"], start=1):
+      print("  " + str(i) + ". " + artist["artist"] + " (" + str(artist["entries"]) + ")")
+
+  except Exception as e:
+    logging.error("**ERROR: trending() failed:")
+    logging.error(e)
+    return
+
 ############################################################
 #
 # popularity
 #
 def popularity(baseurl):
   """
-  Searches for user's most recent song of the day and gives them its popularity score.
+  Searches for user's most recent song of the day and gives them its popularity score,
+  or the scores of every song of the day in a date range.
   
   Parameters
   ----------
@@ -577,13 +1071,24 @@ def popularity(baseurl):
   try:
     print("Enter username>")
     username = input()
+    print("Enter start date (YYYY-MM-DD), or press enter for your most recent song>")
+    first = input().strip()
+    last = ""
+    if first:
+      print("Enter end date (YYYY-MM-DD), or press enter for today>")
+      last = input().strip()
     #
     # call the web service:
     #
     api = '/popularity/' + username
     url = baseurl + api
+    query = {k: v for (k, v) in (("from", first), ("to", last)) if v}
+    if query:
+      url += "?" + urllib.parse.urlencode(query)
     
     res = web_service_get(url)
+    if res is None:  # no response, error already logged
+      return
 
     #
     # let's look at what we got back:
@@ -605,6 +1110,18 @@ def popularity(baseurl):
     # success
     #
     body = res.json()
+    if "entries" in body:
+      for entry in body["entries"]:
+        score = "not on Spotify" if entry["popularity"] is None else str(entry["popularity"])
+        print(entry["date"] + ": \"" + entry['song'] + "\" by " + entry['artist'] + " -- " + score)
+      stats = body["stats"]
+      if stats["found"] == 0:
+        print("No songs of the day found on Spotify in that range.")
+        return
+      print("Average popularity: " + str(stats["mean"]) + " (min " + str(stats["min"]) + ", max " + str(stats["max"]) + ")")
+      if stats["trend"] is not None:
+        print("Trend: " + ("%+.2f" % stats["trend"]) + " points per day")
+      return
     if "artist" not in body:
       print("Your most recent song of the day was \"" + body['song'] + "\" and its popularity score on Spotify is " + str(body["popularity"]) + ".")
     else: 
@@ -642,6 +1159,8 @@ def concerts(baseurl):
     url = baseurl + api
     
     res = web_service_get(url)
+    if res is None:  # no response, error already logged
+      return
 
     #
     # let's look at what we got back:
@@ -673,6 +1192,8 @@ def concerts(baseurl):
         url = baseurl + api
         
         res = web_service_get(url)
+        if res is None:  # no response, error already logged
+          return
 
         #
         # let's look at what we got back:
@@ -710,36 +1231,30 @@ def concerts(baseurl):
     return
   
 ############################################################
-# main
 #
-try:
-  print('** Welcome to Reverb **')
-  print()
-
-  # eliminate traceback so we just get error message:
-  sys.tracebacklimit = 0
-
-  #
-  # what config file should we use for this session?
-  #
-  config_file = 'reverbapp-client-config.ini'
+# load_baseurl
+#
+def load_baseurl(config_file, out=sys.stdout):
+  """
+  Reads the web service's base URL from the given config file,
+  checking that it looks sane.
 
-  print("Config file to use for this session?")
-  print("Press ENTER to use default, or")
-  print("enter config file name>")
-  s = input()
+  Parameters
+  ----------
+  config_file: client config file name
+  out: where to print error messages
 
-  if s == "":  # use default
-    pass  # already set
-  else:
-    config_file = s
+  Returns
+  -------
+  base URL (without trailing /), or None if it's not usable
+  """
 
   #
   # does config file exist?
   #
   if not pathlib.Path(config_file).is_file():
-    print("**ERROR: config file '", config_file, "' does not exist, exiting")
-    sys.exit(0)
+    print("**ERROR: config file '", config_file, "' does not exist, exiting", file=out)
+    return None
 
   #
   # setup base URL to web service:
@@ -752,24 +1267,278 @@ try:
   # make sure baseurl does not end with /, if so remove:
   #
   if len(baseurl) < 16:
-    print("**ERROR: baseurl '", baseurl, "' is not nearly long enough...")
-    sys.exit(0)
+    print("**ERROR: baseurl '", baseurl, "' is not nearly long enough...", file=out)
+    return None
 
   if baseurl == "https://YOUR_GATEWAY_API.amazonaws.com":
-    print("**ERROR: update config file with your gateway endpoint")
-    sys.exit(0)
+    print("**ERROR: update config file with your gateway endpoint", file=out)
+    return None
 
-  if baseurl.startswith("http:"):
-    print("**ERROR: your URL starts with 'http', it should start with 'https'")
-    sys.exit(0)
+  #
+  # plain http is only ok for a local gateway (tools/local_gateway.py):
+  #
+  host = urllib.parse.urlsplit(baseurl).hostname
+  if baseurl.startswith("http:") and host not in ("localhost", "127.0.0.1", "::1"):
+    print("**ERROR: your URL starts with 'http', it should start with 'https'", file=out)
+    return None
 
   lastchar = baseurl[len(baseurl) - 1]
   if lastchar == "/":
     baseurl = baseurl[:-1]
 
+  return baseurl
+
+
+############################################################
+#
+# scripted operations
+#
+# Non-interactive versions of the commands above: each takes
+# the operation as a dict (e.g. one line of a batch file) and
+# returns the last response received, or None.
+#
+def op_add_user(baseurl, op):
+  data = {
+    "username": op["username"],
+    "pwdhash": op["password"]
+  }
+  return web_service_post(baseurl + "/user", data)
+
+
+def op_login(baseurl, op):
+  data = {
+    "username": op["username"],
+    "pwdhash": op["password"]
+  }
+  return web_service_post(baseurl + "/login", data, idempotent=True)
+
+
+def op_write(baseurl, op):
+  res = op_login(baseurl, op)
+  if res is None or res.status_code != 200:
+    return res
+
+  url = baseurl + "/write"
+
+  date_data = {
+    "username": op["username"],
+    "date": op["date"]
+  }
+  res = web_service_post(url, date_data, idempotent=True)
+  if res is None or res.status_code != 200:
+    return res
+
+  data = {
+    "username": op["username"],
+    "date": op["date"],
+    "song": op["song"],
+    "artist": op["artist"],
+    "blurb": op.get("blurb", "")
+  }
+  return web_service_post(url, data)
+
+
+def op_read(baseurl, op):
+  res = op_login(baseurl, op)
+  if res is None or res.status_code != 200:
+    return res
+
+  url = baseurl + "/read/" + op["username"] + "/" + op["date"]
+  return web_service_get(url)
+
+
+def op_popularity(baseurl, op):
+  url = baseurl + "/popularity/" + op["username"]
+  query = {k: op[k] for k in ("from", "to", "entries") if op.get(k)}
+  if query:
+    url += "?" + urllib.parse.urlencode(query)
+  return web_service_get(url)
+
+
+def op_search(baseurl, op):
+  res = op_login(baseurl, op)
+  if res is None or res.status_code != 200:
+    return res
+
+  query = {k: op[k] for k in ("q", "text", "limit", "cursor") if op.get(k)}
+  url = baseurl + "/search/" + op["username"] + "?" + urllib.parse.urlencode(query)
+  return web_service_get(url)
+
+
+def op_recommendations(baseurl, op):
+  url = baseurl + "/recommendations/" + op["username"]
+  if op.get("limit"):
+    url += "?" + urllib.parse.urlencode({"limit": op["limit"]})
+  return web_service_get(url)
+
+
+def op_stats(baseurl, op):
+  return web_service_get(baseurl + "/stats/" + op["username"])
+
+
+def op_trending(baseurl, op):
+  query = {k: op[k] for k in ("period", "limit") if op.get(k)}
+  return web_service_get(baseurl + "/trending?" + urllib.parse.urlencode(query))
+
+
+def op_concerts(baseurl, op):
   #
-  # main processing loop:
+  # /concerts-init returns the Spotify authorization link; the
+  # results of the last authorized search come from /concerts:
   #
+  if op.get("init"):
+    return web_service_get(baseurl + "/concerts-init")
+  return web_service_get(baseurl + "/concerts")
+
+
+OPERATIONS = {
+  "add-user": op_add_user,
+  "write": op_write,
+  "read": op_read,
+  "popularity": op_popularity,
+  "search": op_search,
+  "recommendations": op_recommendations,
+  "stats": op_stats,
+  "trending": op_trending,
+  "concerts": op_concerts
+}
+
+
+def run_operation(baseurl, op, include_body=True):
+  """
+  Runs one scripted operation and reports how it went.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  op: dict with an "op" key naming the operation (add-user,
+    write, read, popularity, concerts) plus its arguments
+  include_body: include the final response body in the result?
+
+  Returns
+  -------
+  dict with the operation, final status code (None if no
+  response), ok flag and latency in milliseconds
+  """
+  if not isinstance(op, dict):
+    return {"op": "", "status": None, "ok": False, "error": "not a JSON object", "latency_ms": 0.0}
+
+  name = str(op.get("op", "")).replace("_", "-")
+  result = {"op": name}
+
+  start = time.perf_counter()
+
+  try:
+    if name not in OPERATIONS:
+      raise ValueError("unknown op '" + name + "'")
+
+    res = OPERATIONS[name](baseurl, op)
+
+    result["status"] = None if res is None else res.status_code
+    result["ok"] = res is not None and res.status_code == 200
+
+    if include_body and res is not None:
+      try:
+        result["body"] = res.json()
+      except ValueError:
+        result["body"] = res.text
+
+  except Exception as e:
+    result["status"] = None
+    result["ok"] = False
+    result["error"] = str(e) if not isinstance(e, KeyError) else "missing field " + str(e)
+
+  result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+  return result
+
+
+############################################################
+#
+# run_batch
+#
+def run_batch(baseurl, batch_file, concurrency=1, include_body=False, out=sys.stdout):
+  """
+  Executes the operations in a JSONL file (one JSON object per
+  line, see run_operation), at most concurrency at a time, and
+  writes one JSON line per operation as it completes. Blank lines
+  and lines starting with # are skipped.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  batch_file: JSONL file name, or - for stdin
+  concurrency: # of operations in flight at once
+  include_body: include response bodies in the output?
+  out: where to write the JSON lines
+
+  Returns
+  -------
+  summary dict (# of operations, # ok, elapsed seconds)
+  """
+  if batch_file == "-":
+    lines = sys.stdin.readlines()
+  else:
+    with open(batch_file) as f:
+      lines = f.readlines()
+
+  ops = []
+  for lineno, line in enumerate(lines, start=1):
+    line = line.strip()
+    if line == "" or line.startswith("#"):
+      continue
+    ops.append((lineno, line))
+
+  # one keep-alive connection per worker:
+  get_session(pool_maxsize=max(concurrency, 1))
+
+  out_lock = threading.Lock()
+  summary = {"operations": 0, "ok": 0}
+
+  def execute(lineno, line):
+    try:
+      op = json.loads(line)
+      result = run_operation(baseurl, op, include_body)
+    except ValueError as e:
+      result = {"op": None, "status": None, "ok": False,
+                "error": "invalid JSON: " + str(e), "latency_ms": 0.0}
+
+    result = {"line": lineno, **result}
+
+    with out_lock:
+      summary["operations"] += 1
+      if result["ok"]:
+        summary["ok"] += 1
+      out.write(json.dumps(result) + "\n")
+      out.flush()
+
+  start = time.perf_counter()
+
+  with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+    futures = [executor.submit(execute, lineno, line) for (lineno, line) in ops]
+    for future in futures:
+      future.result()
+
+  summary["elapsed_s"] = round(time.perf_counter() - start, 3)
+  return summary
+
+
+############################################################
+#
+# interactive
+#
+def interactive(baseurl):
+  """
+  The interactive main processing loop: prompts for commands
+  until the user enters 0.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
   cmd = prompt()
 
   while cmd != 0:
@@ -783,19 +1552,178 @@ try:
       popularity(baseurl)
     elif cmd == 5:
       concerts(baseurl)
+    elif cmd == 6:
+      search(baseurl)
+    elif cmd == 7:
+      recommendations(baseurl)
+    elif cmd == 8:
+      stats(baseurl)
+    elif cmd == 9:
+      trending(baseurl)
     else:
       print("** Unknown command, try again...")
     #
     cmd = prompt()
 
-  #
-  # done
-  #
-  print()
-  print('** done **')
-  sys.exit(0)
 
-except Exception as e:
-  logging.error("**ERROR: main() failed:")
-  logging.error(e)
-  sys.exit(0)
+############################################################
+#
+# parse_args
+#
+def parse_args(argv):
+  """
+  Parses the command line. With no command, the client runs
+  interactively.
+
+  Parameters
+  ----------
+  argv: command-line arguments (without the program name)
+
+  Returns
+  -------
+  argparse.Namespace
+  """
+  parser = argparse.ArgumentParser(
+    description="Reverb client. Run without a command for the interactive prompt.")
+  parser.add_argument("--config", help="client config file (default: reverbapp-client-config.ini)")
+
+  commands = parser.add_subparsers(dest="command")
+
+  def user_args(p, password=True):
+    p.add_argument("--username", required=True)
+    if password:
+      p.add_argument("--password", default=os.environ.get("REVERB_PASSWORD"),
+                     help="defaults to $REVERB_PASSWORD")
+
+  p = commands.add_parser("add-user", help="create an account")
+  user_args(p)
+
+  p = commands.add_parser("write", help="write a song journal entry")
+  user_args(p)
+  p.add_argument("--date", required=True, help="YYYY-MM-DD")
+  p.add_argument("--song", required=True)
+  p.add_argument("--artist", required=True)
+  p.add_argument("--blurb", default="")
+
+  p = commands.add_parser("read", help="read an old journal entry")
+  user_args(p)
+  p.add_argument("--date", required=True, help="YYYY-MM-DD")
+
+  p = commands.add_parser("popularity", help="get song popularity score")
+  user_args(p, password=False)
+  p.add_argument("--from", help="YYYY-MM-DD; with --to, score every entry in the range")
+  p.add_argument("--to", help="YYYY-MM-DD")
+  p.add_argument("--entries", help="comma-separated entry ids to score")
+
+  p = commands.add_parser("search", help="search your journal by song or artist")
+  user_args(p)
+  p.add_argument("--q", help="words of the song or artist")
+  p.add_argument("--text", help="words of the blurb")
+  p.add_argument("--limit", type=int, help="entries per page (default 20)")
+  p.add_argument("--cursor", help="the \"next\" value of the previous page")
+
+  p = commands.add_parser("recommendations", help="get songs recommended from your recent entries")
+  user_args(p, password=False)
+  p.add_argument("--limit", type=int, help="# of songs (default 20)")
+
+  p = commands.add_parser("stats", help="see your journal stats")
+  user_args(p, password=False)
+
+  p = commands.add_parser("trending", help="see the songs and artists trending across Reverb")
+  p.add_argument("--period", choices=["day", "week"], help="today's picks or this week's (default week)")
+  p.add_argument("--limit", type=int, help="# of songs and of artists (default 10)")
+
+  p = commands.add_parser("concerts", help="get upcoming concerts from the last authorized search")
+  p.add_argument("--init", action="store_true", help="print the Spotify authorization link instead")
+
+  p = commands.add_parser("batch", help="run the operations in a JSONL file")
+  p.add_argument("file", help="JSONL file of operations, or - for stdin")
+  p.add_argument("--concurrency", type=int, default=1, help="# of operations in flight at once")
+  p.add_argument("--bodies", action="store_true", help="include response bodies in the output")
+
+  args = parser.parse_args(argv)
+
+  if "password" in args and args.password is None:
+    parser.error("--password (or $REVERB_PASSWORD) is required for " + args.command)
+  if args.command == "search" and not (args.q or args.text):
+    parser.error("search needs --q or --text")
+
+  return args
+
+
+############################################################
+# main
+#
+if __name__ == "__main__":
+  try:
+    args = parse_args(sys.argv[1:])
+
+    if args.command is None:
+      print('** Welcome to Reverb **')
+      print()
+
+    # eliminate traceback so we just get error message:
+    sys.tracebacklimit = 0
+
+    #
+    # what config file should we use for this session?
+    #
+    config_file = 'reverbapp-client-config.ini'
+
+    if args.config is not None:
+      config_file = args.config
+    elif args.command is None:
+      print("Config file to use for this session?")
+      print("Press ENTER to use default, or")
+      print("enter config file name>")
+      s = input()
+
+      if s == "":  # use default
+        pass  # already set
+      else:
+        config_file = s
+
+    if args.command is None:
+      baseurl = load_baseurl(config_file)
+      if baseurl is None:
+        sys.exit(0)
+
+      #
+      # main processing loop:
+      #
+      interactive(baseurl)
+
+      #
+      # done
+      #
+      close_session()
+
+      print()
+      print('** done **')
+      sys.exit(0)
+
+    #
+    # scripted: results go to stdout as JSON lines, anything
+    # else goes to stderr:
+    #
+    baseurl = load_baseurl(config_file, out=sys.stderr)
+    if baseurl is None:
+      sys.exit(2)
+
+    if args.command == "batch":
+      summary = run_batch(baseurl, args.file, args.concurrency, args.bodies)
+      print(json.dumps(summary), file=sys.stderr)
+      ok = summary["ok"] == summary["operations"]
+    else:
+      op = {"op": args.command, **vars(args)}
+      result = run_operation(baseurl, op)
+      print(json.dumps(result))
+      ok = result["ok"]
+
+    close_session()
+    sys.exit(0 if ok else 1)
+
+  except Exception as e:
+    logging.error("**ERROR: main() failed:")
+    logging.error(e)
+    sys.exit(0)
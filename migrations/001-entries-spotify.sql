@@ -0,0 +1,23 @@
+--
+-- 001: Spotify track metadata on entries.
+--
+-- Brings a database created by an earlier reverbapp-database.sql up
+-- to date (new databases already have these columns):
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/001-entries-spotify.sql
+--
+-- The columns are filled in after each write by
+-- finalproj_resolve_track, and refreshed by /popularity; entries
+-- written before this migration are resolved on their first
+-- /popularity call.
+--
+
+USE reverbapp;
+
+ALTER TABLE entries
+    ADD COLUMN spotify_trackid   varchar(64),
+    ADD COLUMN spotify_song      varchar(256),
+    ADD COLUMN spotify_artist    varchar(256),
+    ADD COLUMN popularity        int,
+    ADD COLUMN popularity_at     datetime,
+    ADD INDEX  (userid, entrydate);
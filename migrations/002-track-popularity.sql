@@ -0,0 +1,15 @@
+--
+-- 002: popularity time series, written by finalproj_refresh_popularity.
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/002-track-popularity.sql
+--
+
+USE reverbapp;
+
+CREATE TABLE IF NOT EXISTS track_popularity
+(
+    trackid           varchar(64) not null,
+    fetched_at        datetime not null,
+    popularity        int not null,
+    PRIMARY KEY (trackid, fetched_at)
+);
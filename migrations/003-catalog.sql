@@ -0,0 +1,75 @@
+--
+-- 003: song and artist catalog.
+--
+-- Moves the song and artist names out of entries into the artists
+-- and tracks tables, and points each entry at its track:
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/003-catalog.sql
+--
+-- Deploy the functions that read and write the catalog right after
+-- running it; writes made in between by the old /write fail.
+--
+
+USE reverbapp;
+
+CREATE TABLE IF NOT EXISTS artists
+(
+    artistid          int not null AUTO_INCREMENT,
+    name              varchar(256) not null,
+    namekey           varchar(256) not null,
+    spotify_artistid  varchar(64),
+    PRIMARY KEY (artistid),
+    UNIQUE      (namekey)
+);
+
+CREATE TABLE IF NOT EXISTS tracks
+(
+    trackid           int not null AUTO_INCREMENT,
+    artistid          int not null,
+    name              varchar(256) not null,
+    namekey           varchar(256) not null,
+    spotify_trackid   varchar(64),
+    PRIMARY KEY (trackid),
+    FOREIGN KEY (artistid) REFERENCES artists(artistid),
+    UNIQUE      (artistid, namekey),
+    INDEX       (spotify_trackid)
+);
+
+--
+-- backfill the catalog from the existing entries; the key is
+-- catalog.namekey(): lower case, runs of whitespace collapsed
+--
+INSERT IGNORE INTO artists(name, namekey)
+  SELECT MIN(TRIM(artist)), LOWER(TRIM(REGEXP_REPLACE(artist, '[[:space:]]+', ' '))) AS k
+  FROM entries
+  GROUP BY k;
+
+INSERT IGNORE INTO tracks(artistid, name, namekey)
+  SELECT a.artistid, MIN(TRIM(e.songname)), LOWER(TRIM(REGEXP_REPLACE(e.songname, '[[:space:]]+', ' '))) AS k
+  FROM entries e
+    JOIN artists a ON a.namekey = LOWER(TRIM(REGEXP_REPLACE(e.artist, '[[:space:]]+', ' ')))
+  GROUP BY a.artistid, k;
+
+ALTER TABLE entries ADD COLUMN trackid int AFTER entrydate;
+
+UPDATE entries e
+  JOIN artists a ON a.namekey = LOWER(TRIM(REGEXP_REPLACE(e.artist, '[[:space:]]+', ' ')))
+  JOIN tracks t ON t.artistid = a.artistid
+               AND t.namekey = LOWER(TRIM(REGEXP_REPLACE(e.songname, '[[:space:]]+', ' ')))
+SET e.trackid = t.trackid;
+
+-- songs already found on Spotify:
+UPDATE tracks t
+  JOIN entries e ON e.trackid = t.trackid
+SET t.spotify_trackid = e.spotify_trackid
+WHERE t.spotify_trackid IS NULL AND e.spotify_trackid IS NOT NULL;
+
+--
+-- and drop the names from entries
+--
+ALTER TABLE entries
+    MODIFY COLUMN trackid int not null,
+    ADD FOREIGN KEY (trackid) REFERENCES tracks(trackid),
+    ADD INDEX (trackid, entrydate),
+    DROP COLUMN songname,
+    DROP COLUMN artist;
@@ -0,0 +1,22 @@
+--
+-- 004: FULLTEXT indexes for /search (finalproj_search).
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/004-catalog-search.sql
+--
+-- The ngram parser indexes every run of ngram_token_size (default
+-- 2) characters, so a search matches words anywhere in a name,
+-- including prefixes like "phoeb".
+--
+-- The indexes are built without stopwords (read when an index is
+-- created): the ngram parser leaves out every token that contains
+-- a stopword, and InnoDB's default list has "a", "i", "in", "the",
+-- ..., so "ha" or "in" could never be found. This only needs the
+-- session setting, not a change to the DB parameter group.
+--
+
+USE reverbapp;
+
+SET SESSION innodb_ft_enable_stopword = 0;
+
+ALTER TABLE artists ADD FULLTEXT INDEX artists_name_ngram (name) WITH PARSER ngram;
+ALTER TABLE tracks ADD FULLTEXT INDEX tracks_name_ngram (name) WITH PARSER ngram;
@@ -0,0 +1,28 @@
+--
+-- 005: blind index of the blurbs, for /search?text= (see
+-- blindindex.py).
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/005-blurb-tokens.sql
+--
+-- Then put an HMAC key, encrypted with the app's KMS key, in the
+-- [blind-index] section of reverbapp-config.ini:
+--
+--   aws kms generate-data-key --key-id alias/reverbapp-key --key-spec AES_256 \
+--       --query CiphertextBlob --output text
+--
+--   [blind-index]
+--   key = <that value>
+--
+-- Entries written before the key was set are not indexed.
+--
+
+USE reverbapp;
+
+CREATE TABLE IF NOT EXISTS blurb_tokens
+(
+    userid            int not null,
+    digest            binary(16) not null,
+    entryid           int not null,
+    PRIMARY KEY (userid, digest, entryid),
+    FOREIGN KEY (entryid) REFERENCES entries(entryid)
+);
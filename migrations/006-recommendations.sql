@@ -0,0 +1,31 @@
+--
+-- 006: recommendation tables, written by
+-- finalproj_build_recommendations and /write (see recommend.py).
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/006-recommendations.sql
+--
+-- Then run finalproj_build_recommendations once (and on a
+-- schedule) to fill them in.
+--
+
+USE reverbapp;
+
+CREATE TABLE IF NOT EXISTS track_neighbors
+(
+    trackid           int not null,
+    neighbor          int not null,
+    score             float not null,
+    PRIMARY KEY (trackid, neighbor),
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid),
+    FOREIGN KEY (neighbor) REFERENCES tracks(trackid)
+);
+
+CREATE TABLE IF NOT EXISTS recommendations
+(
+    userid            int not null,
+    trackid           int not null,
+    score             float not null,
+    PRIMARY KEY (userid, trackid),
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid)
+);
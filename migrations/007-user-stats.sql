@@ -0,0 +1,49 @@
+--
+-- 007: per-user journal statistics, kept up to date by /write and
+-- served by /stats (see userstats.py).
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/007-user-stats.sql
+--
+-- Then run finalproj_rebuild_stats once to compute them for the
+-- entries already written.
+--
+
+USE reverbapp;
+
+ALTER TABLE entries ADD INDEX (userid, trackid);
+
+CREATE TABLE IF NOT EXISTS user_stats
+(
+    userid            int not null,
+    entries           int not null default 0,
+    distinct_songs    int not null default 0,
+    distinct_artists  int not null default 0,
+    first_entry       date,
+    last_entry        date,
+    current_run_start date,
+    longest_streak    int not null default 0,
+    months            json not null,
+    top_artists       json not null,
+    PRIMARY KEY (userid),
+    FOREIGN KEY (userid) REFERENCES users(userid)
+);
+
+CREATE TABLE IF NOT EXISTS user_artist_counts
+(
+    userid            int not null,
+    artistid          int not null,
+    entries           int not null,
+    PRIMARY KEY (userid, artistid),
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    FOREIGN KEY (artistid) REFERENCES artists(artistid)
+);
+
+CREATE TABLE IF NOT EXISTS user_streaks
+(
+    userid            int not null,
+    start_date        date not null,
+    end_date          date not null,
+    PRIMARY KEY (userid, start_date),
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    INDEX       (userid, end_date)
+);
@@ -0,0 +1,40 @@
+--
+-- 008: trending counts, kept up to date by /write and served by
+-- /trending (see trending.py), counted for the last 7 days of
+-- entries.
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/008-trending.sql
+--
+-- Then schedule finalproj_refresh_trending (e.g. rate(1 day)) to
+-- delete the days that leave the window.
+--
+
+USE reverbapp;
+
+CREATE TABLE IF NOT EXISTS trending_tracks
+(
+    entrydate         date not null,
+    trackid           int not null,
+    entries           int not null,
+    PRIMARY KEY (entrydate, trackid),
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid)
+);
+
+CREATE TABLE IF NOT EXISTS trending_artists
+(
+    entrydate         date not null,
+    artistid          int not null,
+    entries           int not null,
+    PRIMARY KEY (entrydate, artistid),
+    FOREIGN KEY (artistid) REFERENCES artists(artistid)
+);
+
+INSERT IGNORE INTO trending_tracks(entrydate, trackid, entries)
+  SELECT entrydate, trackid, COUNT(*) FROM entries
+  WHERE entrydate >= UTC_DATE() - INTERVAL 6 DAY AND entrydate <= UTC_DATE()
+  GROUP BY entrydate, trackid;
+
+INSERT IGNORE INTO trending_artists(entrydate, artistid, entries)
+  SELECT e.entrydate, t.artistid, COUNT(*) FROM entries e JOIN tracks t ON t.trackid = e.trackid
+  WHERE e.entrydate >= UTC_DATE() - INTERVAL 6 DAY AND e.entrydate <= UTC_DATE()
+  GROUP BY e.entrydate, t.artistid;
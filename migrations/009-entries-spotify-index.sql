@@ -0,0 +1,12 @@
+--
+-- 009: index the entries by Spotify track, for
+-- finalproj_refresh_popularity: finding the stale tracks reads the
+-- index instead of the table, and writing a track's new popularity
+-- back to its entries is an index lookup.
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/009-entries-spotify-index.sql
+--
+
+USE reverbapp;
+
+ALTER TABLE entries ADD INDEX (spotify_trackid, popularity_at);
@@ -0,0 +1,16 @@
+--
+-- 010: rebuild the /search FULLTEXT indexes without stopwords, for
+-- databases that ran 004 before it turned them off (see
+-- migrations/004-catalog-search.sql). New databases don't need it.
+--
+--   mysql -h ENDPOINT -u admin -p < migrations/010-catalog-search-stopwords.sql
+--
+
+USE reverbapp;
+
+SET SESSION innodb_ft_enable_stopword = 0;
+
+ALTER TABLE artists DROP INDEX artists_name_ngram;
+ALTER TABLE artists ADD FULLTEXT INDEX artists_name_ngram (name) WITH PARSER ngram;
+ALTER TABLE tracks DROP INDEX tracks_name_ngram;
+ALTER TABLE tracks ADD FULLTEXT INDEX tracks_name_ngram (name) WITH PARSER ngram;
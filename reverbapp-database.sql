@@ -2,8 +2,24 @@ CREATE DATABASE IF NOT EXISTS reverbapp;
 
 USE reverbapp;
 
-DROP TABLE IF EXISTS users;
+-- the FULLTEXT (ngram) indexes below are built without stopwords:
+-- the ngram parser drops every token containing one, and the
+-- default list has "a", "i", "in", "the", ...
+SET SESSION innodb_ft_enable_stopword = 0;
+
+DROP TABLE IF EXISTS track_popularity;
+DROP TABLE IF EXISTS trending_artists;
+DROP TABLE IF EXISTS trending_tracks;
+DROP TABLE IF EXISTS user_streaks;
+DROP TABLE IF EXISTS user_artist_counts;
+DROP TABLE IF EXISTS user_stats;
+DROP TABLE IF EXISTS blurb_tokens;
+DROP TABLE IF EXISTS recommendations;
+DROP TABLE IF EXISTS track_neighbors;
 DROP TABLE IF EXISTS entries;
+DROP TABLE IF EXISTS tracks;
+DROP TABLE IF EXISTS artists;
+DROP TABLE IF EXISTS users;
 
 CREATE TABLE users
 (
@@ -16,22 +32,151 @@ CREATE TABLE users
 
 ALTER TABLE users AUTO_INCREMENT = 20001;  -- starting value
 
+--
+-- the song catalog: entries reference a track, a track its artist;
+-- names are matched on namekey (lower case, whitespace collapsed)
+--
+CREATE TABLE artists
+(
+    artistid          int not null AUTO_INCREMENT,
+    name              varchar(256) not null,   -- as first written
+    namekey           varchar(256) not null,
+    spotify_artistid  varchar(64),             -- filled in by finalproj_resolve_track
+    PRIMARY KEY (artistid),
+    UNIQUE      (namekey),
+    FULLTEXT    (name) WITH PARSER ngram   -- /search
+);
+
+CREATE TABLE tracks
+(
+    trackid           int not null AUTO_INCREMENT,
+    artistid          int not null,
+    name              varchar(256) not null,   -- as first written
+    namekey           varchar(256) not null,
+    spotify_trackid   varchar(64),             -- filled in by finalproj_resolve_track
+    PRIMARY KEY (trackid),
+    FOREIGN KEY (artistid) REFERENCES artists(artistid),
+    UNIQUE      (artistid, namekey),
+    INDEX       (spotify_trackid),
+    FULLTEXT    (name) WITH PARSER ngram   -- /search
+);
+
 CREATE TABLE entries
 (
     entryid           int not null AUTO_INCREMENT,
     userid            int not null,
     entrydate         date not null, -- YYYY-MM-DD
-    songname          varchar(256) not null,
-    artist            varchar(256) not null,
+    trackid           int not null,  -- the song, in the catalog
     blurb             text not null,
     encryptionkey     varchar(256) not null,
+    spotify_trackid   varchar(64),   -- the song on Spotify, filled in after the write
+    spotify_song      varchar(256),  --   (by finalproj_resolve_track or /popularity)
+    spotify_artist    varchar(256),
+    popularity        int,           -- last known Spotify popularity, 0-100
+    popularity_at     datetime,      -- when it was fetched (UTC)
     PRIMARY KEY (entryid),
     FOREIGN KEY (userid) REFERENCES users(userid),
-    UNIQUE      (encryptionkey)
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid),
+    UNIQUE      (encryptionkey),
+    INDEX       (userid, entrydate),
+    INDEX       (userid, trackid),
+    INDEX       (trackid, entrydate),
+    INDEX       (spotify_trackid, popularity_at)   -- finalproj_refresh_popularity
 );
 
 ALTER TABLE entries AUTO_INCREMENT = 10001;  -- starting value
 
+CREATE TABLE blurb_tokens   -- blind index of the blurbs' words (see blindindex.py)
+(
+    userid            int not null,
+    digest            binary(16) not null,    -- HMAC of the userid and a word
+    entryid           int not null,
+    PRIMARY KEY (userid, digest, entryid),
+    FOREIGN KEY (entryid) REFERENCES entries(entryid)
+);
+
+CREATE TABLE track_neighbors   -- each track's most similar tracks (see recommend.py)
+(
+    trackid           int not null,
+    neighbor          int not null,
+    score             float not null,         -- similarity
+    PRIMARY KEY (trackid, neighbor),
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid),
+    FOREIGN KEY (neighbor) REFERENCES tracks(trackid)
+);
+
+CREATE TABLE recommendations   -- each user's recommended tracks
+(
+    userid            int not null,
+    trackid           int not null,
+    score             float not null,
+    PRIMARY KEY (userid, trackid),
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid)
+);
+
+CREATE TABLE user_stats   -- each user's journal statistics (see userstats.py)
+(
+    userid            int not null,
+    entries           int not null default 0,
+    distinct_songs    int not null default 0,
+    distinct_artists  int not null default 0,
+    first_entry       date,
+    last_entry        date,
+    current_run_start date,                   -- start of the run of days ending at last_entry
+    longest_streak    int not null default 0, -- days
+    months            json not null,          -- {"YYYY-MM": entries}
+    top_artists       json not null,          -- [[artistid, name, entries], ...]
+    PRIMARY KEY (userid),
+    FOREIGN KEY (userid) REFERENCES users(userid)
+);
+
+CREATE TABLE user_artist_counts   -- entries per user and artist
+(
+    userid            int not null,
+    artistid          int not null,
+    entries           int not null,
+    PRIMARY KEY (userid, artistid),
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    FOREIGN KEY (artistid) REFERENCES artists(artistid)
+);
+
+CREATE TABLE user_streaks   -- each user's runs of consecutive days with an entry
+(
+    userid            int not null,
+    start_date        date not null,
+    end_date          date not null,
+    PRIMARY KEY (userid, start_date),
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    INDEX       (userid, end_date)
+);
+
+CREATE TABLE trending_tracks   -- entries per day and track, for the last 7 days (see trending.py)
+(
+    entrydate         date not null,
+    trackid           int not null,
+    entries           int not null,
+    PRIMARY KEY (entrydate, trackid),
+    FOREIGN KEY (trackid) REFERENCES tracks(trackid)
+);
+
+CREATE TABLE trending_artists   -- entries per day and artist, for the last 7 days
+(
+    entrydate         date not null,
+    artistid          int not null,
+    entries           int not null,
+    PRIMARY KEY (entrydate, artistid),
+    FOREIGN KEY (artistid) REFERENCES artists(artistid)
+);
+
+CREATE TABLE track_popularity   -- popularity of each track over time
+(
+    trackid           varchar(64) not null,   -- Spotify track id
+    fetched_at        datetime not null,      -- UTC
+    popularity        int not null,           -- 0-100
+    PRIMARY KEY (trackid, fetched_at)
+);
+
 --
 -- Insert some users to start with:
 -- 
@@ -0,0 +1,655 @@
+#
+# benchmark.py
+#
+# Load generation and latency benchmarks for the Reverb endpoints.
+#
+# A population of synthetic users is driven through a weighted mix
+# of scenarios (sign-up, daily write, history read, popularity,
+# concerts) against a base URL -- the local gateway
+# (tools/local_gateway.py) or the real API Gateway stage. Every
+# HTTP call is timed and recorded under its route, and the run ends
+# with a JSON report of p50/p95/p99 latency, throughput and status
+# counts per route, with cold and warm invocations kept apart when
+# the server says which is which (X-Reverb-Cold-Start).
+#
+# Reports from two runs can be compared to catch regressions:
+#
+#   python tools/benchmark.py run http://127.0.0.1:8080/prod --duration 60 -o before.json
+#   python tools/benchmark.py run http://127.0.0.1:8080/prod --duration 60 -o after.json
+#   python tools/benchmark.py compare before.json after.json
+#
+# With --coldstart a run also profiles each function's cold-start
+# imports (tools/coldstart_profile.py): the run fails if a function
+# is over its budget, and compare flags import-time regressions.
+#
+# The EMF metrics the functions wrote during a run (see
+# local_gateway.py --metrics-file) can be summarized per route:
+#
+#   python tools/benchmark.py metrics metrics.jsonl
+#
+# and so can the queries they ran (local_gateway.py --query-log),
+# per statement fingerprint, slowest in total first:
+#
+#   python tools/benchmark.py queries queries.jsonl
+#
+
+import argparse
+import datetime
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+import coldstart_profile
+
+
+###################################################################
+#
+# statistics
+#
+def percentile(sorted_values, p):
+  """
+  Linear-interpolated percentile (0 <= p <= 100) of an already
+  sorted list, or None if the list is empty.
+  """
+  if not sorted_values:
+    return None
+  k = (len(sorted_values) - 1) * (p / 100.0)
+  lo = int(k)
+  hi = min(lo + 1, len(sorted_values) - 1)
+  return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, elapsed_s):
+  """
+  Summary statistics (ms) for a list of latencies.
+  """
+  values = sorted(latencies)
+  n = len(values)
+  if n == 0:
+    return {"count": 0}
+  return {
+    "count": n,
+    "throughput_rps": round(n / elapsed_s, 3) if elapsed_s > 0 else None,
+    "mean_ms": round(sum(values) / n, 3),
+    "min_ms": round(values[0], 3),
+    "p50_ms": round(percentile(values, 50), 3),
+    "p95_ms": round(percentile(values, 95), 3),
+    "p99_ms": round(percentile(values, 99), 3),
+    "max_ms": round(values[-1], 3),
+  }
+
+
+###################################################################
+#
+# recorder
+#
+class Recorder:
+  """
+  Thread-safe collection of timed calls, by route.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.calls = []
+    self.scenarios = []
+
+  def call(self, route, status, latency_ms, cold):
+    with self._lock:
+      self.calls.append((route, status, latency_ms, cold))
+
+  def scenario(self, name, ok, latency_ms):
+    with self._lock:
+      self.scenarios.append((name, ok, latency_ms))
+
+  def report(self, elapsed_s):
+    routes = {}
+    for (route, status, latency_ms, cold) in self.calls:
+      r = routes.setdefault(route, {"all": [], "warm": [], "cold": [], "unknown": [], "status": {}})
+      r["all"].append(latency_ms)
+      r["unknown" if cold is None else ("cold" if cold else "warm")].append(latency_ms)
+      key = "error" if status is None else str(status)
+      r["status"][key] = r["status"].get(key, 0) + 1
+
+    endpoints = {}
+    for (route, r) in sorted(routes.items()):
+      total = len(r["all"])
+      server_errors = sum(n for (s, n) in r["status"].items() if s == "error" or int(s) >= 500)
+      endpoints[route] = {
+        "all": summarize(r["all"], elapsed_s),
+        "warm": summarize(r["warm"], elapsed_s),
+        "cold": summarize(r["cold"], elapsed_s),
+        "unknown": summarize(r["unknown"], elapsed_s),
+        "status": r["status"],
+        "error_rate": round(server_errors / total, 4) if total else 0.0,
+      }
+
+    scenarios = {}
+    for (name, ok, latency_ms) in self.scenarios:
+      s = scenarios.setdefault(name, {"latencies": [], "ok": 0, "failed": 0})
+      s["latencies"].append(latency_ms)
+      s["ok" if ok else "failed"] += 1
+
+    return {
+      "endpoints": endpoints,
+      "scenarios": {name: {**summarize(s["latencies"], elapsed_s), "ok": s["ok"], "failed": s["failed"]}
+                    for (name, s) in sorted(scenarios.items())},
+      "totals": summarize([c[2] for c in self.calls], elapsed_s),
+    }
+
+
+###################################################################
+#
+# virtual users
+#
+class VirtualUser:
+  """
+  One synthetic user with its own keep-alive session, like one
+  client. Remembers which dates it has written so writes never
+  collide and reads hit real entries.
+  """
+
+  def __init__(self, baseurl, username, password, recorder, timeout, start_date):
+    self.baseurl = baseurl
+    self.username = username
+    self.password = password
+    self.recorder = recorder
+    self.timeout = timeout
+    self.session = requests.Session()
+    self.next_date = start_date
+    self.written = []
+    self.signed_up = False
+
+  def request(self, method, route, path, data=None):
+    start = time.perf_counter()
+    try:
+      res = self.session.request(method, self.baseurl + path, json=data, timeout=self.timeout)
+      latency_ms = (time.perf_counter() - start) * 1000
+      cold = res.headers.get("X-Reverb-Cold-Start")
+      cold = None if cold is None else cold == "true"
+      self.recorder.call(route, res.status_code, latency_ms, cold)
+      return res
+    except requests.exceptions.RequestException:
+      self.recorder.call(route, None, (time.perf_counter() - start) * 1000, None)
+      return None
+
+  def ok(self, res):
+    return res is not None and res.status_code == 200
+
+  def login(self):
+    return self.request("POST", "POST /login", "/login",
+                        {"username": self.username, "pwdhash": self.password})
+
+  #
+  # scenarios: each returns True if every call succeeded
+  #
+  def signup(self):
+    res = self.request("POST", "POST /user", "/user",
+                       {"username": self.username, "pwdhash": self.password})
+    self.signed_up = self.ok(res)
+    return self.signed_up
+
+  def daily_write(self):
+    if not self.ok(self.login()):
+      return False
+
+    date = self.next_date.isoformat()
+    self.next_date += datetime.timedelta(days=1)
+
+    res = self.request("POST", "POST /write (date check)", "/write",
+                       {"username": self.username, "date": date})
+    if not self.ok(res):
+      return False
+
+    song = random.choice(SONGS)
+    res = self.request("POST", "POST /write", "/write",
+                       {"username": self.username, "date": date,
+                        "song": song[0], "artist": song[1],
+                        "blurb": "benchmark entry " + uuid.uuid4().hex})
+    if self.ok(res):
+      self.written.append(date)
+    return self.ok(res)
+
+  def history_read(self):
+    if not self.written:
+      return self.daily_write()
+    if not self.ok(self.login()):
+      return False
+    date = random.choice(self.written)
+    return self.ok(self.request("GET", "GET /read/{username}/{date}",
+                                "/read/" + self.username + "/" + date))
+
+  def popularity(self):
+    if not self.written:
+      return self.daily_write()
+    return self.ok(self.request("GET", "GET /popularity/{username}",
+                                "/popularity/" + self.username))
+
+  def concerts(self):
+    if not self.ok(self.request("GET", "GET /concerts-init", "/concerts-init")):
+      return False
+    return self.ok(self.request("GET", "GET /concerts", "/concerts"))
+
+
+SCENARIOS = {
+  "signup": None,  # handled by the driver: brings a new user in
+  "write": VirtualUser.daily_write,
+  "read": VirtualUser.history_read,
+  "popularity": VirtualUser.popularity,
+  "concerts": VirtualUser.concerts,
+}
+
+DEFAULT_MIX = "signup=1,write=4,read=3,popularity=2,concerts=1"
+
+SONGS = [
+  ("Motion Sickness", "Phoebe Bridgers"),
+  ("Espresso", "Sabrina Carpenter"),
+  ("Birds of a Feather", "Billie Eilish"),
+  ("greedy", "Tate McRae"),
+  ("Good Luck, Babe!", "Chappell Roan"),
+  ("Cruel Summer", "Taylor Swift"),
+  ("Pink Pony Club", "Chappell Roan"),
+  ("Kyoto", "Phoebe Bridgers"),
+]
+
+
+def parse_mix(s):
+  mix = {}
+  for part in filter(None, s.split(",")):
+    (name, weight) = part.split("=")
+    name = name.strip()
+    if name not in SCENARIOS:
+      raise ValueError("unknown scenario '" + name + "', expected one of " + ", ".join(SCENARIOS))
+    mix[name] = float(weight)
+  return mix
+
+
+###################################################################
+#
+# driver
+#
+class Driver:
+  """
+  Runs the benchmark: signs up the initial population, then
+  --concurrency worker threads repeatedly pick a random user and a
+  scenario by weight until the duration or request budget is spent.
+  """
+
+  def __init__(self, args):
+    self.args = args
+    self.baseurl = args.baseurl.rstrip("/")
+    self.mix = parse_mix(args.mix)
+    self.recorder = Recorder()
+    self.run_id = uuid.uuid4().hex[:8]
+    self.users = []
+    self.idle = []
+    self._lock = threading.Lock()
+    self._user_count = 0
+    self._scenarios_left = args.scenarios
+
+  def new_user(self):
+    with self._lock:
+      self._user_count += 1
+      n = self._user_count
+    start_date = datetime.date(2000, 1, 1) + datetime.timedelta(days=random.randrange(0, 3650))
+    return VirtualUser(self.baseurl, "bench_" + self.run_id + "_" + str(n), "pw-" + self.run_id,
+                       self.recorder, self.args.timeout, start_date)
+
+  def run_scenario(self, name, user):
+    start = time.perf_counter()
+    if name == "signup":
+      ok = user.signup()
+    else:
+      ok = SCENARIOS[name](user)
+    self.recorder.scenario(name, ok, (time.perf_counter() - start) * 1000)
+    return ok
+
+  def take_turn(self):
+    """
+    Returns False when there is nothing left to do.
+    """
+    with self._lock:
+      if self._scenarios_left is not None and self._scenarios_left <= 0:
+        return False
+      user = self.idle.pop(random.randrange(len(self.idle))) if self.idle else None
+      if user is not None and self._scenarios_left is not None:
+        self._scenarios_left -= 1
+
+    if user is None:
+      # more workers than users, wait for one to be free:
+      time.sleep(0.01)
+      return True
+
+    (names, weights) = zip(*self.mix.items())
+    name = random.choices(names, weights)[0]
+
+    if name == "signup":
+      newcomer = self.new_user()
+      if self.run_scenario("signup", newcomer):
+        with self._lock:
+          self.users.append(newcomer)
+          self.idle.append(newcomer)
+    else:
+      self.run_scenario(name, user)
+
+    with self._lock:
+      self.idle.append(user)
+    return True
+
+  def worker(self, deadline):
+    while time.monotonic() < deadline:
+      if not self.take_turn():
+        return
+
+  def run(self):
+    args = self.args
+
+    #
+    # the initial population:
+    #
+    setup_start = time.perf_counter()
+    for i in range(args.users):
+      user = self.new_user()
+      if self.run_scenario("signup", user):
+        self.users.append(user)
+        self.idle.append(user)
+    if not self.users:
+      raise RuntimeError("could not sign up any users at " + self.baseurl)
+    setup_s = time.perf_counter() - setup_start
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=self.worker, args=(deadline,), daemon=True)
+               for i in range(args.concurrency)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    elapsed_s = time.perf_counter() - start
+
+    report = self.recorder.report(setup_s + elapsed_s)
+    report["meta"] = {
+      "version": git_version(),
+      "baseurl": self.baseurl,
+      "started": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+      "duration_s": round(elapsed_s, 3),
+      "setup_s": round(setup_s, 3),
+      "users": len(self.users),
+      "concurrency": args.concurrency,
+      "mix": self.mix,
+      "run_id": self.run_id,
+    }
+    return report
+
+
+def git_version():
+  try:
+    return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                          text=True, timeout=10).stdout.strip() or None
+  except (OSError, subprocess.SubprocessError):
+    return None
+
+
+###################################################################
+#
+# compare
+#
+# A route regresses when its warm (or, when the server doesn't
+# report cold starts, overall) p95 or p99 grows by more than
+# the threshold, or its error rate goes up.
+#
+def compare(before, after, threshold, min_count=20):
+  rows = []
+  regressions = []
+
+  for route in sorted(set(before["endpoints"]) | set(after["endpoints"])):
+    b = before["endpoints"].get(route)
+    a = after["endpoints"].get(route)
+    if b is None or a is None:
+      rows.append((route, "only in " + ("after" if b is None else "before"), "", "", ""))
+      continue
+
+    kind = "warm" if a["warm"]["count"] and b["warm"]["count"] else "all"
+    for stat in ("p50_ms", "p95_ms", "p99_ms"):
+      (bv, av) = (b[kind].get(stat), a[kind].get(stat))
+      if bv is None or av is None:
+        continue
+      change = (av - bv) / bv if bv > 0 else 0.0
+      rows.append((route, kind + " " + stat, "%.1f" % bv, "%.1f" % av, "%+.1f%%" % (change * 100)))
+      enough = min(a[kind]["count"], b[kind]["count"]) >= min_count
+      if stat != "p50_ms" and change > threshold and enough:
+        regressions.append(route + " " + kind + " " + stat + " %+.1f%%" % (change * 100))
+
+    if a["error_rate"] > b["error_rate"]:
+      rows.append((route, "error_rate", str(b["error_rate"]), str(a["error_rate"]), ""))
+      regressions.append(route + " error rate " + str(b["error_rate"]) + " -> " + str(a["error_rate"]))
+
+  if before.get("coldstart") and after.get("coldstart"):
+    previous = {r["function"]: r for r in before["coldstart"]["functions"]}
+    for result in after["coldstart"]["functions"]:
+      b = previous.get(result["function"], {})
+      if b.get("import_ms") is not None and result.get("import_ms") is not None:
+        change = (result["import_ms"] - b["import_ms"]) / b["import_ms"] if b["import_ms"] > 0 else 0.0
+        rows.append((result["function"], "import_ms", "%.1f" % b["import_ms"], "%.1f" % result["import_ms"],
+                     "%+.1f%%" % (change * 100)))
+      regressions += coldstart_profile.check_baseline(result, before["coldstart"], threshold, 5.0)
+
+  return (rows, regressions)
+
+
+###################################################################
+#
+# metrics
+#
+# Aggregates EMF documents (one per invocation) by route: counters
+# (unit Count) are summed, other metrics are histograms reported as
+# count / p50 / p95 / p99.
+#
+def summarize_metrics(lines):
+  routes = {}
+  for line in lines:
+    line = line.strip()
+    if not line:
+      continue
+    doc = json.loads(line)
+    if "_aws" not in doc:
+      continue
+    route = routes.setdefault(doc.get("Route", "?"), {"counters": {}, "histograms": {}})
+    for directive in doc["_aws"]["CloudWatchMetrics"]:
+      for metric in directive["Metrics"]:
+        name = metric["Name"]
+        value = doc.get(name)
+        if value is None:
+          continue
+        if metric.get("Unit") == "Count":
+          route["counters"][name] = route["counters"].get(name, 0) + value
+        else:
+          samples = route["histograms"].setdefault(name, [])
+          samples.extend(value if isinstance(value, list) else [value])
+
+  for route in routes.values():
+    for (name, values) in route["histograms"].items():
+      values.sort()
+      route["histograms"][name] = {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+      }
+  return routes
+
+
+def print_metrics(routes, out=sys.stdout):
+  for (route, m) in sorted(routes.items()):
+    print(route, file=out)
+    for (name, total) in sorted(m["counters"].items()):
+      print("  %-40s %9s" % (name, total), file=out)
+    for (name, h) in sorted(m["histograms"].items()):
+      print("  %-40s %9d %9.1f %9.1f %9.1f" % (name, h["count"], h["p50_ms"], h["p95_ms"], h["p99_ms"]), file=out)
+
+
+###################################################################
+#
+# queries
+#
+# Aggregates the per-invocation query breakdowns written by
+# datatier (REVERB_QUERY_LOG) by fingerprint: executions, time,
+# rows, the routes that ran it, and in how many invocations it
+# ran often enough to look like an N+1 pattern.
+#
+def summarize_queries(lines, n_plus_one=5):
+  queries = {}
+  for line in lines:
+    line = line.strip()
+    if not line:
+      continue
+    doc = json.loads(line)
+    for q in doc.get("queries", []):
+      s = queries.setdefault(q["fingerprint"], {"count": 0, "invocations": 0, "total_ms": 0.0,
+                                                "max_ms": 0.0, "rows": 0, "routes": set(), "n_plus_one": 0})
+      s["count"] += q["count"]
+      s["invocations"] += 1
+      s["total_ms"] += q["ms"]
+      s["max_ms"] = max(s["max_ms"], q["max_ms"])
+      s["rows"] += q["rows"]
+      s["routes"].add(doc.get("route") or "?")
+      if q["count"] >= n_plus_one:
+        s["n_plus_one"] += 1
+
+  result = []
+  for (fp, s) in queries.items():
+    s["fingerprint"] = fp
+    s["routes"] = sorted(s["routes"])
+    s["total_ms"] = round(s["total_ms"], 2)
+    s["mean_ms"] = round(s["total_ms"] / s["count"], 3)
+    s["per_invocation"] = round(s["count"] / s["invocations"], 2)
+    result.append(s)
+  result.sort(key=lambda s: -s["total_ms"])
+  return result
+
+
+def print_queries(queries, top=20, out=sys.stdout):
+  print("%9s %9s %9s %9s %7s %9s  %s" % ("total ms", "count", "mean ms", "max ms", "per inv", "rows", "query"), file=out)
+  for s in queries[:top]:
+    flag = "  **N+1 in %d invocations" % s["n_plus_one"] if s["n_plus_one"] else ""
+    print("%9.1f %9d %9.3f %9.1f %7.1f %9d  %s%s" % (s["total_ms"], s["count"], s["mean_ms"], s["max_ms"],
+          s["per_invocation"], s["rows"], s["fingerprint"][:100], flag), file=out)
+    print("%58s  %s" % ("", ", ".join(s["routes"])), file=out)
+
+
+###################################################################
+#
+# main
+#
+def print_summary(report, out=sys.stderr):
+  print("%-34s %7s %9s %9s %9s %9s %7s" % ("route", "count", "p50 ms", "p95 ms", "p99 ms", "rps", "errors"), file=out)
+  for (route, e) in report["endpoints"].items():
+    s = e["all"]
+    print("%-34s %7d %9.1f %9.1f %9.1f %9.2f %6.1f%%" % (route, s["count"], s["p50_ms"], s["p95_ms"],
+          s["p99_ms"], s["throughput_rps"] or 0, e["error_rate"] * 100), file=out)
+    for kind in ("cold", "warm"):
+      k = e[kind]
+      if k["count"] and e["cold"]["count"]:
+        print("  %-32s %7d %9.1f %9.1f %9.1f" % (kind, k["count"], k["p50_ms"], k["p95_ms"], k["p99_ms"]), file=out)
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Reverb load generator and latency benchmark.")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  p = commands.add_parser("run", help="run a benchmark against a base URL")
+  p.add_argument("baseurl", help="e.g. http://127.0.0.1:8080/prod")
+  p.add_argument("--users", type=int, default=10, help="# of users signed up before the run")
+  p.add_argument("--concurrency", type=int, default=4, help="# of scenarios in flight at once")
+  p.add_argument("--duration", type=float, default=30, help="seconds to run for")
+  p.add_argument("--scenarios", type=int, default=None, help="stop after this many scenarios")
+  p.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights, default " + DEFAULT_MIX)
+  p.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+  p.add_argument("--seed", type=int, default=None, help="random seed")
+  p.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+  p.add_argument("--coldstart", action="store_true",
+                 help="also profile the functions' cold-start imports, fail if over budget")
+  p.add_argument("--coldstart-budgets", default=str(coldstart_profile.DEFAULT_BUDGETS),
+                 help="budgets for --coldstart")
+
+  p = commands.add_parser("compare", help="compare two reports, exit 1 on regression")
+  p.add_argument("before")
+  p.add_argument("after")
+  p.add_argument("--threshold", type=float, default=0.10, help="allowed p95/p99 growth, default 0.10")
+  p.add_argument("--min-count", type=int, default=20, help="ignore routes with fewer samples")
+
+  p = commands.add_parser("metrics", help="summarize an EMF metrics file per route")
+  p.add_argument("file", help="JSON lines, e.g. from local_gateway.py --metrics-file")
+  p.add_argument("--json", action="store_true", help="print the summary as JSON")
+
+  p = commands.add_parser("queries", help="summarize a query log per statement")
+  p.add_argument("file", help="JSON lines, e.g. from local_gateway.py --query-log")
+  p.add_argument("--top", type=int, default=20, help="# of statements to print")
+  p.add_argument("--n-plus-one", type=int, default=5,
+                 help="executions per invocation that flag an N+1 pattern")
+  p.add_argument("--json", action="store_true", help="print the summary as JSON")
+
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  args = parse_args(argv)
+
+  if args.command == "compare":
+    with open(args.before) as f:
+      before = json.load(f)
+    with open(args.after) as f:
+      after = json.load(f)
+    (rows, regressions) = compare(before, after, args.threshold, args.min_count)
+    for row in rows:
+      print("%-34s %-14s %10s %10s %9s" % row)
+    for r in regressions:
+      print("**REGRESSION: " + r)
+    return 1 if regressions else 0
+
+  if args.command == "metrics":
+    with open(args.file) as f:
+      routes = summarize_metrics(f)
+    if args.json:
+      print(json.dumps(routes, indent=2))
+    else:
+      print_metrics(routes)
+    return 0
+
+  if args.command == "queries":
+    with open(args.file) as f:
+      queries = summarize_queries(f, args.n_plus_one)
+    if args.json:
+      print(json.dumps(queries, indent=2))
+    else:
+      print_queries(queries, args.top)
+    return 0
+
+  if args.seed is not None:
+    random.seed(args.seed)
+
+  report = Driver(args).run()
+  print_summary(report)
+
+  status = 0
+  if args.coldstart:
+    report["coldstart"] = coldstart_profile.run(budgets_file=args.coldstart_budgets)
+    coldstart_profile.print_report(report["coldstart"], out=sys.stderr)
+    status = 1 if report["coldstart"]["failures"] else 0
+
+  text = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(text + "\n")
+  else:
+    print(text)
+  return status
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
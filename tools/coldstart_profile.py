@@ -0,0 +1,298 @@
+#
+# coldstart_profile.py
+#
+# Cold-start import profiler and budget check for the Reverb lambda
+# functions.
+#
+# For each function, lambda_function is imported in fresh Python
+# interpreters (what Lambda does in a new container's init phase)
+# and timed:
+#
+#   init_ms     wall time of the whole process: interpreter start-up
+#               plus the import (close to Lambda's "Init Duration")
+#   import_ms   time spent importing lambda_function
+#
+# (medians over --runs runs, after one warm-up run that also
+# writes the .pyc files). One more run under -X importtime breaks
+# the import down per package -- boto3, pymysql, bcrypt, urllib3,
+# idna, ... -- by cumulative and self time.
+#
+# The numbers are checked against the budgets in
+# tools/coldstart-budgets.ini, and optionally against an earlier
+# report (--baseline); the exit code is 1 if any function is over
+# budget, regressed or failed to import:
+#
+#   python tools/coldstart_profile.py
+#   python tools/coldstart_profile.py -o before.json
+#   python tools/coldstart_profile.py --baseline before.json --threshold 0.2
+#
+# Functions are profiled from their directories in
+# "lambda functions/" by default, or from the staged builds of
+# tools/package_lambdas.py with --build build/lambda/stage.
+#
+
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+from configparser import ConfigParser
+
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+FUNCTIONS_DIR = REPO_DIR / "lambda functions"
+DEFAULT_BUDGETS = REPO_DIR / "tools" / "coldstart-budgets.ini"
+
+MARKER = "--reverb-import--"
+
+#
+# run in the fresh interpreter: argv[1] is a JSON list of paths to
+# put in front of sys.path.
+#
+IMPORT_CODE = (
+  "import json, sys, time\n"
+  "sys.path[:0] = json.loads(sys.argv[1])\n"
+  "sys.stderr.write('" + MARKER + "\\n')\n"
+  "t = time.perf_counter()\n"
+  "import lambda_function\n"
+  "print(json.dumps({'import_ms': (time.perf_counter() - t) * 1000}))\n"
+)
+
+
+###################################################################
+#
+# profiling
+#
+def run_import(func_dir, paths, importtime=False):
+  """
+  Imports lambda_function once in a fresh interpreter; returns
+  (process wall ms, import ms, stderr), or raises RuntimeError
+  with the import error.
+  """
+  cmd = [sys.executable, "-s"]
+  if importtime:
+    cmd += ["-X", "importtime"]
+  cmd += ["-c", IMPORT_CODE, json.dumps([str(p) for p in paths])]
+
+  start = time.perf_counter()
+  proc = subprocess.run(cmd, cwd=func_dir, capture_output=True, text=True)
+  wall_ms = (time.perf_counter() - start) * 1000
+
+  if proc.returncode != 0:
+    lines = [l for l in proc.stderr.strip().splitlines() if not l.startswith("import time:")]
+    raise RuntimeError(lines[-1] if lines else "exit code " + str(proc.returncode))
+
+  import_ms = json.loads(proc.stdout.strip().splitlines()[-1])["import_ms"]
+  return (wall_ms, import_ms, proc.stderr)
+
+
+def parse_importtime(stderr):
+  """
+  Parses -X importtime output (after the marker) into per-package
+  totals: {package: {"cumulative_ms", "self_ms", "modules"}}.
+  """
+  packages = {}
+  lines = stderr.split(MARKER, 1)[-1].splitlines()
+
+  for line in lines:
+    if not line.startswith("import time:") or "imported package" in line:
+      continue
+    try:
+      (self_us, cumulative_us, name) = line[len("import time:"):].split("|")
+      (self_us, cumulative_us) = (int(self_us), int(cumulative_us))
+    except ValueError:
+      continue
+
+    name = name.strip()
+    top = name.split(".")[0]
+
+    p = packages.setdefault(top, {"cumulative_ms": 0.0, "self_ms": 0.0, "modules": 0})
+    p["self_ms"] += self_us / 1000
+    p["modules"] += 1
+    # the package's own line carries the cumulative cost of importing it
+    if name == top:
+      p["cumulative_ms"] = max(p["cumulative_ms"], cumulative_us / 1000)
+
+  for p in packages.values():
+    p["cumulative_ms"] = round(p["cumulative_ms"], 2)
+    p["self_ms"] = round(p["self_ms"], 2)
+  return packages
+
+
+def profile_function(func_dir, paths=(), runs=5):
+  """
+  Profiles the import of one function's lambda_function; returns a
+  dict with init_ms, import_ms (medians), runs and the per-package
+  breakdown, or with an "error" if it does not import.
+  """
+  func_dir = pathlib.Path(func_dir)
+  paths = [func_dir] + [pathlib.Path(p) for p in paths]
+  result = {"function": func_dir.name, "path": str(func_dir)}
+
+  try:
+    run_import(func_dir, paths)   # warm-up: writes .pyc files
+    samples = [run_import(func_dir, paths) for i in range(runs)]
+    (_, _, stderr) = run_import(func_dir, paths, importtime=True)
+  except RuntimeError as err:
+    result["error"] = str(err)
+    return result
+
+  packages = parse_importtime(stderr)
+  result["runs"] = runs
+  result["init_ms"] = round(statistics.median(s[0] for s in samples), 1)
+  result["import_ms"] = round(statistics.median(s[1] for s in samples), 1)
+  result["packages"] = dict(sorted(packages.items(), key=lambda kv: -kv[1]["cumulative_ms"]))
+  return result
+
+
+###################################################################
+#
+# budgets
+#
+# [DEFAULT] applies to every function, and a [function] section
+# overrides it:
+#
+#   import_ms = 300         max median import time
+#   init_ms = 400           max median process time
+#   module.boto3 = 250      max cumulative import time of a package
+#
+def load_budgets(path):
+  configur = ConfigParser()
+  configur.read(path)
+  return configur
+
+
+def budgets_for(configur, function):
+  section = configur[function] if configur.has_section(function) else configur.defaults()
+  return {key: float(value) for (key, value) in section.items()}
+
+
+def check_budgets(result, budgets):
+  """
+  Returns the list of budget violations for one profiled function.
+  """
+  violations = []
+  for (key, limit) in budgets.items():
+    if key.startswith("module."):
+      package = result["packages"].get(key[len("module."):])
+      actual = package["cumulative_ms"] if package else None
+    else:
+      actual = result.get(key)
+    if actual is not None and actual > limit:
+      violations.append("%s %s %.1f ms > budget %.1f ms" % (result["function"], key, actual, limit))
+  return violations
+
+
+def check_baseline(result, baseline, threshold, min_delta_ms):
+  """
+  Returns regressions of import_ms / init_ms against the same
+  function in a baseline report.
+  """
+  before = {r["function"]: r for r in baseline.get("functions", [])}.get(result["function"])
+  regressions = []
+  if before is None:
+    return regressions
+
+  for key in ("import_ms", "init_ms"):
+    (b, a) = (before.get(key), result.get(key))
+    if b is None or a is None or b <= 0:
+      continue
+    if (a - b) / b > threshold and a - b > min_delta_ms:
+      regressions.append("%s %s %.1f -> %.1f ms (%+.0f%%)" % (result["function"], key, b, a, (a - b) / b * 100))
+  return regressions
+
+
+###################################################################
+#
+# run
+#
+def function_dirs(names=None, build=None):
+  root = pathlib.Path(build) if build else FUNCTIONS_DIR
+  dirs = sorted(p for p in root.iterdir() if (p / "lambda_function.py").is_file())
+  if names:
+    dirs = [p for p in dirs if p.name in set(names)]
+  return dirs
+
+
+def run(names=None, build=None, paths=(), runs=5, budgets_file=DEFAULT_BUDGETS,
+        baseline=None, threshold=0.2, min_delta_ms=5.0):
+  """
+  Profiles the functions and checks them; returns the report,
+  whose "failures" list is empty when everything passed.
+  """
+  budgets = load_budgets(budgets_file)
+  results = []
+  failures = []
+
+  for func_dir in function_dirs(names, build):
+    result = profile_function(func_dir, paths, runs)
+    results.append(result)
+
+    if "error" in result:
+      failures.append(result["function"] + " failed to import: " + result["error"])
+      continue
+    failures += check_budgets(result, budgets_for(budgets, result["function"]))
+    if baseline is not None:
+      failures += check_baseline(result, baseline, threshold, min_delta_ms)
+
+  return {
+    "python": "%d.%d.%d" % sys.version_info[:3],
+    "runs": runs,
+    "functions": results,
+    "failures": failures,
+  }
+
+
+def print_report(report, top=5, out=sys.stdout):
+  print("%-26s %10s %10s  %s" % ("function", "init ms", "import ms", "slowest packages (cumulative ms)"), file=out)
+  for r in report["functions"]:
+    if "error" in r:
+      print("%-26s %10s %10s  %s" % (r["function"], "-", "-", "import failed: " + r["error"]), file=out)
+      continue
+    packages = [(name, p) for (name, p) in r["packages"].items() if name != "lambda_function"]
+    slowest = ", ".join("%s %.1f" % (name, p["cumulative_ms"]) for (name, p) in packages[:top])
+    print("%-26s %10.1f %10.1f  %s" % (r["function"], r["init_ms"], r["import_ms"], slowest), file=out)
+  for failure in report["failures"]:
+    print("**FAIL: " + failure, file=out)
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Profile and budget-check the Reverb lambda cold-start imports.")
+  parser.add_argument("functions", nargs="*", help="functions to profile (default: all)")
+  parser.add_argument("--build", help="profile staged builds here (e.g. build/lambda/stage) instead of the sources")
+  parser.add_argument("--path", action="append", default=[],
+                      help="extra sys.path entry, e.g. a layer's python/ directory (repeatable)")
+  parser.add_argument("--runs", type=int, default=5, help="timed imports per function")
+  parser.add_argument("--budgets", default=str(DEFAULT_BUDGETS), help="budgets file")
+  parser.add_argument("--baseline", help="earlier report to check for regressions")
+  parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth over the baseline")
+  parser.add_argument("--min-delta", type=float, default=5.0, help="ignore growth below this many ms")
+  parser.add_argument("-o", "--output", help="write the JSON report here")
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  args = parse_args(argv)
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+
+  report = run(args.functions, args.build, args.path, args.runs, args.budgets,
+               baseline, args.threshold, args.min_delta)
+  print_report(report)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+      f.write("\n")
+
+  return 1 if report["failures"] else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
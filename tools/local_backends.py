@@ -0,0 +1,683 @@
+#
+# local_backends.py
+#
+# Local stand-ins for the AWS services the Reverb lambda functions
+# use, so the real handler code can run on a laptop:
+#
+#   pymysql -> a SQLite database file
+#   boto3   -> KMS and S3 implemented on the local file system
+#
+#   boto3   -> Lambda invocations of the other local functions
+#
+# install() puts stand-in "pymysql" / "boto3" modules into
+# sys.modules before the handlers are imported; services that are
+# not replaced are passed through to the real boto3. Every
+# stand-in call can be given a simulated latency so timings are
+# closer to what the handlers see in AWS.
+#
+
+import hashlib
+import hmac
+import io
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+import threading
+import time
+import types
+import datetime
+
+
+###################################################################
+#
+# latency
+#
+# Simulated per-call latency in milliseconds, by service name
+# ("db", "kms", "s3").
+#
+latency_ms = {}
+
+def simulate_latency(service):
+  ms = latency_ms.get(service, 0)
+  if ms > 0:
+    time.sleep(ms / 1000.0)
+
+
+###################################################################
+#
+# SQLite stand-in for pymysql
+#
+# The schema mirrors reverbapp-database.sql, including the seed
+# users and the AUTO_INCREMENT starting values.
+#
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users
+(
+    userid       INTEGER PRIMARY KEY AUTOINCREMENT,
+    username     TEXT NOT NULL UNIQUE,
+    pwdhash      TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS artists
+(
+    artistid          INTEGER PRIMARY KEY AUTOINCREMENT,
+    name              TEXT NOT NULL,
+    namekey           TEXT NOT NULL UNIQUE,
+    spotify_artistid  TEXT
+);
+
+CREATE TABLE IF NOT EXISTS tracks
+(
+    trackid           INTEGER PRIMARY KEY AUTOINCREMENT,
+    artistid          INTEGER NOT NULL REFERENCES artists(artistid),
+    name              TEXT NOT NULL,
+    namekey           TEXT NOT NULL,
+    spotify_trackid   TEXT,
+    UNIQUE (artistid, namekey)
+);
+
+CREATE INDEX IF NOT EXISTS tracks_spotify_trackid ON tracks(spotify_trackid);
+
+CREATE TABLE IF NOT EXISTS entries
+(
+    entryid           INTEGER PRIMARY KEY AUTOINCREMENT,
+    userid            INTEGER NOT NULL REFERENCES users(userid),
+    entrydate         DATE NOT NULL,
+    trackid           INTEGER NOT NULL REFERENCES tracks(trackid),
+    blurb             BLOB NOT NULL,
+    encryptionkey     BLOB NOT NULL UNIQUE,
+    spotify_trackid   TEXT,
+    spotify_song      TEXT,
+    spotify_artist    TEXT,
+    popularity        INTEGER,
+    popularity_at     DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS entries_userid_entrydate ON entries(userid, entrydate);
+CREATE INDEX IF NOT EXISTS entries_userid_trackid ON entries(userid, trackid);
+CREATE INDEX IF NOT EXISTS entries_trackid_entrydate ON entries(trackid, entrydate);
+CREATE INDEX IF NOT EXISTS entries_spotify_trackid_popularity_at ON entries(spotify_trackid, popularity_at);
+
+CREATE TABLE IF NOT EXISTS blurb_tokens
+(
+    userid            INTEGER NOT NULL,
+    digest            BLOB NOT NULL,
+    entryid           INTEGER NOT NULL REFERENCES entries(entryid),
+    PRIMARY KEY (userid, digest, entryid)
+);
+
+CREATE TABLE IF NOT EXISTS track_neighbors
+(
+    trackid           INTEGER NOT NULL REFERENCES tracks(trackid),
+    neighbor          INTEGER NOT NULL REFERENCES tracks(trackid),
+    score             REAL NOT NULL,
+    PRIMARY KEY (trackid, neighbor)
+);
+
+CREATE TABLE IF NOT EXISTS recommendations
+(
+    userid            INTEGER NOT NULL REFERENCES users(userid),
+    trackid           INTEGER NOT NULL REFERENCES tracks(trackid),
+    score             REAL NOT NULL,
+    PRIMARY KEY (userid, trackid)
+);
+
+CREATE TABLE IF NOT EXISTS user_stats
+(
+    userid            INTEGER PRIMARY KEY REFERENCES users(userid),
+    entries           INTEGER NOT NULL DEFAULT 0,
+    distinct_songs    INTEGER NOT NULL DEFAULT 0,
+    distinct_artists  INTEGER NOT NULL DEFAULT 0,
+    first_entry       DATE,
+    last_entry        DATE,
+    current_run_start DATE,
+    longest_streak    INTEGER NOT NULL DEFAULT 0,
+    months            TEXT NOT NULL,
+    top_artists       TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user_artist_counts
+(
+    userid            INTEGER NOT NULL REFERENCES users(userid),
+    artistid          INTEGER NOT NULL REFERENCES artists(artistid),
+    entries           INTEGER NOT NULL,
+    PRIMARY KEY (userid, artistid)
+);
+
+CREATE TABLE IF NOT EXISTS user_streaks
+(
+    userid            INTEGER NOT NULL REFERENCES users(userid),
+    start_date        DATE NOT NULL,
+    end_date          DATE NOT NULL,
+    PRIMARY KEY (userid, start_date)
+);
+
+CREATE INDEX IF NOT EXISTS user_streaks_userid_end_date ON user_streaks(userid, end_date);
+
+CREATE TABLE IF NOT EXISTS trending_tracks
+(
+    entrydate         DATE NOT NULL,
+    trackid           INTEGER NOT NULL REFERENCES tracks(trackid),
+    entries           INTEGER NOT NULL,
+    PRIMARY KEY (entrydate, trackid)
+);
+
+CREATE TABLE IF NOT EXISTS trending_artists
+(
+    entrydate         DATE NOT NULL,
+    artistid          INTEGER NOT NULL REFERENCES artists(artistid),
+    entries           INTEGER NOT NULL,
+    PRIMARY KEY (entrydate, artistid)
+);
+
+CREATE TABLE IF NOT EXISTS track_popularity
+(
+    trackid           TEXT NOT NULL,
+    fetched_at        DATETIME NOT NULL,
+    popularity        INTEGER NOT NULL,
+    PRIMARY KEY (trackid, fetched_at)
+);
+"""
+
+#
+# columns added to existing tables since the schema was first
+# created, so older local database files are brought up to date
+# (table, column, declaration):
+#
+ADDED_COLUMNS = [
+  ("entries", "spotify_trackid", "TEXT"),
+  ("entries", "spotify_song", "TEXT"),
+  ("entries", "spotify_artist", "TEXT"),
+  ("entries", "popularity", "INTEGER"),
+  ("entries", "popularity_at", "DATETIME"),
+  ("entries", "trackid", "INTEGER"),
+]
+
+#
+# migrations/003-catalog.sql for older local database files, whose
+# entries still carry the song and artist names:
+#
+CATALOG_BACKFILL = """
+INSERT OR IGNORE INTO artists(name, namekey)
+  SELECT MIN(TRIM(artist)), namekey(artist) FROM entries GROUP BY namekey(artist);
+
+INSERT OR IGNORE INTO tracks(artistid, name, namekey)
+  SELECT a.artistid, MIN(TRIM(e.songname)), namekey(e.songname)
+  FROM entries e JOIN artists a ON a.namekey = namekey(e.artist)
+  GROUP BY a.artistid, namekey(e.songname);
+
+UPDATE entries SET trackid =
+  (SELECT t.trackid FROM tracks t JOIN artists a ON a.artistid = t.artistid
+   WHERE a.namekey = namekey(entries.artist) AND t.namekey = namekey(entries.songname));
+
+UPDATE tracks SET spotify_trackid =
+  (SELECT MAX(e.spotify_trackid) FROM entries e WHERE e.trackid = tracks.trackid)
+WHERE spotify_trackid IS NULL;
+
+ALTER TABLE entries DROP COLUMN songname;
+ALTER TABLE entries DROP COLUMN artist;
+"""
+
+def migrate_catalog(conn):
+  columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)")]
+  if "songname" in columns:
+    conn.create_function("namekey", 1, lambda name: " ".join(name.lower().split()))
+    conn.executescript(CATALOG_BACKFILL)
+
+SEED = """
+INSERT INTO sqlite_sequence(name, seq) VALUES('users', 20000);
+INSERT INTO sqlite_sequence(name, seq) VALUES('entries', 10000);
+
+INSERT INTO users(username, pwdhash)  -- pwd = abc123!!
+            values('p_sarkar', '$2y$10$/8B5evVyaHF.hxVx0i6dUe2JpW89EZno/VISnsiD1xSh6ZQsNMtXK');
+
+INSERT INTO users(username, pwdhash)  -- pwd = abc456!!
+            values('e_ricci', '$2y$10$F.FBSF4zlas/RpHAxqsuF.YbryKNr53AcKBR3CbP2KsgZyMxOI2z2');
+
+INSERT INTO users(username, pwdhash)  -- pwd = abc789!!
+            values('l_chen', '$2y$10$GmIzRsGKP7bd9MqH.mErmuKvZQ013kPfkKbeUAHxar5bn1vu9.sdK');
+"""
+
+#
+# MySQL-isms used by the handlers, and their SQLite equivalents:
+#
+TRANSLATIONS = [
+  (re.compile(r"LAST_INSERT_ID\(\)", re.IGNORECASE), "last_insert_rowid()"),
+  (re.compile(r"\bINSERT\s+IGNORE\b", re.IGNORECASE), "INSERT OR IGNORE"),
+  (re.compile(r"^\s*EXPLAIN\s", re.IGNORECASE), "EXPLAIN QUERY PLAN "),
+  (re.compile(r"\s+FOR\s+UPDATE\b", re.IGNORECASE), ""),   # writes are serialized anyway
+  (re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.IGNORECASE), "ON CONFLICT DO UPDATE SET"),
+  (re.compile(r"MATCH\s*\(([\w.]+)\)\s*AGAINST\s*\(\s*%s\s+IN\s+BOOLEAN\s+MODE\s*\)", re.IGNORECASE),
+   r"fulltext_match(\1, %s)"),
+  (re.compile(r"%s"), "?"),
+]
+
+def translate(sql):
+  for (pattern, replacement) in TRANSLATIONS:
+    sql = pattern.sub(replacement, sql)
+  return sql
+
+
+BOOLEAN_TERM = re.compile(r'\+"([^"]*)"|\+(\S+)')
+
+def fulltext_match(text, query):
+  """
+  MATCH(column) AGAINST(query IN BOOLEAN MODE) on a FULLTEXT index
+  built WITH PARSER ngram, for the +"term" queries the handlers
+  send: true when every term occurs in the text (case and runs of
+  whitespace ignored). Evaluated row by row -- the stand-in has no
+  index, which is fine for a local database.
+  """
+  text = " ".join(str(text).lower().split())
+  terms = [quoted or bare for (quoted, bare) in BOOLEAN_TERM.findall(query)]
+  return int(bool(terms) and all(" ".join(t.lower().split()) in text for t in terms))
+
+
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" "))
+sqlite3.register_converter("DATE", lambda b: datetime.date.fromisoformat(b.decode()))
+sqlite3.register_converter("DATETIME", lambda b: datetime.datetime.fromisoformat(b.decode()))
+
+
+class SqliteCursor:
+
+  def __init__(self, conn):
+    self._cursor = conn.cursor()
+
+  @property
+  def rowcount(self):
+    return self._cursor.rowcount
+
+  @property
+  def lastrowid(self):
+    return self._cursor.lastrowid
+
+  @property
+  def description(self):
+    return self._cursor.description
+
+  def execute(self, sql, parameters=None):
+    simulate_latency("db")
+    self._cursor.execute(translate(sql), tuple(parameters or ()))
+    return self._cursor.rowcount
+
+  def executemany(self, sql, seq_of_parameters):
+    simulate_latency("db")
+    self._cursor.executemany(translate(sql), [tuple(p) for p in seq_of_parameters])
+    return self._cursor.rowcount
+
+  def fetchone(self):
+    return self._cursor.fetchone()
+
+  def fetchmany(self, size=1):
+    return self._cursor.fetchmany(size)
+
+  def fetchall(self):
+    return tuple(self._cursor.fetchall())
+
+  def __iter__(self):
+    return iter(self._cursor)
+
+  def close(self):
+    self._cursor.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class SqliteConnection:
+
+  def __init__(self, path, read_only=False):
+    self._conn = sqlite3.connect(path,
+                                 timeout=30,
+                                 isolation_level="DEFERRED",
+                                 detect_types=sqlite3.PARSE_DECLTYPES,
+                                 check_same_thread=False)
+    self._conn.create_function("fulltext_match", 2, fulltext_match, deterministic=True)
+    if read_only:
+      self._conn.execute("PRAGMA query_only = ON")
+    self.open = True
+
+  def cursor(self, cursor=None):
+    return SqliteCursor(self._conn)
+
+  def begin(self):
+    if not self._conn.in_transaction:
+      self._conn.execute("BEGIN")
+
+  def commit(self):
+    self._conn.commit()
+
+  def rollback(self):
+    self._conn.rollback()
+
+  def ping(self, reconnect=True):
+    return True
+
+  def autocommit(self, value):
+    self._conn.isolation_level = None if value else "DEFERRED"
+
+  def close(self):
+    self._conn.close()
+    self.open = False
+
+
+class SqliteDatabase:
+  """
+  Owns the SQLite file, and hands out pymysql-like connections.
+  """
+
+  def __init__(self, path):
+    self.path = str(path)
+    self._lock = threading.Lock()
+    self._ready = False
+
+  def setup(self):
+    with self._lock:
+      if self._ready:
+        return
+
+      conn = sqlite3.connect(self.path)
+      try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        new = conn.execute("SELECT name FROM sqlite_master WHERE name = 'users'").fetchone() is None
+        for (table, column, declaration) in ADDED_COLUMNS:
+          columns = [row[1] for row in conn.execute("PRAGMA table_info(" + table + ")")]
+          if columns and column not in columns:
+            conn.execute("ALTER TABLE " + table + " ADD COLUMN " + column + " " + declaration)
+        conn.executescript(SCHEMA)
+        migrate_catalog(conn)
+        if new:
+          conn.executescript(SEED)
+        conn.commit()
+      finally:
+        conn.close()
+
+      self._ready = True
+
+  def connect(self, host=None, port=None, user=None, passwd=None, database=None, **kwargs):
+    """
+    Like MySQL's grants, the read-only account (reverbapp-read-only)
+    gets a connection that fails on writes.
+    """
+    self.setup()
+    return SqliteConnection(self.path, read_only=bool(user) and "read-only" in user)
+
+
+def make_pymysql(db):
+  """
+  Builds a stand-in "pymysql" module whose connect() opens the
+  given SqliteDatabase.
+  """
+  module = types.ModuleType("pymysql")
+  module.__file__ = __file__
+  module.connect = db.connect
+  module.Connect = db.connect
+
+  cursors = types.ModuleType("pymysql.cursors")
+  cursors.Cursor = SqliteCursor
+  cursors.SSCursor = SqliteCursor
+  module.cursors = cursors
+
+  return module
+
+
+###################################################################
+#
+# Lambda stand-in
+#
+# invoke() runs another local function through the given
+# invoke(function name, event) callback -- the gateway's simulated
+# runtime: InvocationType=Event in a background thread (the caller
+# gets 202 right away), RequestResponse synchronously.
+#
+class LocalLambda:
+
+  def __init__(self, invoke):
+    self._invoke = invoke
+
+  def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"{}", **kwargs):
+    name = FunctionName.split(":")[-1] if FunctionName.startswith("arn:") else FunctionName
+    event = json.loads(Payload or b"{}")
+
+    if InvocationType == "Event":
+      threading.Thread(target=self._invoke, args=(name, event), daemon=True).start()
+      return {"StatusCode": 202, "Payload": io.BytesIO(b"")}
+
+    result = self._invoke(name, event)
+    return {"StatusCode": 200, "Payload": io.BytesIO(json.dumps(result).encode())}
+
+
+###################################################################
+#
+# KMS stand-in
+#
+# Ciphertext blobs are self-describing (key id + nonce + data +
+# MAC), encrypted with a keystream derived from a local master
+# key. Not meant to be strong crypto, only to behave like KMS:
+# ciphertexts are opaque, unique, and decrypt without a KeyId.
+#
+class LocalKMS:
+
+  MAGIC = b"LKMS1"
+
+  def __init__(self, master_key):
+    self.master_key = master_key
+
+  def _keystream(self, nonce, n):
+    out = b""
+    counter = 0
+    while len(out) < n:
+      out += hashlib.sha256(self.master_key + nonce + counter.to_bytes(4, "big")).digest()
+      counter += 1
+    return out[:n]
+
+  def _seal(self, key_id, plaintext):
+    simulate_latency("kms")
+    key_id = key_id.encode()
+    nonce = os.urandom(16)
+    data = bytes(a ^ b for (a, b) in zip(plaintext, self._keystream(nonce, len(plaintext))))
+    blob = self.MAGIC + bytes([len(key_id)]) + key_id + nonce + data
+    return blob + hmac.new(self.master_key, blob, hashlib.sha256).digest()[:16]
+
+  def encrypt(self, KeyId, Plaintext, **kwargs):
+    return {"CiphertextBlob": self._seal(KeyId, Plaintext), "KeyId": KeyId}
+
+  def generate_data_key(self, KeyId, KeySpec="AES_256", NumberOfBytes=None, **kwargs):
+    n = NumberOfBytes or (16 if KeySpec == "AES_128" else 32)
+    plaintext = os.urandom(n)
+    return {"CiphertextBlob": self._seal(KeyId, plaintext), "Plaintext": plaintext, "KeyId": KeyId}
+
+  def decrypt(self, CiphertextBlob, **kwargs):
+    simulate_latency("kms")
+    blob = bytes(CiphertextBlob)
+    (body, tag) = (blob[:-16], blob[-16:])
+
+    if not blob.startswith(self.MAGIC) or \
+       not hmac.compare_digest(tag, hmac.new(self.master_key, body, hashlib.sha256).digest()[:16]):
+      raise LocalServiceError("InvalidCiphertextException", "kms.decrypt: invalid ciphertext")
+
+    n = body[len(self.MAGIC)]
+    start = len(self.MAGIC) + 1
+    key_id = body[start:start + n].decode()
+    nonce = body[start + n:start + n + 16]
+    data = body[start + n + 16:]
+    plaintext = bytes(a ^ b for (a, b) in zip(data, self._keystream(nonce, len(data))))
+    return {"Plaintext": plaintext, "KeyId": key_id}
+
+
+###################################################################
+#
+# S3 stand-in
+#
+# Objects are files under <root>/<bucket>/<key>.
+#
+class LocalServiceError(Exception):
+
+  def __init__(self, code, message):
+    super().__init__(message)
+    self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class LocalS3Object:
+
+  def __init__(self, root, bucket_name, key):
+    self.bucket_name = bucket_name
+    self.key = key
+    self._path = pathlib.Path(root) / bucket_name / key
+
+  def put(self, Body=b"", ContentType="binary/octet-stream", **kwargs):
+    simulate_latency("s3")
+    if isinstance(Body, str):
+      Body = Body.encode("utf-8")
+    elif hasattr(Body, "read"):
+      Body = Body.read()
+    self._path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self._path.with_name(self._path.name + ".tmp")
+    tmp.write_bytes(Body)
+    os.replace(tmp, self._path)
+    return {"ETag": '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+  def get(self, **kwargs):
+    simulate_latency("s3")
+    if not self._path.is_file():
+      raise LocalServiceError("NoSuchKey", "s3.get: no such key " + self.bucket_name + "/" + self.key)
+    data = self._path.read_bytes()
+    return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+
+class LocalS3:
+
+  def __init__(self, root):
+    self.root = root
+
+  def Object(self, bucket_name, key):
+    return LocalS3Object(self.root, bucket_name, key)
+
+
+###################################################################
+#
+# boto3 stand-in
+#
+def make_boto3(clients, resources):
+  """
+  Builds a stand-in "boto3" module: client(name) / resource(name)
+  return the local stand-in when there is one, and otherwise fall
+  through to the real boto3 (imported lazily).
+  """
+  module = types.ModuleType("boto3")
+  module.__file__ = __file__
+
+  def real_boto3():
+    saved = sys.modules.pop("boto3")
+    try:
+      import boto3 as real
+      return real
+    finally:
+      sys.modules["boto3"] = saved
+
+  def client(service_name, *args, **kwargs):
+    if service_name in clients:
+      return clients[service_name]
+    return real_boto3().client(service_name, *args, **kwargs)
+
+  def resource(service_name, *args, **kwargs):
+    if service_name in resources:
+      return resources[service_name]
+    return real_boto3().resource(service_name, *args, **kwargs)
+
+  def setup_default_session(**kwargs):
+    # the handlers only set up a session (with an S3 profile) to
+    # talk to S3, which needs no session when it's local:
+    if "s3" not in resources:
+      real_boto3().setup_default_session(**kwargs)
+
+  class Session:
+    # a session for a named profile: the stand-ins don't care
+    # about credentials, real services get a real session
+
+    def __init__(self, **kwargs):
+      self._kwargs = kwargs
+      self._real = None
+
+    def real(self):
+      if self._real is None:
+        self._real = real_boto3().session.Session(**self._kwargs)
+      return self._real
+
+    def client(self, service_name, *args, **kwargs):
+      if service_name in clients:
+        return clients[service_name]
+      return self.real().client(service_name, *args, **kwargs)
+
+    def resource(self, service_name, *args, **kwargs):
+      if service_name in resources:
+        return resources[service_name]
+      return self.real().resource(service_name, *args, **kwargs)
+
+  module.client = client
+  module.resource = resource
+  module.setup_default_session = setup_default_session
+  module.session = types.SimpleNamespace(Session=Session)
+  return module
+
+
+###################################################################
+#
+# install
+#
+def install(state_dir, db="sqlite", kms="local", s3="local", latency=None, invoke=None):
+  """
+  Installs the chosen stand-ins into sys.modules. Must be called
+  before any handler is imported.
+
+  Parameters
+  ----------
+  state_dir: directory for the SQLite file, S3 objects and KMS key
+  db: "sqlite" for the local stand-in, "mysql" for real pymysql
+  kms: "local" or "aws"
+  s3: "local" or "aws"
+  latency: optional dict of simulated per-call latency in ms
+  invoke: optional invoke(function name, event) callback that runs
+    a local function, for a stand-in Lambda client
+
+  Returns
+  -------
+  dict of the stand-ins that were installed, by service name
+  """
+  state_dir = pathlib.Path(state_dir)
+  state_dir.mkdir(parents=True, exist_ok=True)
+
+  latency_ms.update(latency or {})
+  installed = {}
+
+  if db == "sqlite":
+    installed["db"] = SqliteDatabase(state_dir / "reverbapp.sqlite3")
+    installed["db"].setup()
+    sys.modules["pymysql"] = make_pymysql(installed["db"])
+
+  clients = {}
+  resources = {}
+
+  if kms == "local":
+    key_file = state_dir / "kms-master.key"
+    if not key_file.is_file():
+      key_file.write_bytes(os.urandom(32))
+    clients["kms"] = installed["kms"] = LocalKMS(key_file.read_bytes())
+
+  if s3 == "local":
+    resources["s3"] = installed["s3"] = LocalS3(state_dir / "s3")
+
+  if invoke is not None:
+    clients["lambda"] = installed["lambda"] = LocalLambda(invoke)
+
+  if clients or resources:
+    sys.modules["boto3"] = make_boto3(clients, resources)
+
+  return installed
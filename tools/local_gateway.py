@@ -0,0 +1,636 @@
+#
+# local_gateway.py
+#
+# Runs the Reverb backend on a laptop: a local HTTP server that
+# plays the role of API Gateway, routing each request to the real
+# lambda_handler of the matching function in "lambda functions/"
+# with an API Gateway (REST, proxy integration) event.
+#
+# Each function gets a pool of simulated Lambda containers. A
+# request that finds no idle container starts a new one, which
+# imports the function's code from scratch (a cold start); later
+# requests reuse idle containers (warm starts) until they have
+# been idle for --idle-timeout seconds. Responses carry
+# X-Reverb-Cold-Start / X-Reverb-Init-Duration-Ms /
+# X-Reverb-Duration-Ms headers so clients can tell the two apart.
+#
+# MySQL, S3 and KMS are replaced by the stand-ins in
+# local_backends.py unless told otherwise, e.g.
+#
+#   python tools/local_gateway.py --port 8080
+#   python tools/local_gateway.py --db mysql --kms aws --s3 aws
+#
+# With --router every route goes to the single router function
+# (finalproj_router) instead, as when it is deployed. Functions
+# that run on an EventBridge schedule in AWS can be run every so
+# many seconds with --every, e.g.
+#
+#   python tools/local_gateway.py --every finalproj_refresh_popularity=60
+#
+# and the client is pointed at it with a config file containing
+#
+#   [client]
+#   webservice=http://localhost:8080/prod
+#
+
+import argparse
+import base64
+import configparser
+import importlib.util
+import itertools
+import json
+import os
+import pathlib
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import local_backends
+
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+FUNCTIONS_DIR = REPO_DIR / "lambda functions"
+
+
+###################################################################
+#
+# routes
+#
+# (method, API Gateway resource, lambda function) -- the same
+# resources the client calls.
+#
+ROUTES = [
+  ("POST", "/user", "finalproj_add_user"),
+  ("POST", "/login", "finalproj_login"),
+  ("POST", "/write", "finalproj_write_entry"),
+  ("GET", "/read/{username}/{date}", "finalproj_read_entry"),
+  ("GET", "/popularity/{username}", "finalproj_popularity"),
+  ("GET", "/search/{username}", "finalproj_search"),
+  ("GET", "/recommendations/{username}", "finalproj_recommendations"),
+  ("GET", "/stats/{username}", "finalproj_stats"),
+  ("GET", "/trending", "finalproj_trending"),
+  ("GET", "/concerts-init", "finalproj_concerts_init"),
+  ("GET", "/concerts", "finalproj_get_concerts"),
+  ("GET", "/callback", "finalproj_concerts"),
+]
+
+ROUTER_FUNCTION = "finalproj_router"
+
+
+def compile_route(resource):
+  pattern = re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(resource))
+  return re.compile("^" + pattern + "$")
+
+
+class Router:
+
+  def __init__(self, routes):
+    self.routes = [(method, resource, compile_route(resource), function)
+                   for (method, resource, function) in routes]
+
+  def match(self, method, path):
+    """
+    Returns (resource, function name, path parameters), or None
+    if no route matches. A matching path with the wrong method
+    returns a resource with no function.
+    """
+    found = None
+    for (route_method, resource, pattern, function) in self.routes:
+      m = pattern.match(path)
+      if m is None:
+        continue
+      params = {k: urllib.parse.unquote(v) for (k, v) in m.groupdict().items()}
+      if route_method == method:
+        return (resource, function, params)
+      found = (resource, None, params)
+    return found
+
+
+###################################################################
+#
+# Lambda context
+#
+class LambdaContext:
+
+  def __init__(self, function_name, memory_mb, timeout_s):
+    self.function_name = function_name
+    self.function_version = "$LATEST"
+    self.invoked_function_arn = "arn:aws:lambda:local:000000000000:function:" + function_name
+    self.memory_limit_in_mb = memory_mb
+    self.aws_request_id = str(uuid.uuid4())
+    self.log_group_name = "/aws/lambda/" + function_name
+    self.log_stream_name = time.strftime("%Y/%m/%d") + "/[$LATEST]local"
+    self._deadline = time.monotonic() + timeout_s
+
+  def get_remaining_time_in_millis(self):
+    return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+###################################################################
+#
+# containers
+#
+# Importing a handler runs with the function's directory first on
+# sys.path, so it picks up that function's own datatier.py etc.
+# Modules loaded from the function's directory are then taken out
+# of sys.modules and kept by the container, so each container (like
+# each Lambda execution environment) has its own copy and module
+# state, and the next cold start imports them again.
+#
+_import_lock = threading.Lock()
+_container_ids = itertools.count(1)
+
+
+class Container:
+
+  def __init__(self, function):
+    self.function = function
+    self.id = next(_container_ids)
+    self.modules = {}
+    self.invocations = 0
+    self.last_used = time.monotonic()
+
+    start = time.perf_counter()
+    self.handler = self._load()
+    self.init_ms = (time.perf_counter() - start) * 1000
+
+  def _load(self):
+    directory = str(self.function.directory)
+
+    with _import_lock:
+      before = set(sys.modules)
+      sys.path.insert(0, directory)
+      try:
+        spec = importlib.util.spec_from_file_location(
+          "lambda_function_" + self.function.name + "_" + str(self.id),
+          self.function.directory / "lambda_function.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+      finally:
+        sys.path.remove(directory)
+        for name in set(sys.modules) - before:
+          path = getattr(sys.modules[name], "__file__", None) or ""
+          if path.startswith(directory + os.sep):
+            self.modules[name] = sys.modules.pop(name)
+
+    self.modules["lambda_function"] = module
+    return module.lambda_handler
+
+
+class Function:
+
+  def __init__(self, name, directory, idle_timeout, memory_mb, timeout_s):
+    self.name = name
+    self.directory = directory
+    self.idle_timeout = idle_timeout
+    self.memory_mb = memory_mb
+    self.timeout_s = timeout_s
+    self._idle = []
+    self._lock = threading.Lock()
+    self.busy = 0
+
+  def acquire(self):
+    """
+    Returns (container, cold) -- an idle warm container if there
+    is one, otherwise a newly started one.
+    """
+    now = time.monotonic()
+
+    with self._lock:
+      # containers idle for too long have been reclaimed:
+      self._idle = [c for c in self._idle if now - c.last_used < self.idle_timeout]
+      self.busy += 1
+      if self._idle:
+        return (self._idle.pop(), False)
+
+    try:
+      return (Container(self), True)
+    except BaseException:
+      with self._lock:
+        self.busy -= 1
+      raise
+
+  def release(self, container):
+    container.last_used = time.monotonic()
+    with self._lock:
+      self.busy -= 1
+      self._idle.append(container)
+
+  def invoke(self, event):
+    """
+    Invokes the function's handler in a container.
+
+    Returns
+    -------
+    (result, info) where result is whatever the handler returned
+    and info is a dict with container id, cold flag, init and
+    handler durations in ms
+    """
+    (container, cold) = self.acquire()
+    context = LambdaContext(self.name, self.memory_mb, self.timeout_s)
+
+    try:
+      start = time.perf_counter()
+      result = container.handler(event, context)
+      duration_ms = (time.perf_counter() - start) * 1000
+    finally:
+      container.invocations += 1
+      self.release(container)
+
+    info = {
+      "container": container.id,
+      "cold": cold,
+      "init_ms": container.init_ms if cold else 0.0,
+      "duration_ms": duration_ms,
+      "request_id": context.aws_request_id,
+    }
+    return (result, info)
+
+
+class LambdaRuntime:
+
+  def __init__(self, functions_dir, idle_timeout=300, memory_mb=128, timeout_s=30,
+               concurrency_limit=0):
+    self.functions_dir = pathlib.Path(functions_dir)
+    self.idle_timeout = idle_timeout
+    self.memory_mb = memory_mb
+    self.timeout_s = timeout_s
+    self.concurrency_limit = concurrency_limit
+    self._functions = {}
+    self._lock = threading.Lock()
+
+  def function(self, name):
+    with self._lock:
+      if name not in self._functions:
+        directory = self.functions_dir / name
+        if not (directory / "lambda_function.py").is_file():
+          raise LookupError("no lambda function '" + name + "' in " + str(self.functions_dir))
+        self._functions[name] = Function(name, directory, self.idle_timeout,
+                                         self.memory_mb, self.timeout_s)
+      return self._functions[name]
+
+  def throttled(self):
+    if self.concurrency_limit <= 0:
+      return False
+    with self._lock:
+      busy = sum(f.busy for f in self._functions.values())
+    return busy >= self.concurrency_limit
+
+  def invoke(self, name, event):
+    return self.function(name).invoke(event)
+
+
+###################################################################
+#
+# API Gateway
+#
+def make_event(method, resource, path, stage, params, query, headers, body, source_ip):
+  """
+  Builds an API Gateway REST API proxy-integration event.
+  """
+  query_pairs = urllib.parse.parse_qsl(query, keep_blank_values=True)
+  multi_query = {}
+  for (k, v) in query_pairs:
+    multi_query.setdefault(k, []).append(v)
+
+  now = time.time()
+  is_base64 = False
+
+  if body is not None:
+    try:
+      body = body.decode("utf-8")
+    except UnicodeDecodeError:
+      body = base64.b64encode(body).decode("ascii")
+      is_base64 = True
+
+  return {
+    "resource": resource,
+    "path": path,
+    "httpMethod": method,
+    "headers": dict(headers),
+    "multiValueHeaders": {k: [v] for (k, v) in headers.items()},
+    "queryStringParameters": {k: v[-1] for (k, v) in multi_query.items()} or None,
+    "multiValueQueryStringParameters": multi_query or None,
+    "pathParameters": params or None,
+    "stageVariables": None,
+    "requestContext": {
+      "resourceId": "local",
+      "resourcePath": resource,
+      "httpMethod": method,
+      "extendedRequestId": str(uuid.uuid4()),
+      "requestTime": time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(now)),
+      "path": "/" + stage + path,
+      "accountId": "000000000000",
+      "protocol": "HTTP/1.1",
+      "stage": stage,
+      "domainPrefix": "localhost",
+      "requestTimeEpoch": int(now * 1000),
+      "requestId": str(uuid.uuid4()),
+      "identity": {"sourceIp": source_ip, "userAgent": headers.get("User-Agent")},
+      "domainName": "localhost",
+      "apiId": "local",
+    },
+    "body": body,
+    "isBase64Encoded": is_base64,
+  }
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+  server_version = "ReverbLocalGateway"
+
+  def setup(self):
+    super().setup()
+    # headers and body are separate writes; don't let Nagle's
+    # algorithm hold the body back for a delayed ACK:
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+  def do_GET(self):
+    self.handle_request("GET")
+
+  def do_POST(self):
+    self.handle_request("POST")
+
+  def do_PUT(self):
+    self.handle_request("PUT")
+
+  def do_DELETE(self):
+    self.handle_request("DELETE")
+
+  def send(self, status, body, headers=None):
+    if not isinstance(body, (bytes, bytearray)):
+      body = str(body).encode("utf-8")
+    self.send_response(status)
+    headers = dict(headers or {})
+    headers.setdefault("Content-Type", "application/json")
+    for (k, v) in headers.items():
+      self.send_header(k, str(v))
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def handle_request(self, method):
+    length = int(self.headers.get("Content-Length") or 0)
+    body = self.rfile.read(length) if length > 0 else None
+
+    url = urllib.parse.urlsplit(self.path)
+    path = url.path
+
+    # the stage is optional, so both /prod/user and /user work:
+    stage = self.server.stage
+    if path == "/" + stage or path.startswith("/" + stage + "/"):
+      path = path[len(stage) + 1:] or "/"
+
+    match = self.server.router.match(method, path)
+    if match is None:
+      return self.send(403, json.dumps({"message": "Missing Authentication Token"}))
+
+    (resource, function, params) = match
+    if function is None:
+      return self.send(403, json.dumps({"message": "Missing Authentication Token"}))
+
+    runtime = self.server.runtime
+    if runtime.throttled():
+      return self.send(429, json.dumps({"message": "Too Many Requests"}), {"Retry-After": "1"})
+
+    event = make_event(method, resource, path, stage, params, url.query,
+                       dict(self.headers.items()), body, self.client_address[0])
+
+    try:
+      (result, info) = runtime.invoke(function, event)
+    except Exception as err:
+      print("**ERROR: " + function + " failed: " + str(err), file=sys.stderr)
+      return self.send(502, json.dumps({"message": "Internal server error"}))
+
+    timing = {
+      "X-Reverb-Function": function,
+      "X-Reverb-Container": info["container"],
+      "X-Reverb-Cold-Start": "true" if info["cold"] else "false",
+      "X-Reverb-Init-Duration-Ms": "%.2f" % info["init_ms"],
+      "X-Reverb-Duration-Ms": "%.2f" % info["duration_ms"],
+      "X-Amzn-RequestId": info["request_id"],
+    }
+
+    if info["duration_ms"] > runtime.timeout_s * 1000:
+      return self.send(504, json.dumps({"message": "Endpoint request timed out"}), timing)
+
+    #
+    # like API Gateway, a malformed proxy response is a 502:
+    #
+    if not isinstance(result, dict) or "statusCode" not in result:
+      return self.send(502, json.dumps({"message": "Internal server error"}), timing)
+
+    headers = dict(result.get("headers") or {})
+    for (k, values) in (result.get("multiValueHeaders") or {}).items():
+      headers[k] = ", ".join(str(v) for v in values)
+    headers.update(timing)
+
+    body = result.get("body") or ""
+    if result.get("isBase64Encoded"):
+      body = base64.b64decode(body)
+
+    self.send(int(result["statusCode"]), body, headers)
+
+
+class LocalGateway(ThreadingHTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self, address, runtime, stage="prod", verbose=False, routes=ROUTES):
+    super().__init__(address, GatewayHandler)
+    self.router = Router(routes)
+    self.runtime = runtime
+    self.stage = stage
+    self.verbose = verbose
+
+
+###################################################################
+#
+# schedules
+#
+def scheduled_event():
+  return {
+    "version": "0",
+    "id": str(uuid.uuid4()),
+    "detail-type": "Scheduled Event",
+    "source": "aws.events",
+    "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "detail": {},
+  }
+
+
+def schedule(runtime, function, seconds):
+  """
+  Invokes the function with a scheduled event every so many
+  seconds, in a background thread, like an EventBridge rule.
+  """
+
+  def run():
+    while True:
+      time.sleep(seconds)
+      try:
+        runtime.invoke(function, scheduled_event())
+      except Exception as err:
+        print("** scheduled " + function + " failed: " + str(err), file=sys.stderr)
+
+  threading.Thread(target=run, name="schedule-" + function, daemon=True).start()
+
+
+def parse_schedule(s):
+  (function, seconds) = s.split("=", 1)
+  return (function.strip(), float(seconds))
+
+
+###################################################################
+#
+# main
+#
+def parse_latency(s):
+  """
+  Parses "db=2,kms=8,s3=20" into {"db": 2.0, "kms": 8.0, "s3": 20.0}.
+  """
+  latency = {}
+  for part in filter(None, (s or "").split(",")):
+    (service, ms) = part.split("=")
+    latency[service.strip()] = float(ms)
+  return latency
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Local API Gateway + Lambda emulator for Reverb.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--stage", default="prod")
+  parser.add_argument("--config", default=str(REPO_DIR / "tools" / "reverbapp-local-config.ini"),
+                      help="reverbapp-config.ini given to the handlers")
+  parser.add_argument("--state-dir", default=str(REPO_DIR / ".reverb-local"),
+                      help="where the local database, S3 objects and KMS key live")
+  parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite",
+                      help="sqlite stand-in, or the MySQL server named in --config")
+  parser.add_argument("--kms", choices=["local", "aws"], default="local")
+  parser.add_argument("--s3", choices=["local", "aws"], default="local")
+  parser.add_argument("--latency", default="",
+                      help="simulated per-call latency of the stand-ins in ms, e.g. db=2,kms=8,s3=20")
+  parser.add_argument("--idle-timeout", type=float, default=300,
+                      help="seconds before an idle container is reclaimed")
+  parser.add_argument("--memory", type=int, default=128, help="reported memory limit in MB")
+  parser.add_argument("--timeout", type=float, default=29, help="integration timeout in seconds")
+  parser.add_argument("--concurrency-limit", type=int, default=0,
+                      help="max concurrent invocations before 429s (0 = no limit)")
+  parser.add_argument("--router", action="store_true",
+                      help="serve every route from the single router function (" + ROUTER_FUNCTION + ")")
+  parser.add_argument("--metrics-file", default=None,
+                      help="append the functions' EMF metrics here instead of logging them")
+  parser.add_argument("--every", action="append", default=[], type=parse_schedule, metavar="FUNCTION=SECONDS",
+                      help="invoke a function on a schedule, like an EventBridge rule (repeatable)")
+  parser.add_argument("--query-log", default=None,
+                      help="append each invocation's per-query timings here (see benchmark.py queries)")
+  parser.add_argument("--slow-query-ms", type=float, default=None,
+                      help="log queries slower than this with their EXPLAIN plan (default 100)")
+  parser.add_argument("--verbose", action="store_true", help="log each HTTP request")
+  return parser.parse_args(argv)
+
+
+def add_blind_index_key(config_path, kms):
+  """
+  Gives the handlers' config a [blind-index] key when it has none:
+  an HMAC key wrapped by the local KMS, kept in the state directory
+  so the digests of earlier entries still match after a restart.
+  """
+  configur = configparser.ConfigParser()
+  configur.read(config_path)
+  if configur.has_option('blind-index', 'key'):
+    return
+
+  key_file = config_path.parent / "blind-index.key"
+  if not key_file.is_file():
+    blob = kms.generate_data_key(KeyId='alias/reverbapp-key', KeySpec='AES_256')['CiphertextBlob']
+    key_file.write_text(base64.b64encode(blob).decode())
+
+  if not configur.has_section('blind-index'):
+    configur.add_section('blind-index')
+  configur.set('blind-index', 'key', key_file.read_text())
+  with open(config_path, "w") as f:
+    configur.write(f)
+
+
+def setup(args):
+  """
+  Installs the stand-ins and prepares the handlers' working
+  directory (they read reverbapp-config.ini from the cwd).
+  """
+  state_dir = pathlib.Path(args.state_dir).resolve()
+  state_dir.mkdir(parents=True, exist_ok=True)
+
+  runtime = LambdaRuntime(FUNCTIONS_DIR,
+                          idle_timeout=args.idle_timeout,
+                          memory_mb=args.memory,
+                          timeout_s=args.timeout,
+                          concurrency_limit=args.concurrency_limit)
+
+  #
+  # functions invoked by other functions (e.g. the asynchronous
+  # track lookup after /write) run in the same simulated runtime:
+  #
+  def invoke(name, event):
+    return runtime.invoke(name, event)[0]
+
+  installed = local_backends.install(state_dir, db=args.db, kms=args.kms, s3=args.s3,
+                                     latency=parse_latency(args.latency), invoke=invoke)
+
+  if args.metrics_file:
+    os.environ["REVERB_METRICS_FILE"] = str(pathlib.Path(args.metrics_file).resolve())
+  if args.query_log:
+    os.environ["REVERB_QUERY_LOG"] = str(pathlib.Path(args.query_log).resolve())
+  if args.slow_query_ms is not None:
+    os.environ["REVERB_SLOW_QUERY_MS"] = str(args.slow_query_ms)
+
+  shutil.copyfile(args.config, state_dir / "reverbapp-config.ini")
+  if "kms" in installed:
+    add_blind_index_key(state_dir / "reverbapp-config.ini", installed["kms"])
+  os.chdir(state_dir)
+
+  return runtime
+
+
+def main(argv):
+  args = parse_args(argv)
+  runtime = setup(args)
+
+  routes = ROUTES
+  if args.router:
+    routes = [(method, resource, ROUTER_FUNCTION) for (method, resource, function) in ROUTES]
+
+  server = LocalGateway((args.host, args.port), runtime, stage=args.stage, verbose=args.verbose,
+                        routes=routes)
+
+  for (function, seconds) in args.every:
+    runtime.function(function)  # fail now if there is no such function
+    schedule(runtime, function, seconds)
+
+  print("** Reverb local gateway on http://" + args.host + ":" + str(server.server_address[1])
+        + "/" + args.stage + " (db=" + args.db + ", kms=" + args.kms + ", s3=" + args.s3
+        + (", router" if args.router else "") + ") **")
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
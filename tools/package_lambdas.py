@@ -0,0 +1,455 @@
+#
+# package_lambdas.py
+#
+# Builds slim, Linux-native deployment packages for the Reverb
+# lambda functions.
+#
+# The function directories in "lambda functions/" are what we run
+# locally; several of them carry vendored copies of requests and
+# friends that they never import, built for whatever machine they
+# were installed on. This tool instead works out what each
+# handler really imports -- lambda_function.py plus the shared
+# modules it pulls in (datatier.py, tracing.py, ...) and the
+# third-party packages those import -- and builds a zip with just
+# that:
+#
+#   - first-party modules copied from the function's directory,
+#   - third-party packages pip-installed from the pins in
+#     tools/lambda-requirements.txt as manylinux wheels for the
+#     Lambda runtime's Python version and architecture (boto3 is
+#     provided by the runtime),
+#   - __pycache__, *.dist-info and bin/ stripped,
+#   - .pyc files precompiled (when this interpreter matches the
+#     runtime's version), since /var/task is read-only and Lambda
+#     would otherwise recompile on every cold start,
+#   - files in sorted order with fixed timestamps, so the same
+#     inputs always give the same zip.
+#
+# The router function (finalproj_router) is packaged with the
+# handlers of all the functions in its ROUTES, as handlers/<name>.py,
+# and the union of their imports.
+#
+# With --layer the third-party packages go into one shared layer
+# zip instead of each function's zip. The tool also checks that the
+# copies of the shared modules are identical across functions, and
+# reports each package's size and cold-start import time (measured
+# by tools/coldstart_profile.py):
+#
+#   python tools/package_lambdas.py --config reverbapp-config.ini
+#   python tools/package_lambdas.py finalproj_popularity --arch arm64 --layer
+#
+
+import argparse
+import ast
+import compileall
+import hashlib
+import json
+import os
+import pathlib
+import py_compile
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import coldstart_profile
+
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+FUNCTIONS_DIR = REPO_DIR / "lambda functions"
+
+#
+# provided by the Lambda Python runtime:
+#
+RUNTIME_PROVIDED = {"boto3", "botocore", "s3transfer", "jmespath", "dateutil"}
+
+#
+# import name -> distribution name, where they differ:
+#
+DISTRIBUTIONS = {
+  "pymysql": "PyMySQL",
+}
+
+PLATFORMS = {
+  "x86_64": "manylinux2014_x86_64",
+  "arm64": "manylinux2014_aarch64",
+}
+
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+STRIP_DIRS = ("__pycache__", "bin")
+STRIP_SUFFIXES = (".dist-info",)
+
+
+###################################################################
+#
+# import closure
+#
+def imported_names(path):
+  """
+  Returns the top-level names of the modules imported anywhere in
+  the given source file (absolute imports only).
+  """
+  tree = ast.parse(path.read_text(), filename=str(path))
+  names = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      names.update(alias.name.split(".")[0] for alias in node.names)
+    elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+      names.add(node.module.split(".")[0])
+  return names
+
+
+def import_closure(func_dir, entry=None):
+  """
+  Starting from the entry file (default: the function's
+  lambda_function.py), returns (first-party module names,
+  third-party top-level names). A module is first-party when it is
+  a .py file in the function's directory; vendored packages in the
+  directory count as third-party, since they are reinstalled from
+  wheels.
+  """
+  first_party = set()
+  third_party = set()
+  seen = set()
+  todo = [entry or func_dir / "lambda_function.py"]
+
+  while todo:
+    path = todo.pop()
+    if path in seen:
+      continue
+    seen.add(path)
+
+    for imported in imported_names(path):
+      if (func_dir / (imported + ".py")).is_file():
+        first_party.add(imported)
+        todo.append(func_dir / (imported + ".py"))
+      elif imported not in sys.stdlib_module_names:
+        third_party.add(imported)
+
+  first_party.add("lambda_function")
+  return (sorted(first_party), sorted(third_party))
+
+
+def routed_functions(func_dir):
+  """
+  Returns the functions a router serves (from the ROUTES list in
+  its lambda_function.py), or [] for an ordinary function.
+  """
+  tree = ast.parse((func_dir / "lambda_function.py").read_text())
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "ROUTES" for t in node.targets):
+      return sorted({function for (method, resource, function) in ast.literal_eval(node.value)})
+  return []
+
+
+def router_closure(func_dir, functions):
+  """
+  import_closure() for a router: its own imports plus those of
+  every handler it serves, whose shared modules come from the
+  router's directory.
+  """
+  (first_party, third_party) = (set(x) for x in import_closure(func_dir))
+  for function in functions:
+    (f, t) = import_closure(func_dir, FUNCTIONS_DIR / function / "lambda_function.py")
+    first_party.update(f)
+    third_party.update(t)
+  return (sorted(first_party), sorted(third_party))
+
+
+def read_pins(path):
+  """
+  Returns {normalized distribution name: requirement} from a
+  requirements file.
+  """
+  pins = {}
+  for line in pathlib.Path(path).read_text().splitlines():
+    line = line.split("#")[0].strip()
+    if line:
+      name = line.split("==")[0].split(">")[0].split("<")[0].strip()
+      pins[name.lower().replace("_", "-")] = line
+  return pins
+
+
+def requirements_for(third_party, pins):
+  """
+  Maps a function's third-party imports to pinned requirements;
+  returns (requirements, names that are not pinned).
+  """
+  reqs = []
+  unpinned = []
+  for name in third_party:
+    if name in RUNTIME_PROVIDED:
+      continue
+    dist = DISTRIBUTIONS.get(name, name).lower().replace("_", "-")
+    if dist in pins:
+      reqs.append(pins[dist])
+    else:
+      unpinned.append(name)
+  return (sorted(reqs), unpinned)
+
+
+###################################################################
+#
+# shared module drift
+#
+def check_shared_modules(func_dirs):
+  """
+  Returns {module: {digest: [functions]}} for every module that
+  several functions carry a copy of and whose copies differ.
+  """
+  copies = {}
+  for func_dir in func_dirs:
+    for path in func_dir.glob("*.py"):
+      if path.name != "lambda_function.py":
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()[:12]
+        copies.setdefault(path.name, {}).setdefault(digest, []).append(func_dir.name)
+
+  return {module: digests for (module, digests) in copies.items() if len(digests) > 1}
+
+
+###################################################################
+#
+# building
+#
+def pip_install(target, reqs, args):
+  cmd = [sys.executable, "-m", "pip", "install", "--quiet", "--disable-pip-version-check",
+         "--root-user-action=ignore",
+         "--target", str(target),
+         "--platform", PLATFORMS[args.arch],
+         "--implementation", "cp",
+         "--python-version", args.python_version,
+         "--only-binary=:all:",
+         "--no-compile",
+         "--upgrade"] + reqs
+  subprocess.run(cmd, check=True)
+
+
+def strip(root):
+  """
+  Removes caches, package metadata and console scripts.
+  """
+  for path in sorted(root.rglob("*"), reverse=True):
+    if path.is_dir() and (path.name in STRIP_DIRS or path.name.endswith(STRIP_SUFFIXES)):
+      shutil.rmtree(path)
+
+
+def target_matches_interpreter(args):
+  return (args.python_version == "%d.%d" % sys.version_info[:2]
+          and sys.platform == "linux"
+          and os.uname().machine == {"x86_64": "x86_64", "arm64": "aarch64"}[args.arch])
+
+
+def precompile(root):
+  """
+  Writes .pyc files next to the sources; they are checked by hash,
+  not by the (meaningless, zipped) mtime.
+  """
+  compileall.compile_dir(str(root), quiet=1, workers=0,
+                         invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+def write_zip(root, zip_path):
+  """
+  Zips the tree under root reproducibly; returns (# of files,
+  uncompressed bytes).
+  """
+  files = sorted(p for p in root.rglob("*") if p.is_file())
+  total = 0
+  with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as z:
+    for path in files:
+      info = zipfile.ZipInfo(path.relative_to(root).as_posix(), ZIP_DATE)
+      info.compress_type = zipfile.ZIP_DEFLATED
+      mode = 0o755 if path.stat().st_mode & 0o111 else 0o644
+      info.external_attr = (0o100000 | mode) << 16
+      data = path.read_bytes()
+      total += len(data)
+      z.writestr(info, data)
+  return (len(files), total)
+
+
+def build_function(func_dir, reqs, modules, args, layer_dir=None, handlers=()):
+  out = pathlib.Path(args.out)
+  stage = out / "stage" / func_dir.name
+  if stage.exists():
+    shutil.rmtree(stage)
+  stage.mkdir(parents=True)
+
+  for name in modules:
+    shutil.copyfile(func_dir / (name + ".py"), stage / (name + ".py"))
+  if handlers:
+    (stage / "handlers").mkdir()
+    for function in handlers:
+      shutil.copyfile(FUNCTIONS_DIR / function / "lambda_function.py", stage / "handlers" / (function + ".py"))
+  if args.config:
+    shutil.copyfile(args.config, stage / "reverbapp-config.ini")
+
+  if reqs and layer_dir is None:
+    pip_install(stage, reqs, args)
+
+  strip(stage)
+  if args.compile:
+    precompile(stage)
+
+  zip_path = out / (func_dir.name + ".zip")
+  (nfiles, unpacked) = write_zip(stage, zip_path)
+
+  return {
+    "function": func_dir.name,
+    "modules": modules,
+    "handlers": list(handlers),
+    "requirements": reqs,
+    "files": nfiles,
+    "unpacked_bytes": unpacked,
+    "zip_bytes": zip_path.stat().st_size,
+    "zip": str(zip_path),
+    "stage": stage,
+  }
+
+
+def build_layer(reqs, args):
+  out = pathlib.Path(args.out)
+  stage = out / "stage" / "layer"
+  if stage.exists():
+    shutil.rmtree(stage)
+  site = stage / "python"
+  site.mkdir(parents=True)
+
+  if reqs:
+    pip_install(site, reqs, args)
+  strip(site)
+  if args.compile:
+    precompile(site)
+
+  zip_path = out / "reverb-deps-layer.zip"
+  (nfiles, unpacked) = write_zip(stage, zip_path)
+  return {
+    "layer": zip_path.name,
+    "requirements": reqs,
+    "files": nfiles,
+    "unpacked_bytes": unpacked,
+    "zip_bytes": zip_path.stat().st_size,
+    "zip": str(zip_path),
+    "site": site,
+  }
+
+
+###################################################################
+#
+# main
+#
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Build slim deployment zips for the Reverb lambda functions.")
+  parser.add_argument("functions", nargs="*", help="function directories to build (default: all)")
+  parser.add_argument("--out", default=str(REPO_DIR / "build" / "lambda"), help="output directory")
+  parser.add_argument("--requirements", default=str(REPO_DIR / "tools" / "lambda-requirements.txt"),
+                      help="pinned third-party packages")
+  parser.add_argument("--python-version", default="3.12", help="Lambda runtime's Python version")
+  parser.add_argument("--arch", choices=sorted(PLATFORMS), default="x86_64")
+  parser.add_argument("--layer", action="store_true",
+                      help="put third-party packages in one shared layer instead of each zip")
+  parser.add_argument("--config", help="reverbapp-config.ini to bundle with each function")
+  parser.add_argument("--no-compile", dest="compile", action="store_false",
+                      help="don't precompile .pyc files")
+  parser.add_argument("--import-runs", type=int, default=3,
+                      help="fresh-interpreter imports to time per function (0 = skip)")
+  parser.add_argument("--allow-drift", action="store_true",
+                      help="build even if copies of a shared module differ")
+  parser.add_argument("--report", help="write the JSON report here")
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  args = parse_args(argv)
+
+  all_dirs = sorted(p for p in FUNCTIONS_DIR.glob("finalproj_*") if (p / "lambda_function.py").is_file())
+  if args.functions:
+    names = set(args.functions)
+    func_dirs = [p for p in all_dirs if p.name in names]
+    unknown = names - {p.name for p in func_dirs}
+    if unknown:
+      print("**ERROR: unknown function(s): " + ", ".join(sorted(unknown)), file=sys.stderr)
+      return 2
+  else:
+    func_dirs = all_dirs
+
+  drift = check_shared_modules(all_dirs)
+  for (module, digests) in sorted(drift.items()):
+    print("**Shared module " + module + " differs between copies:", file=sys.stderr)
+    for (digest, functions) in digests.items():
+      print("    " + digest + ": " + ", ".join(functions), file=sys.stderr)
+  if drift and not args.allow_drift:
+    return 1
+
+  if args.compile and not target_matches_interpreter(args):
+    print("** note: not precompiling, this is Python %d.%d on %s/%s, the runtime is Python %s on linux/%s"
+          % (sys.version_info[:2] + (sys.platform, os.uname().machine, args.python_version, args.arch)),
+          file=sys.stderr)
+    args.compile = False
+  if not args.config:
+    print("** note: no --config, reverbapp-config.ini must be added to each function at deploy time",
+          file=sys.stderr)
+
+  pins = read_pins(args.requirements)
+  plans = []
+  for func_dir in func_dirs:
+    handlers = routed_functions(func_dir)
+    if handlers:
+      (modules, third_party) = router_closure(func_dir, handlers)
+    else:
+      (modules, third_party) = import_closure(func_dir)
+    (reqs, unpinned) = requirements_for(third_party, pins)
+    if unpinned:
+      print("**ERROR: " + func_dir.name + " imports " + ", ".join(unpinned)
+            + ", which are not pinned in " + args.requirements, file=sys.stderr)
+      return 1
+    plans.append((func_dir, modules, reqs, handlers))
+
+  pathlib.Path(args.out).mkdir(parents=True, exist_ok=True)
+
+  layer = None
+  if args.layer:
+    layer = build_layer(sorted({r for (d, m, reqs, h) in plans for r in reqs}), args)
+
+  results = []
+  for (func_dir, modules, reqs, handlers) in plans:
+    result = build_function(func_dir, reqs, modules, args, layer_dir=layer["site"] if layer else None,
+                            handlers=handlers)
+
+    result["import_ms"] = result["init_ms"] = None
+    if args.import_runs > 0 and target_matches_interpreter(args):
+      extra = [layer["site"]] if layer else []
+      profile = coldstart_profile.profile_function(result["stage"], extra, args.import_runs)
+      result["import_ms"] = profile.get("import_ms")
+      result["init_ms"] = profile.get("init_ms")
+      if "error" in profile:
+        result["import_error"] = profile["error"]
+    results.append(result)
+
+  print("%-26s %8s %11s %9s %10s %10s  %s" % ("function", "files", "unpacked", "zip", "init ms", "import ms",
+        "requirements"))
+  for r in results:
+    (init, imp) = ("%.1f" % r[k] if r[k] is not None else "n/a" for k in ("init_ms", "import_ms"))
+    print("%-26s %8d %10.1fK %8.1fK %10s %10s  %s" % (r["function"], r["files"], r["unpacked_bytes"] / 1024,
+          r["zip_bytes"] / 1024, init, imp, " ".join(r["requirements"]) or "-"))
+    if r.get("import_error"):
+      print("    import failed: " + r["import_error"])
+  if layer:
+    print("%-26s %8d %10.1fK %8.1fK %10s %10s  %s" % (layer["layer"], layer["files"], layer["unpacked_bytes"] / 1024,
+          layer["zip_bytes"] / 1024, "", "", " ".join(layer["requirements"]) or "-"))
+
+  if args.report:
+    report = {
+      "python_version": args.python_version,
+      "arch": args.arch,
+      "functions": [{k: v for (k, v) in r.items() if k != "stage"} for r in results],
+      "layer": {k: v for (k, v) in layer.items() if k != "site"} if layer else None,
+    }
+    with open(args.report, "w") as f:
+      json.dump(report, f, indent=2)
+      f.write("\n")
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))